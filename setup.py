@@ -2,13 +2,60 @@ from setuptools import setup
 from Cython.Build import cythonize
 import numpy
 import os
+import sys
+import tempfile
 
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
 include_path = [numpy.get_include()]
 
+
+def openmp_flags():
+    """
+    Return the compiler and linker flags which enable OpenMP, or empty lists if the
+    compiler does not support it (e.g. Apple clang), in which case the
+    multithreaded network simplex runs on a single thread.
+    """
+    from setuptools._distutils.ccompiler import new_compiler
+    from setuptools._distutils.sysconfig import customize_compiler
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    if compiler.compiler_type == "msvc":
+        compile_flags, link_flags = ["/openmp"], []
+    else:
+        compile_flags, link_flags = ["-fopenmp"], ["-fopenmp"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "test_openmp.c")
+        with open(source, "w") as f:
+            f.write(
+                "#include <omp.h>\n"
+                "int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n"
+            )
+        try:
+            objects = compiler.compile(
+                [source], output_dir=tmpdir, extra_postargs=compile_flags
+            )
+            compiler.link_executable(
+                objects,
+                os.path.join(tmpdir, "test_openmp"),
+                extra_postargs=link_flags,
+            )
+        except Exception:
+            print("OpenMP is not supported by the compiler.", file=sys.stderr)
+            return [], []
+    return compile_flags, link_flags
+
+
+extensions = cythonize(["src/cajal/*.pyx", "src/cajal/EMD_wrapper.cpp"])
+omp_compile_flags, omp_link_flags = openmp_flags()
+for extension in extensions:
+    if extension.name == "cajal.gw_cython":
+        extension.extra_compile_args += omp_compile_flags
+        extension.extra_link_args += omp_link_flags
+
 setup(
-    ext_modules=cythonize(["src/cajal/*.pyx", "src/cajal/EMD_wrapper.cpp"]),
+    ext_modules=extensions,
     compiler_directives={"language_level": "3"},
     include_dirs=include_path,
 )
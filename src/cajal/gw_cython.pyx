@@ -23,11 +23,38 @@ from scipy import sparse
 
 cdef extern from "EMD.h":
     int EMD_wrap(int n1, int n2, double *X, double *Y, double *D, double *G, double* alpha, double* beta, double *cost, uint64_t maxIter) nogil
+    int EMD_wrap_omp(int n1,int n2, double *X, double *Y,double *D, double *G, double* alpha, double* beta, double *cost, uint64_t maxIter, int numThreads) nogil
     cdef enum ProblemType: INFEASIBLE, OPTIMAL, UNBOUNDED, MAX_ITER_REACHED
-# cdef extern from "EMD.h":
-#     int EMD_wrap(int n1,int n2, double *X, double *Y,double *D, double *G, double* alpha, double* beta, double *cost, uint64_t maxIter) nogil
-#     int EMD_wrap_omp(int n1,int n2, double *X, double *Y,double *D, double *G, double* alpha, double* beta, double *cost, uint64_t maxIter, int numThreads) nogil
-#     cdef enum ProblemType: INFEASIBLE, OPTIMAL, UNBOUNDED, MAX_ITER_REACHED
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    static const int CAJAL_OPENMP = 1;
+    #else
+    static const int CAJAL_OPENMP = 0;
+    #endif
+    """
+    const int CAJAL_OPENMP
+
+
+def openmp_available() -> bool:
+    """
+    Whether this module was compiled with OpenMP support. If not, the
+    `num_threads` argument of the functions in this module has no effect.
+    """
+    return CAJAL_OPENMP == 1
+
+
+cdef int _emd(int n, int m, double *a, double *b, double *C, double *P,
+              double *alpha, double *beta, double *cost,
+              uint64_t max_iters_ot, int num_threads) noexcept nogil:
+    """
+    Solve the optimal transport problem with the network simplex, using the
+    multithreaded version if num_threads is not 1.
+    """
+    if num_threads == 1:
+        return EMD_wrap(n, m, a, b, C, P, alpha, beta, cost, max_iters_ot)
+    return EMD_wrap_omp(n, m, a, b, C, P, alpha, beta, cost, max_iters_ot, num_threads)
 
 
 cdef extern from "stdlib.h":
@@ -79,22 +106,97 @@ class GW_cell:
                                        # matrix with the probability
                                        # distribution
     cell_constant : float # ((A * A) @ a) @ a
-    def __init__(self,dmat,distribution):
-        self.dmat = dmat
-        self.distribution = distribution
+    features : Optional[npt.NDArray[np.float_]] # Per-point features, of shape (n, k)
+    def __init__(self,dmat,distribution,features=None,dtype=np.float64):
+        # The constants are computed before dmat is converted to `dtype`,
+        # so that they are exact even if dmat is stored in single precision.
         self.dmat_dot_dist = dmat @ distribution
         self.cell_constant = ((dmat * dmat) @ distribution) @ distribution
+        self.dmat = np.ascontiguousarray(dmat, dtype=dtype)
+        self.distribution = distribution
+        self.features = features
+
+cdef tuple _product_buffers(A, B, int n, int m):
+    """
+    Allocate the work arrays for :func:`_scaled_APB`. Returns a triple
+    (AP, P_work, C_work); the last two are None if A and B are in double precision.
+    """
+    if A.dtype != B.dtype:
+        raise TypeError("A and B must have the same dtype.")
+    if A.dtype == np.float64:
+        return (np.zeros((n,m),dtype=DTYPE,order='C'), None, None)
+    if A.dtype == np.float32:
+        return (np.zeros((n,m),dtype=np.float32,order='C'),
+                np.zeros((n,m),dtype=np.float32,order='C'),
+                np.zeros((n,m),dtype=np.float32,order='C'))
+    raise TypeError("Distance matrices must be of dtype float32 or float64.")
+
+cdef _scaled_APB(A, P, B, double scale, AP, P_work, C_work, C):
+    """
+    Set the double precision matrix C to scale * A @ P @ B. If A and B are
+    stored in single precision, P is rounded to single precision and both
+    matrix products are computed in single precision, which is about twice as fast.
+    """
+    if P_work is None:
+        np.dot(A,P,out=AP)
+        np.multiply(AP,scale,out=AP)
+        np.matmul(AP,B,out=C)
+    else:
+        np.copyto(P_work,P,casting='same_kind')
+        np.dot(A,P_work,out=AP)
+        np.multiply(AP,scale,out=AP)
+        np.matmul(AP,B,out=C_work)
+        np.copyto(C,C_work)
+
+cpdef double emd_cost(
+    np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
+    np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
+    np.ndarray[DTYPE_t,ndim=2,mode='c'] C,
+    uint64_t max_iters_ot = 200000,
+    int num_threads = 1,
+):
+    """
+    Compute the optimal transport cost between two probability distributions.
+
+    :param a: A probability distribution of length n.
+    :param b: A probability distribution of length m.
+    :param C: A cost matrix of shape (n,m).
+    :param num_threads: The number of OpenMP threads used by the network simplex
+        algorithm; -1 for all available cores.
+    :return: The minimum of <C,P> over all couplings P of a and b.
+    """
+    cdef int n = a.shape[0]
+    cdef int m = b.shape[0]
+    cdef int result_code
+    cdef double cost = 0.0
+    cdef np.ndarray[double, ndim=1, mode="c"] alpha=np.zeros(n)
+    cdef np.ndarray[double, ndim=1, mode="c"] beta=np.zeros(m)
+    cdef np.ndarray[np.float64_t,ndim=2,mode='c'] P = np.zeros((n,m),dtype=DTYPE,order='C')
+    with nogil:
+        result_code=_emd(n,m, <double*> a.data, <double*> b.data,
+                         <double*> C.data, <double*> P.data,
+                         <double*> alpha.data, <double*> beta.data,
+                         &cost, max_iters_ot, num_threads)
+    if result_code != OPTIMAL:
+        if result_code == INFEASIBLE:
+            raise Exception("INFEASIBLE")
+        if result_code == UNBOUNDED:
+            raise Exception("UNBOUNDED")
+        if result_code == MAX_ITER_REACHED:
+            raise Warning("MAX_ITER_REACHED")
+    return cost
 
 cpdef gw_cython_init_cost(
-    np.ndarray[DTYPE_t,ndim=2,mode='c'] A,
+    np.ndarray A,
     np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
     DTYPE_t c_A,
-    np.ndarray[DTYPE_t,ndim=2,mode='c'] B,
+    np.ndarray B,
     np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
     DTYPE_t c_B,
     np.ndarray[DTYPE_t,ndim=2,mode='c'] C,
     int max_iters_descent =1000,
     uint64_t max_iters_ot = 200000,
+    int num_threads = 1,
 ):
 
     cdef int it = 0
@@ -106,17 +208,18 @@ cpdef gw_cython_init_cost(
     cdef np.ndarray[double, ndim=1, mode="c"] alpha=np.zeros(n)
     cdef np.ndarray[double, ndim=1, mode="c"] beta=np.zeros(m)
     cdef np.ndarray[DTYPE_t, ndim=2, mode="c"] neg2_PB
-    cdef np.ndarray[double, ndim=2, mode="c"] AP=np.zeros((n,m),dtype=DTYPE,order='C')
+    AP, P_work, C_work = _product_buffers(A, B, n, m)
     cdef np.ndarray[np.float64_t,ndim=2,mode='c'] P = np.zeros((n,m),dtype=DTYPE,order='C')
     cost=c_A+c_B
     cdef double temp=0.0
     cost+=float(np.tensordot(C,P))
 
     while it<max_iters_descent:
-        result_code=EMD_wrap(n,m, <double*> a.data, <double*> b.data,
-                             <double*> C.data, <double*>P.data,
+        with nogil:
+            result_code=_emd(n,m, <double*> a.data, <double*> b.data,
+                             <double*> C.data, <double*> P.data,
                              <double*> alpha.data, <double*> beta.data,
-                             <double*> &temp, max_iters_ot)
+                             &temp, max_iters_ot, num_threads)
 
         if result_code != OPTIMAL:
             # cdef enum ProblemType: INFEASIBLE, OPTIMAL, UNBOUNDED, MAX_ITER_REACHED
@@ -128,9 +231,7 @@ cpdef gw_cython_init_cost(
                 raise Warning("MAX_ITER_REACHED")
             
         # P_sparse = scipy.sparse.csc_matrix(P,shape=(n,m), dtype=DTYPE)
-        np.dot(A,P,out=AP)
-        np.multiply(AP,-2.0,out=AP)
-        np.matmul(AP,B,out=C)
+        _scaled_APB(A,P,B,-2.0,AP,P_work,C_work,C)
         newcost=c_A+c_B
         newcost+=float(np.tensordot(C,P))
         if newcost >= cost:
@@ -141,26 +242,33 @@ cpdef gw_cython_init_cost(
     
 
 cpdef gw_cython_core(
-        np.ndarray[DTYPE_t,ndim=2,mode='c'] A,
+        np.ndarray A,
         np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
         np.ndarray[DTYPE_t,ndim=1,mode='c'] Aa,
         DTYPE_t c_A,
-        np.ndarray[DTYPE_t,ndim=2,mode='c'] B,
+        np.ndarray B,
         np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
         np.ndarray[DTYPE_t,ndim=1,mode='c'] Bb,
         DTYPE_t c_B,
         int max_iters_descent =1000,
-        uint64_t max_iters_ot = 200000
+        uint64_t max_iters_ot = 200000,
+        int num_threads = 1,
 ):
     """
-    :param A: A squareform distance matrix.
+    :param A: A squareform distance matrix, C-contiguous, of dtype float64 or float32.
+        In single precision the matrix products in each gradient step are computed in
+        single precision; the optimal transport problems and the cost are
+        always computed in double precision.
     :param a: A probability distribution on points of A.
     :param Aa: Should be equal to the matrix-vector product A@a.
     :param c_A: Should be equal to the scalar ((A * A)@a)@a.
-    :param B: A squareform distance matrix.
+    :param B: A squareform distance matrix of the same dtype as A.
     :param b: A probability distribution on points of B.
     :param Bb: Should be equal to the matrix-vector product B@b.
     :param c_B: Should be equal to the scalar ((B * B)@b)@b.
+    :param num_threads: The number of OpenMP threads used to solve each optimal
+        transport problem; -1 for all available cores. Multithreading only pays
+        off for large cells, see :func:`cajal.run_gw.gw`.
     :return: A pair (P, gw_dist) where P is a transport plan and gw_dist is the associated cost.
     """
 
@@ -174,7 +282,253 @@ cpdef gw_cython_core(
         c_B,
         C,
         max_iters_descent,
-        max_iters_ot)
+        max_iters_ot,
+        num_threads)
+
+cpdef fused_gw_cython_init_cost(
+    np.ndarray A,
+    np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
+    DTYPE_t c_A,
+    np.ndarray B,
+    np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
+    DTYPE_t c_B,
+    np.ndarray[DTYPE_t,ndim=2,mode='c'] M,
+    DTYPE_t alpha,
+    np.ndarray[DTYPE_t,ndim=2,mode='c'] C,
+    int max_iters_descent =1000,
+    uint64_t max_iters_ot = 200000,
+    int num_threads = 1,
+):
+    """
+    Compute the fused Gromov-Wasserstein distance by gradient descent.
+
+    The objective minimized over couplings P of a and b is
+    alpha * (c_A + c_B - 2 <APB,P>) + (1 - alpha) * <M,P>,
+    so that for alpha = 1 this is the same as :func:`gw_cython_init_cost`.
+
+    :param M: A feature cost matrix of shape (n,m); M[i,j] is the cost of
+        matching point i of A with point j of B.
+    :param alpha: A real number between 0 and 1; the weight of the
+        structural (GW) term against the feature term.
+    :param C: The initial linear cost matrix. This matrix is overwritten.
+    :return: A pair (P, fused_gw_dist) where P is a transport plan
+        and fused_gw_dist is the square root of the objective, divided by two.
+    """
+    cdef int it = 0
+    cdef int n = a.shape[0]
+    cdef int m = b.shape[0]
+    cdef int result_code
+    cdef DTYPE_t cost=0.0
+    cdef DTYPE_t newcost=0.0
+    cdef np.ndarray[double, ndim=1, mode="c"] alpha_dual=np.zeros(n)
+    cdef np.ndarray[double, ndim=1, mode="c"] beta_dual=np.zeros(m)
+    AP, P_work, C_work = _product_buffers(A, B, n, m)
+    cdef np.ndarray[np.float64_t,ndim=2,mode='c'] P = np.zeros((n,m),dtype=DTYPE,order='C')
+    cdef double temp=0.0
+    # Unlike the GW objective, the objective is not bounded above by its
+    # value at P = 0, so the first step is always taken.
+    cost=float("inf")
+
+    while it<max_iters_descent:
+        with nogil:
+            result_code=_emd(n,m, <double*> a.data, <double*> b.data,
+                             <double*> C.data, <double*> P.data,
+                             <double*> alpha_dual.data, <double*> beta_dual.data,
+                             &temp, max_iters_ot, num_threads)
+
+        if result_code != OPTIMAL:
+            if result_code == INFEASIBLE:
+                raise Exception("INFEASIBLE")
+            if result_code == UNBOUNDED:
+                raise Exception("UNBOUNDED")
+            if result_code == MAX_ITER_REACHED:
+                raise Warning("MAX_ITER_REACHED")
+
+        _scaled_APB(A,P,B,-2.0*alpha,AP,P_work,C_work,C)
+        newcost=alpha*(c_A+c_B)
+        newcost+=float(np.tensordot(C,P))
+        newcost+=(1.0-alpha)*float(np.tensordot(M,P))
+        if newcost >= cost:
+            cost = max(cost,0)
+            return (P,sqrt(cost)/2.0)
+        cost=newcost
+        # C is now half the gradient of the quadratic term; add half the
+        # gradient of the linear term.
+        C+=(0.5*(1.0-alpha))*M
+        it+=1
+
+
+cpdef fused_gw_cython_core(
+        np.ndarray A,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] Aa,
+        DTYPE_t c_A,
+        np.ndarray B,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] Bb,
+        DTYPE_t c_B,
+        np.ndarray[DTYPE_t,ndim=2,mode='c'] M,
+        DTYPE_t alpha,
+        int max_iters_descent =1000,
+        uint64_t max_iters_ot = 200000,
+        int num_threads = 1,
+):
+    """
+    :param A: A squareform distance matrix.
+    :param a: A probability distribution on points of A.
+    :param Aa: Should be equal to the matrix-vector product A@a.
+    :param c_A: Should be equal to the scalar ((A * A)@a)@a.
+    :param B: A squareform distance matrix.
+    :param b: A probability distribution on points of B.
+    :param Bb: Should be equal to the matrix-vector product B@b.
+    :param c_B: Should be equal to the scalar ((B * B)@b)@b.
+    :param M: A feature cost matrix of shape (n,m).
+    :param alpha: The weight of the structural term, between 0 and 1.
+    :return: A pair (P, fused_gw_dist) where P is a transport plan and
+        fused_gw_dist is the associated cost, see :func:`fused_gw_cython_init_cost`.
+    """
+
+    cdef np.ndarray[np.float64_t,ndim=2,mode='c'] C = np.multiply(Aa[:,np.newaxis],(-2.0*alpha*Bb)[np.newaxis,:],order='C')
+    C+=(0.5*(1.0-alpha))*M
+    return fused_gw_cython_init_cost(
+        A,
+        a,
+        c_A,
+        B,
+        b,
+        c_B,
+        M,
+        alpha,
+        C,
+        max_iters_descent,
+        max_iters_ot,
+        num_threads)
+
+cpdef partial_gw_cython_core(
+        np.ndarray A,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
+        np.ndarray B,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
+        DTYPE_t mass,
+        int max_iters_descent =1000,
+        uint64_t max_iters_ot = 200000,
+        int num_threads = 1,
+):
+    """
+    Compute the partial Gromov-Wasserstein distance by gradient descent.
+
+    The minimum is taken over all nonnegative matrices P with P1 <= a,
+    P^T1 <= b and total mass `mass`, of the cost
+    L(P) = sum_{i,j,k,l} (A[i,k]-B[j,l])^2 P[i,j] P[k,l].
+    Each linear subproblem is a partial optimal transport problem, which is
+    solved as a balanced one by adding a dummy point to each side which
+    absorbs the mass which is not transported.
+
+    :param A: A squareform distance matrix.
+    :param a: A probability distribution on points of A.
+    :param B: A squareform distance matrix.
+    :param b: A probability distribution on points of B.
+    :param mass: The total mass to be transported, between 0 and 1.
+    :return: A pair (P, partial_gw_dist) where P is a transport plan of total mass
+        `mass` and partial_gw_dist is sqrt(L(P)) / (2 * mass), which is the GW
+        distance between the two normalized sub-measures matched by P. When `mass`
+        is 1 this is the usual GW distance.
+    """
+    cdef int n = a.shape[0]
+    cdef int m = b.shape[0]
+    if not (0.0 < mass <= min(np.sum(a), np.sum(b)) + 1e-12):
+        raise ValueError("mass must be positive and at most the mass of a and b.")
+    # The descent is started from the product coupling and from the optimal GW
+    # coupling scaled to the given mass, and the better result is kept. When a
+    # large part of one cell matches the other, the product coupling leads to a
+    # poor local minimum.
+    P_product = np.multiply(a[:,np.newaxis],(mass*b)[np.newaxis,:],order='C')
+    P_best, cost = _partial_gw_descent(
+        A, a, B, b, mass, P_product, max_iters_descent, max_iters_ot, num_threads)
+    Aa = np.asarray(A @ a, dtype=DTYPE)
+    Bb = np.asarray(B @ b, dtype=DTYPE)
+    P_gw, _ = gw_cython_core(
+        A, a, Aa, float(np.dot(np.multiply(A,A) @ a, a)),
+        B, b, Bb, float(np.dot(np.multiply(B,B) @ b, b)),
+        max_iters_descent, max_iters_ot, num_threads)
+    P, newcost = _partial_gw_descent(
+        A, a, B, b, mass, np.multiply(P_gw,mass,order='C'),
+        max_iters_descent, max_iters_ot, num_threads)
+    if newcost < cost:
+        P_best, cost = P, newcost
+    return (P_best,sqrt(max(cost,0))/(2.0*mass))
+
+cdef tuple _partial_gw_descent(
+        A,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] a,
+        B,
+        np.ndarray[DTYPE_t,ndim=1,mode='c'] b,
+        DTYPE_t mass,
+        np.ndarray[DTYPE_t,ndim=2,mode='c'] P,
+        int max_iters_descent,
+        uint64_t max_iters_ot,
+        int num_threads,
+):
+    """
+    Run the descent of :func:`partial_gw_cython_core` from the coupling P, of total
+    mass `mass`. Returns the pair (P, L(P)) for the last coupling which lowered the cost.
+    """
+    cdef int it = 0
+    cdef int n = a.shape[0]
+    cdef int m = b.shape[0]
+    cdef int result_code
+    cdef DTYPE_t cost=0.0
+    cdef DTYPE_t newcost=0.0
+    cdef double temp=0.0
+    A2 = np.multiply(A,A)
+    B2 = np.multiply(B,B)
+    cdef np.ndarray[DTYPE_t,ndim=1,mode='c'] a_ext = np.append(a, max(np.sum(b)-mass,0.0))
+    cdef np.ndarray[DTYPE_t,ndim=1,mode='c'] b_ext = np.append(b, max(np.sum(a)-mass,0.0))
+    cdef np.ndarray[double, ndim=1, mode="c"] alpha=np.zeros(n+1)
+    cdef np.ndarray[double, ndim=1, mode="c"] beta=np.zeros(m+1)
+    AP, P_work, C_work = _product_buffers(A, B, n, m)
+    cdef np.ndarray[DTYPE_t,ndim=2,mode='c'] G = np.zeros((n,m),dtype=DTYPE,order='C')
+    cdef np.ndarray[DTYPE_t,ndim=2,mode='c'] C_ext = np.zeros((n+1,m+1),dtype=DTYPE,order='C')
+    cdef np.ndarray[DTYPE_t,ndim=2,mode='c'] P_ext = np.zeros((n+1,m+1),dtype=DTYPE,order='C')
+    cdef np.ndarray[DTYPE_t,ndim=2,mode='c'] P_new
+
+    # G is half the gradient of L at P, and L(P) = <G,P>.
+    _scaled_APB(A,P,B,-2.0,AP,P_work,C_work,G)
+    G += (A2 @ P.sum(axis=1).astype(A2.dtype))[:,np.newaxis]
+    G += (B2 @ P.sum(axis=0).astype(B2.dtype))[np.newaxis,:]
+    cost=float(np.tensordot(G,P))
+    while it<max_iters_descent:
+        C_ext[:n,:m] = G
+        # Transporting mass between the two dummy points must never be
+        # cheaper than transporting it between real points.
+        C_ext[n,m] = 2.0 * np.max(np.abs(G)) + 1.0
+        P_ext[:,:] = 0.0
+        with nogil:
+            result_code=_emd(n+1,m+1, <double*> a_ext.data, <double*> b_ext.data,
+                             <double*> C_ext.data, <double*> P_ext.data,
+                             <double*> alpha.data, <double*> beta.data,
+                             &temp, max_iters_ot, num_threads)
+
+        if result_code != OPTIMAL:
+            if result_code == INFEASIBLE:
+                raise Exception("INFEASIBLE")
+            if result_code == UNBOUNDED:
+                raise Exception("UNBOUNDED")
+            if result_code == MAX_ITER_REACHED:
+                raise Warning("MAX_ITER_REACHED")
+
+        P_new = np.ascontiguousarray(P_ext[:n,:m])
+        _scaled_APB(A,P_new,B,-2.0,AP,P_work,C_work,G)
+        G += (A2 @ P_new.sum(axis=1).astype(A2.dtype))[:,np.newaxis]
+        G += (B2 @ P_new.sum(axis=0).astype(B2.dtype))[np.newaxis,:]
+        newcost=float(np.tensordot(G,P_new))
+        if newcost >= cost:
+            return (P,cost)
+        P = P_new
+        cost=newcost
+        it+=1
+    return (P,cost)
+
 
 def gw_pairwise(
         list cell_dms           # A list of GW_cells.
@@ -390,17 +744,45 @@ def qgw_init_cost(
         np.ndarray[np.float64_t,ndim=2] C,
 ):
 
-    cdef int n = a.shape[0]
-    cdef int ns = A_s.shape[0]
-    cdef int m = b.shape[0]
-    cdef int ms = B_s.shape[0]
+    cdef np.ndarray[np.float64_t,ndim=2] quantized_coupling # size ns x ms
+    quantized_coupling, _=gw_cython_init_cost(A_s,a_s,c_As,B_s,b_s,c_Bs,C)
+    return qgw_expand_coupling(a, A_si, a_s, b, B_si, b_s, quantized_coupling)
+
+
+def qgw_expand_coupling(
+        np.ndarray[np.float64_t,ndim=1] a,
+        np.ndarray[Py_ssize_t,ndim=1] A_si,
+        np.ndarray[np.float64_t,ndim=1] a_s,
+        np.ndarray[np.float64_t,ndim=1] b,
+        np.ndarray[Py_ssize_t,ndim=1] B_si,
+        np.ndarray[np.float64_t,ndim=1] b_s,
+        np.ndarray[np.float64_t,ndim=2] quantized_coupling,
+):
+    """
+    Expand a coupling between the clusters of two quantized cells into a sparse
+    coupling between all their points.
+
+    The mass quantized_coupling[i,j] sent from cluster i of A to cluster j of B
+    is distributed between the points of the two clusters by the monotone
+    one-dimensional coupling, with points in each cluster sorted by their distance
+    to the medoid.
+
+    :param a: The probability distribution on the points of A.
+    :param A_si: The cluster boundaries of A, of length ns+1.
+    :param a_s: The quantized distribution on the clusters of A, of length ns.
+    :param b: The probability distribution on the points of B.
+    :param B_si: The cluster boundaries of B, of length ms+1.
+    :param b_s: The quantized distribution on the clusters of B, of length ms.
+    :param quantized_coupling: A coupling matrix of shape (ns, ms).
+    :return: A triple (T_rows, T_cols, T_vals) representing the coupling in
+        COO format. There may be entries of the form (0,0,0.0).
+    """
+    cdef int ns = A_si.shape[0]-1
+    cdef int ms = B_si.shape[0]-1
     cdef Py_ssize_t i = 0
     cdef Py_ssize_t j = 0
     cdef int a_local_len
     cdef int b_local_len
-    cdef np.ndarray[np.float64_t,ndim=2] quantized_coupling # size ns x ms
-    
-    quantized_coupling, _=gw_cython_init_cost(A_s,a_s,c_As,B_s,b_s,c_Bs,C)
     # We can count, roughly, how many elements we'll need in the coupling matrix.
     cdef int num_elts =0
     for i in range(ns):
@@ -444,6 +826,108 @@ def qgw_init_cost(
     
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sparse_coupling_inner_product(
+        const cython.floating[:,::1] A,
+        const cython.floating[:,::1] B,
+        const int[::1] P_indptr,
+        const int[::1] P_indices,
+        const double[::1] P_data,
+):
+    """
+    Compute the inner product <A, P B P^T> for a sparse coupling P in CSR
+    format, without forming any dense intermediate matrix.
+
+    For each row i of P, the vector y = P[i,:] @ B is accumulated, and then
+    (P B P^T)[i,k] = P[k,:] . y is computed for k >= i only, as P B P^T is symmetric.
+    This takes O(nnz * m + n * nnz) time, where nnz is the number of nonzero entries
+    of P, and O(m) additional memory, compared to O(n^2 + n * m) memory for
+    the dense products.
+
+    :param A: A symmetric matrix of shape (n,n), of dtype float64 or float32.
+    :param B: A symmetric matrix of shape (m,m) of the same dtype as A.
+    :param P_indptr: The `indptr` array of P as a scipy.sparse.csr_matrix, of length n+1.
+    :param P_indices: The `indices` array of P.
+    :param P_data: The `data` array of P.
+    :return: The inner product, accumulated in double precision.
+    """
+    cdef Py_ssize_t n = A.shape[0]
+    cdef Py_ssize_t m = B.shape[0]
+    cdef Py_ssize_t i, k, e, f, l
+    cdef int c_e
+    cdef double w_e, z_ik
+    cdef double total = 0.0
+    cdef double[::1] y = np.zeros(m, dtype=DTYPE)
+    with nogil:
+        for i in range(n):
+            if P_indptr[i] == P_indptr[i+1]:
+                continue
+            for l in range(m):
+                y[l] = 0.0
+            for e in range(P_indptr[i], P_indptr[i+1]):
+                c_e = P_indices[e]
+                w_e = P_data[e]
+                for l in range(m):
+                    y[l] += w_e * B[c_e, l]
+            for k in range(i, n):
+                z_ik = 0.0
+                for f in range(P_indptr[k], P_indptr[k+1]):
+                    z_ik += P_data[f] * y[P_indices[f]]
+                if k == i:
+                    total += A[i, k] * z_ik
+                else:
+                    total += 2.0 * A[i, k] * z_ik
+    return total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cluster_medoids(
+        const cython.floating[:,::1] A,
+        const Py_ssize_t[::1] order,
+        const Py_ssize_t[::1] starts,
+):
+    """
+    Compute the medoid of each cluster of a metric space, the point which minimizes
+    the sum of the distances to all other points in the same cluster.
+
+    The points of cluster c are order[starts[c]:starts[c+1]]. The distances are
+    read from A in place, so this takes O(sum_c |c|^2) time and O(max_c |c|)
+    additional memory.
+
+    :param A: A squareform distance matrix, of dtype float64 or float32.
+    :param order: A permutation of the points of A which lists the points of
+        each cluster contiguously.
+    :param starts: An increasing array of length (number of clusters + 1),
+        with starts[0] == 0 and starts[-1] == A.shape[0].
+    :return: An array of indices into A, the medoid of each cluster.
+    """
+    cdef Py_ssize_t k = starts.shape[0]-1
+    cdef Py_ssize_t c, i, j, best
+    cdef double best_sum
+    cdef np.ndarray[Py_ssize_t,ndim=1,mode="c"] medoids = np.zeros((k,),dtype=np.intp)
+    cdef Py_ssize_t[::1] medoids_view = medoids
+    cdef double[::1] row_sums = np.zeros((A.shape[0],),dtype=DTYPE)
+    with nogil:
+        for c in range(k):
+            for i in range(starts[c], starts[c+1]):
+                row_sums[i] = 0.0
+            # A is symmetric, so only the upper triangle of each block is read.
+            for i in range(starts[c], starts[c+1]):
+                for j in range(i+1, starts[c+1]):
+                    row_sums[i] += A[order[i], order[j]]
+                    row_sums[j] += A[order[i], order[j]]
+            best = starts[c]
+            best_sum = row_sums[best]
+            for i in range(starts[c]+1, starts[c+1]):
+                if row_sums[i] < best_sum:
+                    best = i
+                    best_sum = row_sums[i]
+            medoids_view[c] = order[best]
+    return medoids
+
+
 # Turning off bounds checking doesn't improve performance on my end.
 def quantized_gw_cython(
         # a is the probability distribution on points of A
@@ -1088,6 +1088,11 @@ namespace lemon_omp {
 			}
 			/*if (!((_stype == GEQ && _sum_supply <= 0) ||
 				(_stype == LEQ && _sum_supply >= 0))) return false;*/
+			// As in the serial solver, treat supplies whose sums agree up to rounding
+			// as balanced, rather than routing the difference through the
+			// artificial root and reporting the problem as infeasible.
+			if ( fabs(_sum_supply) > 1e-8 ) return false;
+			_sum_supply = 0;
 
 
 			// Initialize artifical cost
@@ -0,0 +1,421 @@
+"""
+A common interface for running a function over many inputs in parallel.
+
+All of the functions in CAJAL which process many cells, or many pairs of cells,
+accept an optional :class:`cajal.parallel.Executor` which decides where the work
+runs (in the current process, in a pool of threads, or in a pool of processes),
+how many BLAS threads each worker may use, how many inputs are sent to a worker
+at a time, and what happens when the computation fails on one input.
+"""
+from __future__ import annotations
+
+import functools
+import itertools as it
+import os
+import threading
+import traceback
+import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from math import ceil
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from typing import Any, Callable, Iterable, Iterator, Literal, Optional, TypeVar, Union
+
+import numpy as np
+from threadpoolctl import ThreadpoolController
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+Backend = Literal["serial", "threads", "processes", "dill", "cluster"]
+OnError = Literal["raise", "return"]
+
+_controller = ThreadpoolController()
+
+# Upper bound on the automatically chosen chunksize, so that long computations
+# still report progress and balance the load at the end.
+_MAX_CHUNKSIZE = 100
+
+
+@dataclass
+class TaskFailure:
+    """
+    The result of a task which raised an exception, when the executor was
+    created with `on_error="return"`.
+
+    :param item: The input on which the task failed.
+    :param exception: The exception raised.
+    :param traceback: The formatted traceback of the exception.
+    """
+
+    item: Any
+    exception: Exception
+    traceback: str
+
+
+def _apply(fn: Callable[[T], R], on_error: OnError, item: T) -> Union[R, TaskFailure]:
+    if on_error == "raise":
+        return fn(item)
+    try:
+        return fn(item)
+    except Exception as e:
+        return TaskFailure(item, e, traceback.format_exc())
+
+
+def _apply_chunk(
+    fn: Callable[[T], R], on_error: OnError, chunk: list[T]
+) -> list[Union[R, TaskFailure]]:
+    return [_apply(fn, on_error, item) for item in chunk]
+
+
+def _init_worker(
+    blas_threads: Optional[int], initializer: Optional[Callable], initargs: tuple
+):
+    """
+    Limit the BLAS threads of a worker process and run the user's initializer.
+    """
+    global _BLAS_LIMITS
+    if blas_threads is not None:
+        # The limit stays in effect as long as this object is alive.
+        _BLAS_LIMITS = _controller.limit(limits=blas_threads, user_api="blas")
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def adaptive_chunksize(num_items: Optional[int], num_workers: int) -> int:
+    """
+    Choose how many inputs to send to a worker at a time: about four chunks per
+    worker, as :meth:`multiprocessing.pool.Pool.map` does, but at most 100.
+
+    :param num_items: The number of inputs, or None if unknown, in which case
+        the inputs are sent one at a time.
+    :param num_workers: The number of workers.
+    """
+    if num_items is None:
+        return 1
+    return max(1, min(_MAX_CHUNKSIZE, ceil(num_items / (4 * max(num_workers, 1)))))
+
+
+class Executor:
+    """
+    Where and how to run a function over many inputs.
+
+    :param backend: One of
+
+        - "serial": run in the current process. Useful for debugging, and for
+          small inputs where starting processes costs more than it saves.
+        - "threads": a pool of threads in the current process. Appropriate only when
+          the work releases the GIL, as the GW solvers in
+          :mod:`cajal.gw_cython` do.
+        - "processes": a :class:`multiprocessing.pool.Pool`. The function and its
+          inputs must be picklable; this is the default for the functions in CAJAL.
+        - "dill": a pool of processes from the `multiprocess` package, which
+          serializes with `dill` and so also accepts lambdas and closures.
+        - "cluster": a :class:`concurrent.futures.ProcessPoolExecutor`, to which
+          chunks of inputs are submitted as futures, with a bounded number in flight.
+          This is a local stand-in for a distributed cluster with the
+          same interface.
+
+    :param num_workers: How many threads or processes to run. If None, one
+        for each core.
+    :param blas_threads: How many threads the BLAS library may use in each worker
+        (in the current process, for the "serial" and "threads" backends).
+        The default of 1 avoids oversubscribing the cores when every worker calls BLAS.
+        None leaves the limit unchanged.
+    :param chunksize: How many inputs are sent to a worker at a time, for
+        functions which do not specify it themselves. If None, it is chosen by
+        :func:`cajal.parallel.adaptive_chunksize`.
+    :param on_error: If "raise", an exception raised on any input is raised again in
+        the calling process, ending the computation. If "return", the result for that
+        input is a :class:`cajal.parallel.TaskFailure` and the computation continues;
+        the functions in CAJAL then report the failed inputs, and record NaN for
+        failed distances.
+    """
+
+    def __init__(
+        self,
+        backend: Backend = "processes",
+        num_workers: Optional[int] = None,
+        blas_threads: Optional[int] = 1,
+        chunksize: Optional[int] = None,
+        on_error: OnError = "raise",
+    ):
+        if backend not in ("serial", "threads", "processes", "dill", "cluster"):
+            raise ValueError("Unknown backend " + repr(backend))
+        if on_error not in ("raise", "return"):
+            raise ValueError("on_error must be 'raise' or 'return'")
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.backend = backend
+        self.num_workers = 1 if backend == "serial" else num_workers
+        self.blas_threads = blas_threads
+        self.chunksize = chunksize
+        self.on_error = on_error
+
+    def __repr__(self):
+        return (
+            "Executor(backend=%r, num_workers=%r, blas_threads=%r, chunksize=%r, on_error=%r)"
+            % (
+                self.backend,
+                self.num_workers,
+                self.blas_threads,
+                self.chunksize,
+                self.on_error,
+            )
+        )
+
+    def _chunksize(self, chunksize: Optional[int], num_items: Optional[int]) -> int:
+        if chunksize is not None:
+            return chunksize
+        if self.chunksize is not None:
+            return self.chunksize
+        return adaptive_chunksize(num_items, self.num_workers)
+
+    @contextmanager
+    def session(
+        self, initializer: Optional[Callable] = None, initargs: tuple = ()
+    ) -> Iterator["Session"]:
+        """
+        Start the workers, to be used for one or more calls to
+        :meth:`cajal.parallel.Session.imap`, and stop them on exit.
+
+        :param initializer: If not None, each worker calls `initializer(*initargs)`
+            when it starts (for the "serial" backend, it is called once in the current
+            process). The usual use is to declare global variables holding data
+            shared by all tasks, so that it is sent to each worker only once.
+        """
+        if self.backend in ("serial", "threads"):
+            blas = (
+                _controller.limit(limits=self.blas_threads, user_api="blas")
+                if self.blas_threads is not None
+                else None
+            )
+            try:
+                if self.backend == "serial":
+                    if initializer is not None:
+                        initializer(*initargs)
+                    yield Session(self, None)
+                else:
+                    with ThreadPool(
+                        processes=self.num_workers,
+                        initializer=initializer,
+                        initargs=initargs,
+                    ) as pool:
+                        yield Session(self, pool)
+            finally:
+                if blas is not None:
+                    blas.restore_original_limits()
+            return
+        worker_initargs = (self.blas_threads, initializer, initargs)
+        if self.backend == "processes":
+            with Pool(
+                processes=self.num_workers,
+                initializer=_init_worker,
+                initargs=worker_initargs,
+            ) as pool:
+                yield Session(self, pool)
+        elif self.backend == "dill":
+            import multiprocess
+
+            with multiprocess.Pool(
+                processes=self.num_workers,
+                initializer=_init_worker,
+                initargs=worker_initargs,
+            ) as pool:
+                yield Session(self, pool)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                initializer=_init_worker,
+                initargs=worker_initargs,
+            ) as pool:
+                yield Session(self, pool)
+
+    def imap(
+        self,
+        fn: Callable[[T], R],
+        iterable: Iterable[T],
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+        ordered: bool = True,
+        chunksize: Optional[int] = None,
+        num_items: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+    ) -> Iterator[Union[R, TaskFailure]]:
+        """
+        Apply `fn` to each element of `iterable` in a new session. The workers are
+        stopped when the returned iterator is exhausted or closed.
+
+        For the parameters see :meth:`cajal.parallel.Executor.session` and
+        :meth:`cajal.parallel.Session.imap`.
+        """
+        with self.session(initializer, initargs) as session:
+            yield from session.imap(
+                fn, iterable, ordered, chunksize, num_items, max_in_flight
+            )
+
+
+class Session:
+    """A running set of workers, created by :meth:`cajal.parallel.Executor.session`."""
+
+    def __init__(self, executor: Executor, pool):
+        self.executor = executor
+        self._pool = pool
+
+    def imap(
+        self,
+        fn: Callable[[T], R],
+        iterable: Iterable[T],
+        ordered: bool = True,
+        chunksize: Optional[int] = None,
+        num_items: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+    ) -> Iterator[Union[R, TaskFailure]]:
+        """
+        Apply `fn` to each element of `iterable`, lazily.
+
+        :param fn: The function to apply. Unless the backend is "serial", "threads"
+            or "dill", it must be picklable, i.e. defined at the top level of a module.
+        :param ordered: If True the results are returned in the order of the inputs,
+            otherwise in the order in which they are completed.
+        :param chunksize: How many inputs to send to a worker at a time. If None,
+            the executor's `chunksize` is used, or else one is chosen from
+            `num_items`, see :func:`cajal.parallel.adaptive_chunksize`.
+        :param num_items: The number of inputs, if `iterable` does not have a length.
+        :param max_in_flight: If not None, at most this many inputs (but at least one
+            chunk) are read from `iterable` whose results have not yet been consumed.
+            This bounds the memory used when the results are large, or are
+            consumed more slowly than they are computed.
+        :return: An iterator over the results, where an input on which `fn` raised an
+            exception gives a :class:`cajal.parallel.TaskFailure` if the
+            executor's `on_error` is "return".
+        """
+        executor = self.executor
+        if num_items is None and hasattr(iterable, "__len__"):
+            num_items = len(iterable)  # type: ignore[arg-type]
+        chunksize = executor._chunksize(chunksize, num_items)
+        task = functools.partial(_apply, fn, executor.on_error)
+        if executor.backend == "serial":
+            return map(task, iterable)
+        if executor.backend == "cluster":
+            return self._submit(fn, iterable, ordered, chunksize, max_in_flight)
+        imap = self._pool.imap if ordered else self._pool.imap_unordered
+        if max_in_flight is None:
+            return imap(task, iterable, chunksize=chunksize)
+        return self._bounded(
+            imap, task, iterable, chunksize, max(max_in_flight, chunksize)
+        )
+
+    @staticmethod
+    def _bounded(
+        imap: Callable, task: Callable, iterable: Iterable, chunksize: int, bound: int
+    ) -> Iterator:
+        # The pool reads the inputs in a separate thread, which blocks here
+        # until enough results have been consumed.
+        slots = threading.Semaphore(bound)
+        stopped = threading.Event()
+
+        def inputs():
+            for item in iterable:
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                yield item
+
+        try:
+            for result in imap(task, inputs(), chunksize=chunksize):
+                slots.release()
+                yield result
+        finally:
+            stopped.set()
+
+    def _submit(
+        self,
+        fn: Callable[[T], R],
+        iterable: Iterable[T],
+        ordered: bool,
+        chunksize: int,
+        max_items: Optional[int],
+    ) -> Iterator[Union[R, TaskFailure]]:
+        # At most this many chunks are queued at once, so that the inputs are
+        # consumed lazily.
+        if max_items is None:
+            max_in_flight = 2 * self.executor.num_workers
+        else:
+            max_in_flight = max(1, max_items // chunksize)
+        iterator = iter(iterable)
+        chunks = iter(lambda: list(it.islice(iterator, chunksize)), [])
+        task = functools.partial(_apply_chunk, fn, self.executor.on_error)
+        if ordered:
+            queue: deque = deque()
+            for chunk in chunks:
+                queue.append(self._pool.submit(task, chunk))
+                if len(queue) >= max_in_flight:
+                    yield from queue.popleft().result()
+            while queue:
+                yield from queue.popleft().result()
+            return
+        pending: set = set()
+        for chunk in chunks:
+            pending.add(self._pool.submit(task, chunk))
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def default_executor(
+    executor: Optional[Executor], num_processes: int, backend: Backend = "processes"
+) -> Executor:
+    """
+    Return `executor`, or if it is None, the executor used by CAJAL functions
+    called with `num_processes` and no executor.
+    """
+    if executor is not None:
+        return executor
+    return Executor(backend, num_workers=num_processes)
+
+
+def warn_failures(failures: list[TaskFailure]) -> None:
+    """Warn that the tasks in `failures` raised exceptions, with the first traceback."""
+    if failures:
+        warnings.warn(
+            "%d task(s) failed; the first, on input %r, raised:\n%s"
+            % (len(failures), failures[0].item, failures[0].traceback)
+        )
+
+
+def pairwise_results(
+    results: Iterable[Union[tuple[int, int, float], TaskFailure]],
+    num_cells: int,
+    dmat: Optional[Any] = None,
+):
+    """
+    Collect triples (i, j, d) into a symmetric distance matrix. Pairs whose
+    task failed are set to NaN, with a warning.
+
+    :param dmat: If given, a matrix to write into; otherwise a new matrix of
+        zeros of side length `num_cells` is created.
+    :return: The distance matrix.
+    """
+    if dmat is None:
+        dmat = np.zeros((num_cells, num_cells))
+    failures: list[TaskFailure] = []
+    for result in results:
+        if isinstance(result, TaskFailure):
+            failures.append(result)
+            i, j = result.item
+            x = np.nan
+        else:
+            i, j, x = result
+        dmat[i, j] = x
+        dmat[j, i] = x
+    warn_failures(failures)
+    return dmat
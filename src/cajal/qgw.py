@@ -1,12 +1,12 @@
 """
-Functions for computing the quantized Gromov-Wasserstein distance and the SLB between
-metric measure spaces, and related utilities for file IO and parallel computation.
+Functions for computing the quantized Gromov-Wasserstein distance and the SLB and TLB
+between metric measure spaces, and related utilities for file IO and parallel computation.
 """
 # std lib dependencies
 import sys
 import itertools as it
 import csv
-from typing import Iterable, Iterator, Collection, Optional, Literal
+from typing import Iterable, Iterator, Collection, Optional, Literal, Union
 from math import sqrt
 
 if "ipykernel" in sys.modules:
@@ -21,16 +21,38 @@ from scipy.spatial.distance import squareform, pdist
 from scipy import sparse
 from scipy import cluster
 
-from multiprocessing import Pool
 
-from .slb import l2
-from .gw_cython import quantized_gw_cython, qgw_init_cost
-
-from .run_gw import (_batched, cell_iterator_csv,
-                     Distribution, DistanceMatrix,
-                     Matrix, uniform, Array,
-                     MetricMeasureSpace
-                     )
+from .parallel import (
+    Executor,
+    TaskFailure,
+    default_executor,
+    pairwise_results,
+    warn_failures,
+)
+from .slb import l2, tlb_cost_matrix
+from .gw_cython import (
+    emd_cost,
+    gw_cython_core,
+    gw_cython_init_cost,
+    fused_gw_cython_core,
+    partial_gw_cython_core,
+    qgw_expand_coupling,
+    sparse_coupling_inner_product,
+    cluster_medoids,
+)
+
+from .run_gw import (
+    _batched,
+    cell_iterator_csv,
+    Distribution,
+    DistanceMatrix,
+    Matrix,
+    uniform,
+    Array,
+    MetricMeasureSpace,
+    feature_cost_matrix,
+    _feature_cost,
+)
 
 
 def distance_inverse_cdf(
@@ -107,7 +129,8 @@ def slb_parallel_memory(
     cell_dms: list[DistanceMatrix],
     cell_distributions : Optional[Iterable[Distribution]],
     num_processes: int,
-    chunksize: int = 20,
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
 ) -> DistanceMatrix:
     """
     Compute the SLB distance in parallel between all cells in `cell_dms`.
@@ -115,7 +138,11 @@ def slb_parallel_memory(
     :param cell_dms: A collection of distance matrices. Probability distributions
         other than uniform are currently unsupported.
     :param num_processes: How many Python processes to run in parallel
-    :param chunksize: How many SLB distances each Python process computes at a time
+    :param chunksize: How many SLB distances each Python process computes at a time.
+        If None, this is chosen by the executor.
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored. Distances whose computation failed
+        are NaN.
 
     :return: a square matrix giving pairwise SLB distances between points.
     """
@@ -124,27 +151,25 @@ def slb_parallel_memory(
     cell_dms_sorted = [np.sort(squareform(cell, force="tovector")) for cell in cell_dms]
     N = len(cell_dms_sorted)
 
-    with Pool(
-        initializer=_init_slb_pool,
-        initargs=(cell_dms_sorted, cell_distributions),
-        processes=num_processes,
-    ) as pool:
-        slb_dists = pool.imap_unordered(
-            _global_slb_pool, it.combinations(iter(range(N)), 2), chunksize=chunksize
-        )
-        arr = np.zeros((N, N))
-        for i, j, x in slb_dists:
-            arr[i, j] = x
-            arr[j, i] = x
-
-    return arr
+    executor = default_executor(executor, num_processes)
+    slb_dists = executor.imap(
+        _global_slb_pool,
+        it.combinations(iter(range(N)), 2),
+        _init_slb_pool,
+        (cell_dms_sorted, cell_distributions),
+        ordered=False,
+        chunksize=chunksize,
+        num_items=N * (N - 1) // 2,
+    )
+    return pairwise_results(slb_dists, N)
 
 
 def slb_parallel(
     intracell_csv_loc: str,
     num_processes: int,
     out_csv: str,
-    chunksize: int = 20,
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
 ) -> None:
     """
     Compute the SLB distance in parallel between all cells in the csv file `intracell_csv_loc`.
@@ -156,9 +181,11 @@ def slb_parallel(
     :param cell_dms: A collection of distance matrices
     :param num_processes: How many Python processes to run in parallel
     :param chunksize: How many SLB distances each Python process computes at a time
+    :param executor: Where to run the computation, see
+        :func:`cajal.qgw.slb_parallel_memory`.
     """
     names, cell_dms = zip(*cell_iterator_csv(intracell_csv_loc))
-    slb_dmat = slb_parallel_memory(cell_dms, None, num_processes, chunksize)
+    slb_dmat = slb_parallel_memory(cell_dms, None, num_processes, chunksize, executor)
     NN = len(names)
     total_num_pairs = int((NN * (NN - 1)) / 2)
     ij = tqdm(it.combinations(range(NN), 2), total=total_num_pairs)
@@ -172,6 +199,289 @@ def slb_parallel(
             csv_writer.writerows(batch)
 
 
+def tlb_signature(
+    dist_mat: DistanceMatrix, measure: Distribution
+) -> tuple[Matrix, Matrix]:
+    """
+    Precompute the data about a cell needed to compute its TLB distance to other cells.
+
+    For each point x of the cell, the local distribution of distances from x
+    to the other points is represented by its inverse cumulative distribution
+    function. This is computed for all points at once by sorting each row of
+    the distance matrix.
+
+    :param dist_mat: A squareform distance matrix of side length N.
+    :param measure: Probability distribution on points of the cell.
+
+    :return: A pair (f, cum_u) of arrays of shape (N,N). Row i of `f` is
+        row i of `dist_mat` in ascending order, and row i of `cum_u` is
+        the cumulative sum of `measure` permuted in the same way, so that f[i,k]
+        is the value of the inverse cumulative distribution function of the distances
+        from point i on the interval [cum_u[i,k-1], cum_u[i,k]].
+    """
+    order = np.argsort(dist_mat, axis=1)
+    f = np.take_along_axis(dist_mat, order, axis=1)
+    cum_u = np.cumsum(measure[order], axis=1)
+    return (np.ascontiguousarray(f, dtype=np.float64), np.ascontiguousarray(cum_u))
+
+
+def tlb_distribution(
+    sig_X: tuple[Matrix, Matrix],
+    mX: Distribution,
+    sig_Y: tuple[Matrix, Matrix],
+    mY: Distribution,
+) -> float:
+    """
+    Compute the TLB distance between two cells equipped with a choice of distribution.
+
+    The third lower bound of Memoli compares the local distributions of
+    distances at each point of X against those at each point of Y, and then
+    solves an optimal transport problem between X and Y with these comparisons
+    as the cost matrix. It is a lower bound for the GW distance which is
+    usually much tighter than the SLB, at the cost of an (N x M)-sized
+    optimal transport problem.
+
+    :param sig_X: The signature of X, as computed by :func:`cajal.qgw.tlb_signature`.
+    :param mX: Probability distribution vector on X.
+    :param sig_Y: The signature of Y, as computed by :func:`cajal.qgw.tlb_signature`.
+    :param mY: Probability distribution vector on Y.
+    """
+    C = tlb_cost_matrix(sig_X[0], sig_X[1], sig_Y[0], sig_Y[1])
+    return 0.5 * sqrt(max(emd_cost(mX, mY, C), 0.0))
+
+
+# TLB
+def _init_tlb_pool(signatures, distributions):
+    """
+    Initialize the parallel TLB computation.
+
+    Declares a global variable accessible from all processes.
+    """
+    global _TLB_SIGNATURES
+    _TLB_SIGNATURES = list(zip(signatures, distributions))
+
+
+def _global_tlb_pool(p: tuple[int, int]):
+    """Compute the TLB distance between cells p[0] and p[1] in the global cell list."""
+    i, j = p
+    sig_X, mX = _TLB_SIGNATURES[i]
+    sig_Y, mY = _TLB_SIGNATURES[j]
+    return (i, j, tlb_distribution(sig_X, mX, sig_Y, mY))
+
+
+def tlb_parallel_memory(
+    cell_dms: list[DistanceMatrix],
+    cell_distributions: Optional[Iterable[Distribution]],
+    num_processes: int,
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> DistanceMatrix:
+    """
+    Compute the TLB distance in parallel between all cells in `cell_dms`.
+
+    :param cell_dms: A collection of distance matrices.
+    :param cell_distributions: Probability distributions on the points of each
+        cell. If None, the uniform distribution is used for every cell.
+    :param num_processes: How many Python processes to run in parallel
+    :param chunksize: How many TLB distances each Python process computes at a time.
+        If None, this is chosen by the executor.
+    :param executor: Where to run the computation, see
+        :func:`cajal.qgw.slb_parallel_memory`.
+
+    :return: a square matrix giving pairwise TLB distances between points.
+    """
+    if cell_distributions is None:
+        cell_distributions = [uniform(cell_dm.shape[0]) for cell_dm in cell_dms]
+    cell_distributions = [
+        np.ascontiguousarray(p, dtype=np.float64) for p in cell_distributions
+    ]
+    signatures = [
+        tlb_signature(cell_dm, p) for cell_dm, p in zip(cell_dms, cell_distributions)
+    ]
+    N = len(signatures)
+
+    executor = default_executor(executor, num_processes)
+    tlb_dists = executor.imap(
+        _global_tlb_pool,
+        it.combinations(iter(range(N)), 2),
+        _init_tlb_pool,
+        (signatures, cell_distributions),
+        ordered=False,
+        chunksize=chunksize,
+        num_items=N * (N - 1) // 2,
+    )
+    return pairwise_results(tlb_dists, N)
+
+
+def tlb_parallel(
+    intracell_csv_loc: str,
+    num_processes: int,
+    out_csv: str,
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> None:
+    """
+    Compute the TLB distance in parallel between all cells in the csv file `intracell_csv_loc`.
+
+    The files are expected to be formatted according to the format in
+    :func:`cajal.run_gw.icdm_csv_validate`. All cells are equipped with the
+    uniform distribution.
+
+    :param intracell_csv_loc: path to a CSV file containing the cells to process
+    :param num_processes: How many Python processes to run in parallel
+    :param out_csv: file path where the TLB distances will be written
+    :param chunksize: How many TLB distances each Python process computes at a time
+    :param executor: Where to run the computation, see
+        :func:`cajal.qgw.slb_parallel_memory`.
+    """
+    names, cell_dms = zip(*cell_iterator_csv(intracell_csv_loc))
+    tlb_dmat = tlb_parallel_memory(cell_dms, None, num_processes, chunksize, executor)
+    NN = len(names)
+    total_num_pairs = int((NN * (NN - 1)) / 2)
+    ij = tqdm(it.combinations(range(NN), 2), total=total_num_pairs)
+    with open(out_csv, "w", newline="") as outfile:
+        csv_writer = csv.writer(outfile)
+        csv_writer.writerow(["first_object", "second_object", "tlb_dist"])
+        batches = _batched(
+            ((names[i], names[j], str(tlb_dmat[i, j])) for i, j in ij), 2000
+        )
+        for batch in batches:
+            csv_writer.writerows(batch)
+
+
+def _farthest_point_centers(
+    cell_dm: DistanceMatrix, num_clusters: int, first: int = 0
+) -> npt.NDArray[np.intp]:
+    """
+    Choose `num_clusters` points by farthest point sampling, starting from `first`.
+    """
+    n = cell_dm.shape[0]
+    num_clusters = min(num_clusters, n)
+    centers = np.zeros((num_clusters,), dtype=np.intp)
+    centers[0] = first
+    min_dist = np.array(cell_dm[first], dtype=np.float64)
+    for c in range(1, num_clusters):
+        centers[c] = np.argmax(min_dist)
+        np.minimum(min_dist, cell_dm[centers[c]], out=min_dist)
+    return centers
+
+
+def voronoi_clusters(
+    cell_dm: DistanceMatrix, landmarks: npt.NDArray[np.int_]
+) -> npt.NDArray[np.int_]:
+    """
+    Assign each point of a metric space to its nearest landmark. This takes
+    O(n * len(landmarks)) time.
+
+    :param cell_dm: A squareform distance matrix.
+    :param landmarks: Indices of distinct points of `cell_dm`, for example as returned by
+        :func:`cajal.sample_swc.swc_landmarks`.
+    :return: A vector of cluster labels in range(len(landmarks)); each landmark
+        belongs to its own cluster.
+    """
+    landmarks = np.asarray(landmarks)
+    labels = np.argmin(cell_dm[:, landmarks], axis=1)
+    labels[landmarks] = np.arange(landmarks.shape[0])
+    # If two landmarks are at distance zero from each other, some labels are unused.
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def farthest_point_clusters(
+    cell_dm: DistanceMatrix, num_clusters: int, first: int = 0
+) -> npt.NDArray[np.int_]:
+    """
+    Cluster the points of a metric space by farthest point sampling.
+
+    Starting from the point `first`, points are chosen one at a time, each as far as
+    possible from all points chosen so far; then each point is assigned to the
+    nearest chosen point. This is the greedy 2-approximation to the k-center
+    problem, and takes O(n * num_clusters) time.
+
+    :param cell_dm: A squareform distance matrix.
+    :param num_clusters: The number of clusters.
+    :param first: The index of the first center.
+    :return: A vector of cluster labels in range(num_clusters).
+    """
+    return voronoi_clusters(
+        cell_dm, _farthest_point_centers(cell_dm, num_clusters, first)
+    )
+
+
+def kmedoids_clusters(
+    cell_dm: DistanceMatrix, num_clusters: int, max_iter: int = 20
+) -> npt.NDArray[np.int_]:
+    """
+    Cluster the points of a metric space by k-medoids.
+
+    The medoids are initialized by :func:`cajal.qgw.farthest_point_clusters`, and
+    improved by alternately assigning each point to its nearest medoid and
+    replacing each medoid by the medoid of its cluster, until the
+    medoids do not change. Each iteration takes O(n * num_clusters + sum_c |c|^2) time.
+
+    :param cell_dm: A squareform distance matrix.
+    :param num_clusters: The number of clusters.
+    :param max_iter: The maximum number of iterations.
+    :return: A vector of cluster labels in range(num_clusters).
+    """
+    labels = farthest_point_clusters(cell_dm, num_clusters)
+    medoids = None
+    for _ in range(max_iter):
+        order = np.argsort(labels, kind="stable")
+        starts = np.searchsorted(labels[order], np.arange(labels.max() + 2))
+        new_medoids = cluster_medoids(cell_dm, order, starts)
+        if medoids is not None and np.array_equal(medoids, new_medoids):
+            break
+        medoids = new_medoids
+        labels = voronoi_clusters(cell_dm, medoids)
+    return labels
+
+
+def minibatch_kmedoids_clusters(
+    cell_dm: DistanceMatrix,
+    num_clusters: int,
+    batch_size: Optional[int] = None,
+    num_batches: int = 10,
+    seed: Optional[int] = None,
+) -> npt.NDArray[np.int_]:
+    """
+    Cluster the points of a metric space by mini-batch k-medoids.
+
+    The medoids are initialized by farthest point sampling. For each batch,
+    a random sample of the points is assigned to the nearest medoids, and each medoid
+    is replaced by the medoid of its cluster within the sample (together with
+    the current medoid). Finally each point is assigned to the nearest medoid.
+    The total time is O(n * num_clusters + num_batches * batch_size^2 / num_clusters),
+    compared to O(n^2) per iteration for :func:`cajal.qgw.kmedoids_clusters`.
+
+    :param cell_dm: A squareform distance matrix.
+    :param num_clusters: The number of clusters.
+    :param batch_size: The number of points in each batch; by default
+        10 * num_clusters, or n if that is smaller.
+    :param num_batches: The number of batches.
+    :param seed: Seed for the random number generator.
+    :return: A vector of cluster labels in range(num_clusters).
+    """
+    n = cell_dm.shape[0]
+    rng = np.random.default_rng(seed)
+    medoids = _farthest_point_centers(cell_dm, num_clusters)
+    if batch_size is None:
+        batch_size = 10 * medoids.shape[0]
+    batch_size = min(batch_size, n)
+    for _ in range(num_batches):
+        batch = np.union1d(rng.choice(n, batch_size, replace=False), medoids)
+        batch_labels = np.argmin(cell_dm[np.ix_(batch, medoids)], axis=1)
+        batch_labels[np.searchsorted(batch, medoids)] = np.arange(medoids.shape[0])
+        order = batch[np.argsort(batch_labels, kind="stable")]
+        starts = np.searchsorted(np.sort(batch_labels), np.arange(medoids.shape[0] + 1))
+        medoids = cluster_medoids(cell_dm, order, starts)
+    return voronoi_clusters(cell_dm, medoids)
+
+
+ClusterMethod = Literal[
+    "hierarchical", "kmedoids", "minibatch_kmedoids", "farthest_point"
+]
+
+
 class quantized_icdm:
     """
     A "quantized" intracell distance matrix.
@@ -182,14 +492,41 @@ class quantized_icdm:
     use the constructor. Usage of this class will result in high memory usage if
     the number of cells to be constructed is large.
 
+    The points of the cell are reordered so that the points of each cluster are
+    contiguous, beginning with the medoid of the cluster and
+    sorted by their distance to the medoid. Couplings returned by
+    :func:`cajal.qgw.quantized_gw` are indexed in this order; the attribute
+    `permutation` relates it to the original order.
+
     :param cell_dm: An intracell distance matrix in squareform.
     :param p: A probability distribution on the points of the metric space
     :param num_clusters: How many clusters to subdivide the cell into; the more
         clusters, the more accuracy, but the longer the computation.
     :param clusters: Labels for a clustering of the points in the cell. If no clustering
-        is supplied, one will be derived by hierarchical clustering until
-        `num_clusters` clusters are formed. If a clustering is supplied, then
+        is supplied, one will be computed by `method` with
+        `num_clusters` clusters. If a clustering is supplied, then
         `num_clusters` is ignored.
+    :param features: Optional array of shape (n,k) of features of the points
+        of the cell, for computing the quantized fused GW distance with
+        :func:`cajal.qgw.quantized_fused_gw`.
+    :param dtype: The dtype in which the full distance matrix `icdm` is stored,
+        np.float64 or np.float32. Single precision halves the memory used by
+        each quantized cell and the time spent evaluating the GW cost of the
+        reconstructed coupling; see :func:`cajal.qgw.quantized_gw` for the effect
+        on accuracy. The constants `c_A`, `c_As` and the matrix `sub_icdm` are
+        always computed and stored in double precision.
+    :param method: How to cluster the cell if `clusters` is None.
+        "hierarchical" uses centroid linkage, which takes O(n^2) memory and
+        O(n^2 log n) time.
+        "kmedoids" uses :func:`cajal.qgw.kmedoids_clusters`,
+        "minibatch_kmedoids" uses :func:`cajal.qgw.minibatch_kmedoids_clusters`,
+        and "farthest_point" uses :func:`cajal.qgw.farthest_point_clusters`;
+        the last two take O(n * num_clusters) time. To cluster a neuron by the
+        Voronoi cells of its branch points, pass
+        `clusters=voronoi_clusters(cell_dm, swc_landmarks(forest, sample_pts))`, see
+        :func:`cajal.qgw.voronoi_clusters` and :func:`cajal.sample_swc.swc_landmarks`.
+        For measurements of the speed and accuracy of each method see
+        :doc:`computing-gw-distances`.
     """
 
     n: int
@@ -198,6 +535,9 @@ class quantized_icdm:
     # "distribution" is a dimensional vector of length n,
     # a probability distribution on points of the space
     distribution: npt.NDArray[np.float64]
+    # The original index of each point; icdm == cell_dm[permutation][:, permutation],
+    # where cell_dm is the matrix given to the constructor.
+    permutation: npt.NDArray[np.int_]
     # The number of clusters in the quantized cell, which is *NOT* guaranteed
     # to be equal to the value of "clusters" specified in the constructor. Check this
     # field when iterating over clusters rather than assuming it has the number of clusters
@@ -215,46 +555,40 @@ class quantized_icdm:
     c_As: float
     A_s_a_s: npt.NDArray[np.float64]
     # This field is equal to np.dot(np.dot(np.multiply(icdm,icdm),distribution),distribution)
+    # Features of the points, listed in the same order as the rows of icdm, or None.
+    features: Optional[npt.NDArray[np.float64]]
+    # Features of the sampled points, of shape (ns, k), or None.
+    sub_features: Optional[npt.NDArray[np.float64]]
 
-    def _sort_icdm_and_distribution(
+    @staticmethod
+    def _cluster_permutation(
         cell_dm: DistanceMatrix,
-        p: Distribution,
         clusters: npt.NDArray[np.int_],
-    ) -> tuple[DistanceMatrix, Distribution, npt.NDArray[np.int_]]:
+    ) -> tuple[npt.NDArray[np.int_], npt.NDArray[np.int_]]:
         """
-        Sort the cell distance matrix so that points in the same cluster are grouped
-        together and the points of each cell are in descending order.
-
-        :param clusters: A vector of integer cluster labels telling which
-            cluster each point belongs to, cluster labels are assumed to be contiguous and
-            start at 1.
-
-        :return: A sorted cell distance matrix, distribution, and a vector of
-            integers marking the initial starting points of each cluster. (This
-            has one more element than the number of distinct clusters, the last
-            element is the length of the cell.)
+        Compute the permutation of the points of the cell which groups the points
+        of each cluster together, with the medoid of each cluster first and the
+        remaining points in ascending order of their distance to the medoid.
+
+        :param clusters: A vector of cluster labels, one for each point.
+            The labels can be arbitrary integers.
+        :return: The permutation, and a vector of
+            integers marking the initial starting points of each cluster in the
+            permuted order. (This has one more element than the number of
+            distinct clusters, the last element is the length of the cell.)
         """
-
-        indices: npt.NDArray[np.int_] = np.argsort(clusters)
-        cell_dm = cell_dm[indices, :][:, indices]
-        p = p[indices]
-
-        for i in range(1, len(set(clusters)) + 1):
-            permutation = np.nonzero(clusters == i)[0]
-            this_cluster = cell_dm[permutation, :][:, permutation]
-            medoid = np.argmin(sum(this_cluster))
-            new_local_indices = np.argsort(this_cluster[medoid])
-            cell_dm[permutation, :] = cell_dm[permutation[new_local_indices], :]
-            cell_dm[:, permutation] = cell_dm[:, permutation[new_local_indices]]
-            indices[permutation] = indices[permutation[new_local_indices]]
-            p[permutation] = p[permutation[new_local_indices]]
-            # q.append(np.sum(p[permutation]))
-
-        q_indices = np.asarray(
-            np.nonzero(np.r_[1, np.diff(np.sort(clusters)), 1])[0], order="C"
-        )
-
-        return (np.asarray(cell_dm, order="C"), p, q_indices)
+        _, labels = np.unique(clusters, return_inverse=True)
+        order = np.argsort(labels, kind="stable")
+        q_indices = np.searchsorted(labels[order], np.arange(labels.max() + 2))
+        medoids = cluster_medoids(cell_dm, order, q_indices)
+        n = cell_dm.shape[0]
+        own_medoid = medoids[labels]
+        dist_to_medoid = cell_dm[np.arange(n), own_medoid]
+        not_medoid = own_medoid != np.arange(n)
+        # Sort by label, then by distance to the medoid, breaking ties so
+        # that the medoid comes first.
+        permutation = np.lexsort((not_medoid, dist_to_medoid, labels))
+        return permutation, q_indices
 
     def __init__(
         self,
@@ -262,52 +596,63 @@ class quantized_icdm:
         p: Distribution,
         num_clusters: Optional[int],
         clusters: Optional[npt.NDArray[np.int_]] = None,
+        features: Optional[Matrix] = None,
+        dtype: npt.DTypeLike = np.float64,
+        method: ClusterMethod = "hierarchical",
     ):
         # Validate the data.
         assert len(cell_dm.shape) == 2
 
         self.n = cell_dm.shape[0]
+        cell_dm = np.ascontiguousarray(cell_dm)
 
         if clusters is None:
-            # Cluster the data and set icdm, distribution, and ns.
-            Z = cluster.hierarchy.linkage(squareform(cell_dm), method="centroid")
-            clusters = cluster.hierarchy.fcluster(
-                Z, num_clusters, criterion="maxclust", depth=0
-            )
-
-        icdm, distribution, q_indices = quantized_icdm._sort_icdm_and_distribution(
-            cell_dm, p, clusters
+            if method == "kmedoids":
+                clusters = kmedoids_clusters(cell_dm, num_clusters)
+            elif method == "minibatch_kmedoids":
+                clusters = minibatch_kmedoids_clusters(cell_dm, num_clusters)
+            elif method == "farthest_point":
+                clusters = farthest_point_clusters(cell_dm, num_clusters)
+            else:
+                Z = cluster.hierarchy.linkage(squareform(cell_dm), method="centroid")
+                clusters = cluster.hierarchy.fcluster(
+                    Z, num_clusters, criterion="maxclust", depth=0
+                )
+
+        permutation, q_indices = quantized_icdm._cluster_permutation(
+            cell_dm, np.asarray(clusters)
         )
-
-        self.icdm = icdm
-        self.distribution = distribution
-        self.ns = len(set(clusters))
+        self.permutation = permutation
         self.q_indices = q_indices
-
-        clusters_sort = np.sort(clusters)
-        self.icdm = np.asarray(cell_dm, order="C")
-        self.distribution = p
+        self.ns = q_indices.shape[0] - 1
+        icdm = cell_dm[np.ix_(permutation, permutation)]
+        distribution = np.asarray(p, dtype=np.float64)[permutation]
+        self.distribution = distribution
 
         # Compute the quantized distribution.
-        q = []
-        for i in range(self.ns):
-            q.append(np.sum(distribution[q_indices[i] : q_indices[i + 1]]))
-        q_arr = np.array(q, dtype=np.float64, order="C")
+        q_arr = np.add.reduceat(distribution, q_indices[:-1])
         self.q_distribution = q_arr
         assert abs(np.sum(q_arr) - 1.0) < 1e-7
-        medoids = np.nonzero(np.r_[1, np.diff(clusters_sort)])[0]
+        # The medoid of each cluster is its first point.
+        medoids = q_indices[:-1]
 
-        A_s = cell_dm[medoids, :][:, medoids]
-        # assert np.all(np.equal(original_cell_dm[:, indices][indices, :], cell_dm))
-        self.sub_icdm = np.asarray(A_s, order="C")
-        self.c_A = np.dot(np.dot(np.multiply(cell_dm, cell_dm), p), p)
+        A_s = np.ascontiguousarray(icdm[np.ix_(medoids, medoids)], dtype=np.float64)
+        self.sub_icdm = A_s
+        self.c_A = np.dot(np.dot(np.multiply(icdm, icdm), distribution), distribution)
         self.c_As = np.dot(np.multiply(A_s, A_s), q_arr) @ q_arr
         self.A_s_a_s = np.dot(A_s, q_arr)
+        self.icdm = np.asarray(icdm, dtype=dtype, order="C")
+        if features is None:
+            self.features = None
+            self.sub_features = None
+        else:
+            self.features = np.asarray(features, dtype=np.float64)[permutation]
+            self.sub_features = self.features[medoids]
 
     @staticmethod
     def of_tuple(p):
-        cell_dm, p, num_clusters, clusters=p
-        return quantized_icdm(cell_dm,p, num_clusters,clusters)
+        cell_dm, p, num_clusters, clusters, *rest = p
+        return quantized_icdm(cell_dm, p, num_clusters, clusters, *rest)
 
     def of_ptcloud(
         X: Matrix,
@@ -328,10 +673,129 @@ class quantized_icdm:
         return quantized_icdm(dmat, distribution, None, clusters)
 
 
+def quantize_cells_parallel(
+    cells: Collection[MetricMeasureSpace],
+    num_processes: int,
+    num_clusters: int,
+    method: ClusterMethod = "hierarchical",
+    dtype: npt.DTypeLike = np.float64,
+    chunksize: Optional[int] = None,
+    verbose: bool = False,
+    executor: Optional[Executor] = None,
+) -> list[quantized_icdm]:
+    """
+    Quantize many cells in parallel.
+
+    :param cells: A list of pairs (A, a), where A is a squareform intracell
+        distance matrix and a is a probability distribution on its points.
+    :param num_processes: How many Python processes to run in parallel.
+    :param num_clusters: Each cell will be partitioned into `num_clusters` many clusters.
+    :param method: The clustering method, see :class:`cajal.qgw.quantized_icdm`.
+    :param dtype: The dtype in which the distance matrices are stored,
+        see :class:`cajal.qgw.quantized_icdm`.
+    :param chunksize: How many cells are sent to each process at a time.
+        If None, this is chosen by the executor.
+    :param verbose: Whether to display a progress bar.
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored.
+    :return: The quantized cells, in the same order as `cells`.
+    :raises ValueError: If the executor's `on_error` is "return" and some cells
+        could not be quantized.
+    """
+    args = [
+        (cell_dm, distribution, num_clusters, None, None, dtype, method)
+        for cell_dm, distribution in cells
+    ]
+    return _quantize_all(args, num_processes, chunksize, verbose, executor)
+
+
+def _quantize_all(
+    args: list[tuple],
+    num_processes: int,
+    chunksize: Optional[int],
+    verbose: bool,
+    executor: Optional[Executor],
+) -> list[quantized_icdm]:
+    """Apply :meth:`cajal.qgw.quantized_icdm.of_tuple` to each tuple in `args`."""
+    executor = default_executor(executor, num_processes)
+    quantized_cells = executor.imap(quantized_icdm.of_tuple, args, chunksize=chunksize)
+    if verbose:
+        quantized_cells = tqdm(quantized_cells, total=len(args))
+    results = list(quantized_cells)
+    failed = [i for i, result in enumerate(results) if isinstance(result, TaskFailure)]
+    if failed:
+        warn_failures([results[i] for i in failed])
+        raise ValueError("Could not quantize the cells at indices " + str(failed))
+    return results
+
+
+QGWLoss = Literal["sparse", "dense", "approximate"]
+
+
+def _reconstructed_inner_product(
+    A_icdm: DistanceMatrix,
+    P: sparse.csr_matrix,
+    B_icdm: DistanceMatrix,
+    loss: QGWLoss,
+) -> float:
+    """
+    Compute <A_icdm, P B_icdm P^T>. If the distance matrices are stored in single
+    precision then so are the products, but the final sum is accumulated
+    in double precision.
+
+    :param loss: "sparse" to use
+        :func:`cajal.gw_cython.sparse_coupling_inner_product`, "dense" to form
+        the dense matrix P B_icdm P^T.
+    """
+    if loss == "sparse":
+        return sparse_coupling_inner_product(
+            A_icdm,
+            B_icdm,
+            P.indptr.astype(np.intc, copy=False),
+            P.indices.astype(np.intc, copy=False),
+            P.data,
+        )
+    if A_icdm.dtype == np.float32:
+        P = P.astype(np.float32)
+    X = P.dot(P.dot(B_icdm).T)
+    return float(np.sum(np.multiply(A_icdm, X, out=X), dtype=np.float64))
+
+
+def _expand_quantized_coupling(
+    A: quantized_icdm, B: quantized_icdm, quantized_coupling: Matrix
+) -> tuple[
+    npt.NDArray[np.int32],
+    npt.NDArray[np.int32],
+    npt.NDArray[np.float_],
+    sparse.csr_matrix,
+]:
+    """
+    Extend a coupling between the clusters of A and B to a sparse coupling
+    between all their points, see :func:`cajal.gw_cython.qgw_expand_coupling`.
+
+    :return: The coupling in COO format (T_rows, T_cols, T_data), and as a csr_matrix
+        without explicit zeros.
+    """
+    T_rows, T_cols, T_data = qgw_expand_coupling(
+        A.distribution,
+        A.q_indices,
+        A.q_distribution,
+        B.distribution,
+        B.q_indices,
+        B.q_distribution,
+        quantized_coupling,
+    )
+    P = sparse.coo_matrix((T_data, (T_rows, T_cols)), shape=(A.n, B.n)).tocsr()
+    P.eliminate_zeros()
+    return T_rows, T_cols, T_data, P
+
+
 def quantized_gw(
     A: quantized_icdm,
     B: quantized_icdm,
     initial_plan: Optional[npt.NDArray[np.float_]] = None,
+    transported_mass: float = 1.0,
+    loss: QGWLoss = "sparse",
 ) -> tuple[sparse.csr_matrix, float]:
     """
     Compute the quantized Gromov-Wasserstein distance
@@ -339,44 +803,136 @@ def quantized_gw(
 
     :param initial_plan: An initial guess at a transport
     plan from A.sub_icdm to B.sub_icdm.
+    :param transported_mass: If less than 1, compute the quantized partial GW distance,
+        see :func:`cajal.run_gw.partial_gw`. The partial problem is solved between the
+        clusters and the result extended to all points as usual. `initial_plan` is
+        ignored in this case.
+    :param loss: How to evaluate the GW cost of the sparse coupling P between all
+        points. "sparse" (the default) computes it exactly with
+        :func:`cajal.gw_cython.sparse_coupling_inner_product`, in
+        O(nnz(P) * m + n * nnz(P)) time and O(m) additional memory.
+        "dense" computes it exactly by forming P B P^T, which takes O(n^2 + nm) memory.
+        "approximate" returns the cost of the coupling between the
+        clusters instead, that is, the GW distance between the medoids of the clusters
+        weighted by the cluster masses. This is much faster for large cells, but
+        ignores the distances within each cluster and so tends to underestimate
+        the quantized GW distance.
+
+    If A and B store their distance matrices in single precision (see
+    :class:`cajal.qgw.quantized_icdm`), the GW cost c_A + c_B - 2<A, PBP^T> of
+    the coupling is evaluated with the sparse products in single precision and
+    accumulated in double precision. The cost then has an absolute error of about
+    1e-7 * (c_A + c_B), so the distance d has an absolute error of about
+    1e-7 * (c_A + c_B) / (8d); in practice the relative error is below 1e-6.
+    The coupling itself is computed between the clusters in double precision and
+    is not affected.
     """
-
-    if initial_plan is None:
-        T_rows, T_cols, T_data = quantized_gw_cython(
-            A.distribution,
+    if transported_mass < 1.0:
+        quantized_coupling, quantized_dist = partial_gw_cython_core(
+            A.sub_icdm,
+            A.q_distribution,
+            B.sub_icdm,
+            B.q_distribution,
+            transported_mass,
+        )
+    elif initial_plan is None:
+        quantized_coupling, quantized_dist = gw_cython_core(
             A.sub_icdm,
-            A.q_indices,
             A.q_distribution,
             A.A_s_a_s,
             A.c_As,
-            B.distribution,
             B.sub_icdm,
-            B.q_indices,
             B.q_distribution,
             B.A_s_a_s,
             B.c_As,
         )
     else:
         init_cost = -2 * (A.sub_icdm @ initial_plan @ B.sub_icdm)
-        T_rows, T_cols, T_data = qgw_init_cost(
-            A.distribution,
+        quantized_coupling, quantized_dist = gw_cython_init_cost(
             A.sub_icdm,
-            A.q_indices,
             A.q_distribution,
             A.c_As,
-            B.distribution,
             B.sub_icdm,
-            B.q_indices,
             B.q_distribution,
             B.c_As,
             init_cost,
         )
+    _, _, _, P = _expand_quantized_coupling(A, B, quantized_coupling)
+    if loss == "approximate":
+        return P, quantized_dist
+
+    if transported_mass < 1.0:
+        p = np.asarray(P.sum(axis=1)).reshape(-1)
+        q = np.asarray(P.sum(axis=0)).reshape(-1)
+        gw_loss = (
+            np.dot(np.dot(np.multiply(A.icdm, A.icdm), p), p)
+            + np.dot(np.dot(np.multiply(B.icdm, B.icdm), q), q)
+            - 2.0 * _reconstructed_inner_product(A.icdm, P, B.icdm, loss)
+        )
+        return P, sqrt(max(gw_loss, 0)) / (2.0 * transported_mass)
 
-    P = sparse.coo_matrix((T_data, (T_rows, T_cols)), shape=(A.n, B.n)).tocsr()
-    gw_loss = A.c_A + B.c_A - 2.0 * float(np.tensordot(A.icdm, P.dot(P.dot(B.icdm).T)))
+    gw_loss = (
+        A.c_A + B.c_A - 2.0 * _reconstructed_inner_product(A.icdm, P, B.icdm, loss)
+    )
     return P, sqrt(max(gw_loss, 0)) / 2.0
 
 
+def quantized_fused_gw(
+    A: quantized_icdm,
+    B: quantized_icdm,
+    alpha: float,
+    categorical_columns: Collection[int] = (),
+    loss: QGWLoss = "sparse",
+) -> tuple[sparse.csr_matrix, float]:
+    """
+    Compute the quantized fused Gromov-Wasserstein distance
+    between two quantized metric measure spaces with features.
+
+    The fused GW problem (see :func:`cajal.run_gw.fused_gw`) is solved between
+    the sampled points of A and B, and the resulting coupling is extended to
+    all points in the same way as in :func:`cajal.qgw.quantized_gw`.
+
+    :param A: A quantized_icdm constructed with `features`.
+    :param B: A quantized_icdm constructed with `features`.
+    :param alpha: A real number between 0 and 1, the weight of the
+        intracell distances against the features.
+    :param categorical_columns: Indices of the feature columns which should be
+        treated as categorical, see :func:`cajal.run_gw.feature_cost_matrix`.
+    :param loss: How to evaluate the cost of the coupling between all points,
+        see :func:`cajal.qgw.quantized_gw`. If "approximate", the fused GW
+        distance between the clusters is returned.
+    """
+    if A.features is None or B.features is None:
+        raise ValueError("Both cells must be constructed with features.")
+    M_s = feature_cost_matrix(A.sub_features, B.sub_features, categorical_columns)
+    quantized_coupling, quantized_dist = fused_gw_cython_core(
+        A.sub_icdm,
+        A.q_distribution,
+        A.A_s_a_s,
+        A.c_As,
+        B.sub_icdm,
+        B.q_distribution,
+        B.A_s_a_s,
+        B.c_As,
+        M_s,
+        alpha,
+    )
+    T_rows, T_cols, T_data, P = _expand_quantized_coupling(A, B, quantized_coupling)
+    if loss == "approximate":
+        return P, quantized_dist
+    gw_loss = (
+        A.c_A + B.c_A - 2.0 * _reconstructed_inner_product(A.icdm, P, B.icdm, loss)
+    )
+    feature_loss = float(
+        np.dot(
+            _feature_cost(A.features[T_rows], B.features[T_cols], categorical_columns),
+            T_data,
+        )
+    )
+    loss = alpha * gw_loss + (1.0 - alpha) * feature_loss
+    return P, sqrt(max(loss, 0)) / 2.0
+
+
 def _block_quantized_gw(indices):
     # Assumes that the global variable _QUANTIZED_CELLS has been declared, as by
     # init_qgw_pool
@@ -392,13 +948,21 @@ def _block_quantized_gw(indices):
     return gw_list
 
 
-def _init_qgw_pool(quantized_cells: list[quantized_icdm]):
+def _init_qgw_pool(
+    quantized_cells: list[quantized_icdm],
+    transported_mass: float = 1.0,
+    loss: QGWLoss = "sparse",
+):
     """
     Initialize the parallel quantized GW computation by declaring a global variable
     accessible from all processes.
     """
     global _QUANTIZED_CELLS
+    global _QGW_TRANSPORTED_MASS
+    global _QGW_LOSS
     _QUANTIZED_CELLS = quantized_cells
+    _QGW_TRANSPORTED_MASS = transported_mass
+    _QGW_LOSS = loss
 
 
 def _quantized_gw_index(p: tuple[int, int]):
@@ -408,7 +972,91 @@ def _quantized_gw_index(p: tuple[int, int]):
     """
     i, j = p
     retval : tuple[int,int,float]
-    return (i, j, quantized_gw(_QUANTIZED_CELLS[i], _QUANTIZED_CELLS[j])[1])
+    return (
+        i,
+        j,
+        quantized_gw(
+            _QUANTIZED_CELLS[i],
+            _QUANTIZED_CELLS[j],
+            transported_mass=_QGW_TRANSPORTED_MASS,
+            loss=_QGW_LOSS,
+        )[1],
+    )
+
+
+def _init_qfgw_pool(
+    quantized_cells: list[quantized_icdm],
+    alpha: float,
+    categorical_columns: Collection[int],
+):
+    """
+    Initialize the parallel quantized fused GW computation by declaring global
+    variables accessible from all processes.
+    """
+    global _QUANTIZED_CELLS
+    global _QFGW_ALPHA
+    global _QFGW_CATEGORICAL_COLUMNS
+    _QUANTIZED_CELLS = quantized_cells
+    _QFGW_ALPHA = alpha
+    _QFGW_CATEGORICAL_COLUMNS = categorical_columns
+
+
+def _quantized_fused_gw_index(p: tuple[int, int]) -> tuple[int, int, float]:
+    i, j = p
+    return (
+        i,
+        j,
+        quantized_fused_gw(
+            _QUANTIZED_CELLS[i],
+            _QUANTIZED_CELLS[j],
+            _QFGW_ALPHA,
+            _QFGW_CATEGORICAL_COLUMNS,
+        )[1],
+    )
+
+
+def quantized_fused_gw_parallel_memory(
+    cells: list[tuple[DistanceMatrix, Distribution, Matrix]],
+    num_processes: int,
+    num_clusters: int,
+    alpha: float,
+    categorical_columns: Collection[int] = (),
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> DistanceMatrix:
+    """
+    Compute the quantized fused GW distance in parallel between all cells in `cells`.
+
+    :param cells: A list of triples (A,a,F) where `A` is a squareform intracell
+        distance matrix, `a` is a probability distribution on the points of
+        `A`, and `F` is an array of shape (n,k) whose rows are the features of
+        the points of `A`.
+    :param num_processes: number of Python processes to run in parallel
+    :param num_clusters: Each cell will be partitioned into `num_clusters` many clusters.
+    :param alpha: A real number between 0 and 1, the weight of the
+        intracell distances against the features.
+    :param categorical_columns: Indices of the feature columns which should be
+        treated as categorical, see :func:`cajal.run_gw.feature_cost_matrix`.
+    :param chunksize: How many distances should be computed at a time by each
+        parallel process. If None, this is chosen by the executor.
+    :param executor: Where to run the computation, see
+        :func:`cajal.qgw.slb_parallel_memory`.
+    :return: a square matrix giving the pairwise quantized fused GW distances.
+    """
+    executor = default_executor(executor, num_processes)
+    args = [(A, a, num_clusters, None, F) for A, a, F in cells]
+    quantized_cells = _quantize_all(args, num_processes, None, False, executor)
+    N = len(quantized_cells)
+    dists = executor.imap(
+        _quantized_fused_gw_index,
+        it.combinations(iter(range(N)), 2),
+        _init_qfgw_pool,
+        (quantized_cells, alpha, categorical_columns),
+        ordered=False,
+        chunksize=chunksize,
+        num_items=N * (N - 1) // 2,
+    )
+    return pairwise_results(dists, N)
 
 
 def quantized_gw_parallel(
@@ -416,9 +1064,14 @@ def quantized_gw_parallel(
     num_processes: int,
     num_clusters: int,
     out_csv: str,
-    chunksize: int = 20,
+    chunksize: Optional[int] = None,
     verbose: bool = False,
-    write_blocksize : int =100
+    write_blocksize: int = 100,
+    transported_mass: float = 1.0,
+    dtype: npt.DTypeLike = np.float64,
+    loss: QGWLoss = "sparse",
+    method: ClusterMethod = "hierarchical",
+    executor: Optional[Executor] = None,
 ) -> None:
     """
     Compute the quantized Gromov-Wasserstein distance in parallel between all cells in a family
@@ -430,7 +1083,19 @@ def quantized_gw_parallel(
     :param out_csv: file path where a CSV file containing
          the quantized GW distances will be written
     :param chunksize: How many q-GW distances should be computed at a time by each parallel process.
+    :param transported_mass: If less than 1, compute the quantized partial GW
+        distance, see :func:`cajal.qgw.quantized_gw`.
+    :param dtype: The dtype in which the quantized cells store their distance
+        matrices, see :class:`cajal.qgw.quantized_icdm`. np.float32 halves the
+        memory used by each worker process.
+    :param loss: How the cost of each coupling is evaluated, see
+        :func:`cajal.qgw.quantized_gw`.
+    :param method: How each cell is clustered, see :class:`cajal.qgw.quantized_icdm`.
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored. Distances whose computation failed
+        are written as "nan".
     """
+    executor = default_executor(executor, num_processes)
     if verbose:
         print("Reading files...")
         cells = [cell for cell in tqdm(cell_iterator_csv(intracell_csv_loc))]
@@ -440,30 +1105,46 @@ def quantized_gw_parallel(
         names, cell_dms = zip(*cell_iterator_csv(intracell_csv_loc))
     if verbose:
         print("Quantizing intracell distance matrices...")
-    with Pool(
-        processes=num_processes
-    ) as pool:
-        args = [ (cell_dm, uniform(cell_dm.shape[0]) , num_clusters, None) for cell_dm in cell_dms ]
-        quantized_cells = list(tqdm(pool.imap(quantized_icdm.of_tuple,args),total=len(names)))
+    quantized_cells = quantize_cells_parallel(
+        [(cell_dm, uniform(cell_dm.shape[0])) for cell_dm in cell_dms],
+        num_processes,
+        num_clusters,
+        method,
+        dtype,
+        verbose=verbose,
+        executor=executor,
+    )
     N = len(quantized_cells)
     total_num_pairs = int((N * (N - 1)) / 2)
     # index_pairs = tqdm(it.combinations(iter(range(N)), 2), total=total_num_pairs)
     index_pairs = it.combinations(iter(range(N)), 2)
 
     print("Computing pairwise Gromov-Wasserstein distances...")    
-    with Pool(
-        initializer=_init_qgw_pool, initargs=(quantized_cells,), processes=num_processes
-    ) as pool:
-        gw_dists = tqdm(
-            pool.imap_unordered(
-            _quantized_gw_index, index_pairs, chunksize=chunksize
-            ),
-            total = total_num_pairs)
-        with open(out_csv, "w", newline="") as outcsvfile:
-            csvwriter = csv.writer(outcsvfile)
-            csvwriter.writerow(["first_object", "second_object", "quantized_gw"])
-            for i,j,gw_dist in gw_dists:
-                csvwriter.writerow((names[i],names[j],gw_dist))
+    gw_dists = tqdm(
+        executor.imap(
+            _quantized_gw_index,
+            index_pairs,
+            _init_qgw_pool,
+            (quantized_cells, transported_mass, loss),
+            ordered=False,
+            chunksize=chunksize,
+            num_items=total_num_pairs,
+        ),
+        total=total_num_pairs,
+    )
+    failures: list[TaskFailure] = []
+    with open(out_csv, "w", newline="") as outcsvfile:
+        csvwriter = csv.writer(outcsvfile)
+        csvwriter.writerow(["first_object", "second_object", "quantized_gw"])
+        for result in gw_dists:
+            if isinstance(result, TaskFailure):
+                failures.append(result)
+                i, j = result.item
+                gw_dist = np.nan
+            else:
+                i, j, gw_dist = result
+            csvwriter.writerow((names[i], names[j], gw_dist))
+    warn_failures(failures)
 
 
 def _cutoff_of(
@@ -580,7 +1261,7 @@ def _get_indices(
 
 
 def _update_dist_mat(
-    gw_dist_iter: Iterable[tuple[int, int, float]],
+    gw_dist_iter: Iterable[Union[tuple[int, int, float], TaskFailure]],
     dist_mat: npt.NDArray[np.float_],
     dist_mat_known: npt.NDArray[np.bool_],
 ) -> None:
@@ -589,17 +1270,26 @@ def _update_dist_mat(
     `dist_mat_known` to reflect these known values.
 
     :param gw_dist_iter: An iterator over ordered triples (i,j,d) where i, j are array
-    indices and d is a float.
+    indices and d is a float, or failed tasks for the pair (i,j), for which d is NaN.
     :param dist_mat: A distance matrix. The matrix is modified by this function;
     we set dist_mat[i,j]=d for all (i,j,d) in `gw_dist_iter`; similarly dist_mat[j,i]=d.
     :param dist_mat_known: An array of booleans recording what GW distances are known.
     This matrix is modified by this function.
     """
-    for i, j, gw_dist in gw_dist_iter:
+    failures: list[TaskFailure] = []
+    for result in gw_dist_iter:
+        if isinstance(result, TaskFailure):
+            # Record the failed pair as known, so that it is not retried.
+            failures.append(result)
+            i, j = result.item
+            gw_dist = np.nan
+        else:
+            i, j, gw_dist = result
         dist_mat[i, j] = gw_dist
         dist_mat[j, i] = gw_dist
         dist_mat_known[i, j] = True
         dist_mat_known[j, i] = True
+    warn_failures(failures)
     return
 
 
@@ -610,12 +1300,17 @@ def combined_slb_quantized_gw_memory(
     accuracy: float,
     nearest_neighbors: int,
     verbose: bool,
-    chunksize: int = 20,
+    chunksize: Optional[int] = None,
+    lower_bound: Literal["slb", "tlb"] = "slb",
+    dtype: npt.DTypeLike = np.float64,
+    loss: QGWLoss = "sparse",
+    method: ClusterMethod = "hierarchical",
+    executor: Optional[Executor] = None,
 ):
     """
     Estimate the qGW distance matrix for cells.
 
-    Compute the pairwise SLB distances between each pair of cells in
+    Compute the pairwise SLB (or TLB) distances between each pair of cells in
     `cell_dms`.  Based on this initial estimate of the distances,
     compute the quantized GW distance between the nearest with
     `num_clusters` many clusters until the correct nearest-neighbors
@@ -640,29 +1335,45 @@ def combined_slb_quantized_gw_memory(
         quantized GW distances between pairs of cells if one is within the first
         `nearest_neighbors` neighbors of the other; for all other values,
         the SLB distance is used to give a rough estimate.
+    :param lower_bound: Which lower bound for the GW distance is used to decide which
+        pairs of cells to compute. "slb" is very cheap; "tlb" is
+        more expensive to compute (an optimal transport problem of the same
+        size as one step of the GW computation) but much tighter, so that
+        fewer quantized GW distances are computed needlessly.
+        The first element of the returned tuple is the chosen lower bound.
+    :param dtype: The dtype in which the quantized cells store their distance
+        matrices, see :class:`cajal.qgw.quantized_icdm`.
+    :param loss: How the cost of each coupling is evaluated, see
+        :func:`cajal.qgw.quantized_gw`.
+    :param method: How each cell is clustered, see :class:`cajal.qgw.quantized_icdm`.
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored. Pairs of cells whose quantized GW
+        distance could not be computed are recorded as known, with distance NaN.
     """
-
+    executor = default_executor(executor, num_processes)
     N = len(cell_dms)
     cells, cell_distributions = zip(*cell_dms)
     np_arange_N = np.arange(N)
-    slb_dmat = slb_parallel_memory(cells, cell_distributions, num_processes, chunksize)
+    if lower_bound == "tlb":
+        slb_dmat = tlb_parallel_memory(
+            cells, cell_distributions, num_processes, chunksize, executor
+        )
+    else:
+        slb_dmat = slb_parallel_memory(
+            cells, cell_distributions, num_processes, chunksize, executor
+        )
 
     # Partial quantized Gromov-Wasserstein table, will be filled in gradually.
     qgw_dmat = np.zeros((N, N), dtype=float)
     qgw_known = np.full(shape=(N, N), fill_value=False)
     qgw_known[np_arange_N, np_arange_N] = True
 
-    quantized_cells = [
-        quantized_icdm(
-            cell_dm, cell_distribution, num_clusters
-        )
-        for cell_dm, cell_distribution in cell_dms
-    ]
+    quantized_cells = quantize_cells_parallel(
+        cell_dms, num_processes, num_clusters, method, dtype, executor=executor
+    )
     # Debug
     total_cells_computed = 0
-    with Pool(
-        initializer=_init_qgw_pool, initargs=(quantized_cells,), processes=num_processes
-    ) as pool:
+    with executor.session(_init_qgw_pool, (quantized_cells, 1.0, loss)) as session:
         indices = _get_indices(
             slb_dmat, qgw_dmat, qgw_known, accuracy, nearest_neighbors
         )
@@ -673,8 +1384,8 @@ def combined_slb_quantized_gw_memory(
                 print("Cell pairs to be computed this iteration: " + str(len(indices)))
 
             total_cells_computed += len(indices)
-            qgw_dists = pool.imap_unordered(
-                _quantized_gw_index, indices, chunksize=chunksize
+            qgw_dists = session.imap(
+                _quantized_gw_index, indices, ordered=False, chunksize=chunksize
             )
             _update_dist_mat(qgw_dists, qgw_dmat, qgw_known)
             assert np.count_nonzero(qgw_known) == 2 * total_cells_computed + N
@@ -692,7 +1403,12 @@ def combined_slb_quantized_gw(
     accuracy: float,
     nearest_neighbors: int,
     verbose: bool = False,
-    chunksize: int = 20,
+    chunksize: Optional[int] = None,
+    lower_bound: Literal["slb", "tlb"] = "slb",
+    dtype: npt.DTypeLike = np.float64,
+    loss: QGWLoss = "sparse",
+    method: ClusterMethod = "hierarchical",
+    executor: Optional[Executor] = None,
 ) -> None:
     """
     Estimate the qGW distance matrix for cells.
@@ -720,9 +1436,14 @@ def combined_slb_quantized_gw(
         nearest_neighbors,
         verbose,
         chunksize,
+        lower_bound,
+        dtype,
+        loss,
+        method,
+        executor,
     )
 
-    median_error = np.median((qgw_dmat - slb_dmat)[qgw_known])
+    median_error = np.nanmedian((qgw_dmat - slb_dmat)[qgw_known])
     slb_estimator = slb_dmat + median_error
     qgw_dmat[~qgw_known] = slb_estimator[~qgw_known]
     ij = it.combinations(range(len(names)), 2)
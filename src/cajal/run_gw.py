@@ -8,7 +8,7 @@ import csv
 # std lib dependencies
 import itertools as it
 import sys
-from typing import Iterator, List, Optional, TypeVar
+from typing import Callable, Collection, Iterator, List, Optional, TypeVar
 
 if "ipykernel" in sys.modules:
     from tqdm.notebook import tqdm
@@ -19,7 +19,6 @@ if sys.version_info >= (3, 10):
     from typing import TypeAlias
 
 from math import ceil, sqrt
-from multiprocessing import Pool
 
 import numpy as np
 import numpy.typing as npt
@@ -28,7 +27,15 @@ from scipy.spatial.distance import squareform
 # external dependencies
 from threadpoolctl import ThreadpoolController
 
-from .gw_cython import GW_cell, gw_cython_core
+from .parallel import Executor, TaskFailure, warn_failures
+from .utilities import icdm_binary_iterator, is_icdm_binary
+from .gw_cython import (
+    GW_cell,
+    gw_cython_core,
+    fused_gw_cython_core,
+    partial_gw_cython_core,
+    openmp_available,
+)
 
 T = TypeVar("T")
 
@@ -148,6 +155,25 @@ def _batched_cell_list_iterator_csv(
     to a child process at one time. However, numpy is already parallelizing the GW computations \
     under the hood so this is probably an irrelevant concern.
     """
+    if is_icdm_binary(intracell_csv_loc):
+
+        def numbered_cells() -> Iterator[tuple[int, str, DistanceMatrix]]:
+            return (
+                (cell_id, name, dmat)
+                for cell_id, (name, dmat) in enumerate(
+                    cell_iterator_csv(intracell_csv_loc), start=1
+                )
+            )
+
+        for outer_list in _batched(numbered_cells(), chunk_size):
+            first_outer_id = outer_list[0][0]
+            inner_cells = it.dropwhile(
+                lambda cell: cell[0] <= first_outer_id, numbered_cells()
+            )
+            for inner_list in _batched(inner_cells, chunk_size):
+                yield outer_list, inner_list
+        return
+
     # Validate input
     icdm_csv_validate(intracell_csv_loc)
 
@@ -193,11 +219,19 @@ def cell_iterator_csv(
     intracell_csv_loc: str,
 ) -> Iterator[tuple[str, DistanceMatrix]]:
     """
-    :param intracell_csv_loc: A full file path to a csv file.
+    :param intracell_csv_loc: A full file path to a csv file, or to a binary file
+        written by :func:`cajal.utilities.write_csv_block` with a
+        :class:`cajal.utilities.BinaryFormat`, which is recognized by its first bytes.
 
     :return: an iterator over cells in the csv file, given as tuples of the form
         (name, dmat). Intracell distance matrices are in squareform.
     """
+    if is_icdm_binary(intracell_csv_loc):
+        for cell_name, icdm in icdm_binary_iterator(intracell_csv_loc):
+            yield cell_name, squareform(
+                icdm.astype(np.float64), force="tomatrix", checks=False
+            )
+        return
     icdm_csv_validate(intracell_csv_loc)
     with open(intracell_csv_loc, "r", newline="") as icdm_csvfile:
         csv_reader = csv.reader(icdm_csvfile, delimiter=",")
@@ -237,15 +271,16 @@ def cell_pair_iterator_csv(
     )
 
 
-def _init_gw_pool(GW_cells: list[GW_cell]):
+def _init_gw_pool(GW_cells: list[GW_cell], num_threads: int = 1):
     global _GW_CELLS
+    global _GW_NUM_THREADS
     _GW_CELLS = GW_cells
+    _GW_NUM_THREADS = num_threads
 
 
 controller = ThreadpoolController()
 
 
-@controller.wrap(limits=1, user_api="blas")
 def _gw_index(p: tuple[int, int]
               ) -> tuple[int, int, Matrix, float]:
     i, j = p
@@ -262,6 +297,180 @@ def _gw_index(p: tuple[int, int]
         B.distribution,
         B.dmat_dot_dist,
         B.cell_constant,
+        num_threads=_GW_NUM_THREADS,
+    )
+    return (i, j, coupling_mat, gw_dist)
+
+
+def _init_partial_gw_pool(
+    GW_cells: list[GW_cell], transported_mass: float, num_threads: int = 1
+):
+    global _GW_CELLS
+    global _TRANSPORTED_MASS
+    global _GW_NUM_THREADS
+    _GW_CELLS = GW_cells
+    _TRANSPORTED_MASS = transported_mass
+    _GW_NUM_THREADS = num_threads
+
+
+def _partial_gw_index(p: tuple[int, int]) -> tuple[int, int, Matrix, float]:
+    i, j = p
+    A: GW_cell
+    B: GW_cell
+    A = _GW_CELLS[i]
+    B = _GW_CELLS[j]
+    coupling_mat, gw_dist = partial_gw_cython_core(
+        A.dmat,
+        A.distribution,
+        B.dmat,
+        B.distribution,
+        _TRANSPORTED_MASS,
+        num_threads=_GW_NUM_THREADS,
+    )
+    return (i, j, coupling_mat, gw_dist)
+
+
+# Default for the smallest number of entries n*m in the cost matrix for which the
+# network simplex is given multiple threads. This is a rough, untuned heuristic;
+# the break-even point depends on the machine and has not been measured.
+_OPENMP_MIN_PROBLEM_SIZE = 1000 * 1000
+
+
+def _split_parallelism(
+    cell_sizes: list[int],
+    num_processes: int,
+    num_threads: Optional[int],
+    min_problem_size: int = _OPENMP_MIN_PROBLEM_SIZE,
+) -> tuple[int, int]:
+    """
+    Decide how to divide `num_processes` cores between parallel processes, each
+    computing GW distances between different pairs of cells, and OpenMP threads
+    within the computation of a single GW distance.
+
+    :param cell_sizes: The number of points of each cell.
+    :param num_threads: The number of threads per process requested by the user,
+        or None to decide automatically.
+    :param min_problem_size: When deciding automatically, threads are only used if
+        the cost matrix of the two largest cells has at least this many entries.
+    :return: A pair (processes, threads_per_process).
+    """
+    if num_threads is not None:
+        return max(1, num_processes // max(num_threads, 1)), num_threads
+    num_pairs = len(cell_sizes) * (len(cell_sizes) - 1) // 2
+    largest = sorted(cell_sizes, reverse=True)[:2]
+    if (
+        not openmp_available()
+        or len(largest) < 2
+        or largest[0] * largest[1] < min_problem_size
+        or num_pairs >= num_processes
+    ):
+        return num_processes, 1
+    processes = max(num_pairs, 1)
+    return processes, max(1, num_processes // processes)
+
+
+def _pairwise_executor(
+    cell_sizes: list[int],
+    num_processes: int,
+    num_threads: Optional[int],
+    executor: Optional[Executor],
+) -> tuple[Executor, int]:
+    """
+    Return the executor for a pairwise GW computation and the number of OpenMP
+    threads used for each pair. If no executor is given, the cores are divided as
+    by :func:`cajal.run_gw._split_parallelism`; otherwise the number of threads
+    defaults to the number of BLAS threads of the executor.
+    """
+    if executor is not None:
+        if num_threads is None:
+            num_threads = executor.blas_threads or 1
+        return executor, num_threads
+    num_processes, num_threads = _split_parallelism(
+        cell_sizes, num_processes, num_threads
+    )
+    return Executor("processes", num_processes, blas_threads=num_threads), num_threads
+
+
+def _feature_cost(
+    X: npt.NDArray[np.float_],
+    Y: npt.NDArray[np.float_],
+    categorical_columns: Collection[int],
+) -> npt.NDArray[np.float_]:
+    """
+    Compare the feature vectors in X and Y along the last axis; X and Y must be
+    broadcastable against each other.
+    """
+    diff = X - Y
+    categorical = np.zeros((X.shape[-1],), dtype=bool)
+    categorical[list(categorical_columns)] = True
+    return np.sum(np.where(categorical, diff != 0, diff * diff), axis=-1)
+
+
+def feature_cost_matrix(
+    X_features: Matrix,
+    Y_features: Matrix,
+    categorical_columns: Collection[int] = (),
+) -> Matrix:
+    """
+    Compute the cost matrix between the features of the points of two cells.
+
+    Numerical features are compared by squared difference, and categorical
+    features (such as the SWC structure_id) by whether they are different;
+    the cost of matching two points is the sum of these over all features.
+    Users should rescale the columns of the feature matrices beforehand to
+    control the relative importance of the features.
+
+    :param X_features: Array of shape (n,k), the features of the points of X.
+    :param Y_features: Array of shape (m,k), the features of the points of Y.
+    :param categorical_columns: The indices of the columns which should be
+        treated as categorical.
+    :return: A C-contiguous matrix of shape (n,m).
+    """
+    return np.ascontiguousarray(
+        _feature_cost(
+            X_features[:, np.newaxis, :],
+            Y_features[np.newaxis, :, :],
+            categorical_columns,
+        ),
+        dtype=np.float64,
+    )
+
+
+def _init_fused_gw_pool(
+    GW_cells: list[GW_cell],
+    alpha: float,
+    categorical_columns: Collection[int],
+    num_threads: int = 1,
+):
+    global _GW_CELLS
+    global _FUSED_ALPHA
+    global _CATEGORICAL_COLUMNS
+    global _GW_NUM_THREADS
+    _GW_CELLS = GW_cells
+    _FUSED_ALPHA = alpha
+    _CATEGORICAL_COLUMNS = categorical_columns
+    _GW_NUM_THREADS = num_threads
+
+
+def _fused_gw_index(p: tuple[int, int]) -> tuple[int, int, Matrix, float]:
+    i, j = p
+    A: GW_cell
+    B: GW_cell
+    A = _GW_CELLS[i]
+    B = _GW_CELLS[j]
+    M = feature_cost_matrix(A.features, B.features, _CATEGORICAL_COLUMNS)
+    coupling_mat, gw_dist = fused_gw_cython_core(
+        A.dmat,
+        A.distribution,
+        A.dmat_dot_dist,
+        A.cell_constant,
+        B.dmat,
+        B.distribution,
+        B.dmat_dot_dist,
+        B.cell_constant,
+        M,
+        _FUSED_ALPHA,
+        num_threads=_GW_NUM_THREADS,
     )
     return (i, j, coupling_mat, gw_dist)
 
@@ -339,6 +548,10 @@ def gw_pairwise_parallel(
     gw_dist_csv: Optional[str] = None,
     gw_coupling_mat_csv: Optional[str] = None,
     return_coupling_mats: bool = False,
+    transported_mass: float = 1.0,
+    dtype: npt.DTypeLike = np.float64,
+    num_threads: Optional[int] = None,
+    executor: Optional[Executor] = None,
 ) -> tuple[
     DistanceMatrix,  # Pairwise GW distance matrix (Squareform)
     Optional[list[tuple[int, int, Matrix]]],
@@ -368,6 +581,34 @@ def gw_pairwise_parallel(
         If `return_coupling_mats` is False, returns `(gw_dmat, None)`.
         This argument is independent of whether the coupling matrices are written to a file;
         one may return the coupling matrices, write them to file, both, or neither.
+    :param transported_mass: A real number in (0, 1]. If it is less than 1, the partial
+        GW distance is computed instead (see :func:`cajal.run_gw.partial_gw`): only this
+        fraction of the mass of each cell needs to be matched, so that a cell which is
+        a truncated reconstruction of another is close to it. The coupling matrices
+        then have total mass `transported_mass`.
+    :param dtype: Either np.float64 or np.float32. If np.float32, the intracell
+        distance matrices are stored in single precision and the matrix products
+        in each gradient descent step are computed in single precision, which
+        halves the memory used by each worker and makes these products about twice
+        as fast. The optimal transport subproblems and the GW cost are still
+        computed in double precision. The cost c_A + c_B - 2<APB,P> of each
+        coupling then has an absolute error of about 1e-7 * (c_A + c_B), where
+        c_A = ((A * A) @ a) @ a, so the GW distance d has an absolute error of about
+        1e-7 * (c_A + c_B) / (8d). In practice the relative error is below 1e-5,
+        except for nearly isometric cells (d below about 1e-3 * sqrt(c_A + c_B))
+        whose distance is only accurate to about 1e-4 * sqrt(c_A + c_B).
+    :param num_threads: How many threads each process uses to compute a single GW
+        distance (for the optimal transport problems, if CAJAL was compiled with OpenMP,
+        and for the matrix products). The number of processes is then
+        `num_processes // num_threads`. If None, this is decided automatically:
+        if there are fewer pairs of cells than `num_processes` and the cells are
+        large (more than about 1000 points), each pair gets several threads;
+        otherwise each process is single-threaded.
+    :param executor: Where to run the computation, see
+        :class:`cajal.parallel.Executor`. If given, `num_processes` is ignored, and
+        `num_threads` defaults to the executor's `blas_threads`. If the executor's
+        `on_error` is "return", the distance between a pair of cells for which the
+        computation failed is NaN, and a warning is issued.
 
     :return: If `return_coupling_mats` is True,
         returns `( gw_dmat, couplings )`,
@@ -379,19 +620,73 @@ def gw_pairwise_parallel(
     """
     GW_cells = []
     for A, a in cells:
-        GW_cells.append(GW_cell(A, a))
-    num_cells = len(cells)
+        GW_cells.append(GW_cell(A, a, dtype=dtype))
+    executor, num_threads = _pairwise_executor(
+        [A.shape[0] for A, _ in cells], num_processes, num_threads, executor
+    )
+    if transported_mass < 1.0:
+        index_fn = _partial_gw_index
+        initializer = _init_partial_gw_pool
+        initargs = (GW_cells, transported_mass, num_threads)
+    else:
+        index_fn = _gw_index
+        initializer = _init_gw_pool
+        initargs = (GW_cells, num_threads)
+    return _gw_pairwise_driver(
+        len(GW_cells),
+        index_fn,
+        initializer,
+        initargs,
+        executor,
+        names,
+        gw_dist_csv,
+        gw_coupling_mat_csv,
+        return_coupling_mats,
+    )
+
+
+def _skip_failures(
+    results: Iterator[T | TaskFailure], failures: list[TaskFailure]
+) -> Iterator[T]:
+    """Yield the successful results, and append the failed tasks to `failures`."""
+    for result in results:
+        if isinstance(result, TaskFailure):
+            failures.append(result)
+        else:
+            yield result
+
+
+def _gw_pairwise_driver(
+    num_cells: int,
+    index_fn: Callable[[tuple[int, int]], tuple[int, int, Matrix, float]],
+    initializer: Callable,
+    initargs: tuple,
+    executor: Executor,
+    names: Optional[list[str]],
+    gw_dist_csv: Optional[str],
+    gw_coupling_mat_csv: Optional[str],
+    return_coupling_mats: bool,
+) -> tuple[DistanceMatrix, Optional[list[tuple[int, int, Matrix]]]]:
+    """
+    Apply `index_fn` to all pairs of cells in parallel, and collect the
+    results as in :func:`cajal.run_gw.gw_pairwise_parallel`.
+
+    :param index_fn: A function taking a pair of indices (i,j) to a tuple
+        (i, j, coupling_mat, gw_dist). It may refer to global variables declared
+        by `initializer`.
+    """
     gw_dmat = np.zeros((num_cells, num_cells))
     if return_coupling_mats is not None:
         gw_coupling_mats = []
-    NN = len(GW_cells)
-    total_num_pairs = int((NN * (NN - 1)) / 2)
+    total_num_pairs = int((num_cells * (num_cells - 1)) / 2)
     ij = tqdm(it.combinations(range(num_cells), 2), total=total_num_pairs)
-    with Pool(
-        initializer=_init_gw_pool, initargs=(GW_cells,), processes=num_processes
-    ) as pool:
+    failures: list[TaskFailure] = []
+    with executor.session(initializer, initargs) as session:
         gw_data : Iterator[tuple[int, int, Matrix, float]]
-        gw_data = pool.imap_unordered(_gw_index, ij, chunksize=20)
+        gw_data = _skip_failures(
+            session.imap(index_fn, ij, ordered=False, num_items=total_num_pairs),
+            failures,
+        )
         if (gw_dist_csv is not None) or (gw_coupling_mat_csv is not None):
             if names is None:
                 raise Exception(
@@ -408,12 +703,16 @@ def gw_pairwise_parallel(
             gw_dmat[j, i] = gw_dist
             if return_coupling_mats:
                 gw_coupling_mats.append((i, j, coupling_mat))
+    for failure in failures:
+        i, j = failure.item
+        gw_dmat[i, j] = np.nan
+        gw_dmat[j, i] = np.nan
+    warn_failures(failures)
     if return_coupling_mats:
         return (gw_dmat, gw_coupling_mats)
     return (gw_dmat, None)
 
 
-@controller.wrap(limits=1, user_api="blas")
 def gw(
     A: DistanceMatrix,
     a: Distribution,
@@ -421,13 +720,165 @@ def gw(
     b: Distribution,
     max_iters_descent: int = 1000,
     max_iters_ot: int = 200000,
+    num_threads: int = 1,
+) -> tuple[Matrix, float]:
+    """
+    Compute the Gromov-Wasserstein distance between two metric measure spaces.
+
+    A and B may both be of dtype np.float32, in which case the gradient is
+    computed in single precision, see :func:`cajal.run_gw.gw_pairwise_parallel`.
+
+    :param num_threads: How many threads to use for the optimal transport
+        problems (if CAJAL was compiled with OpenMP, see
+        :func:`cajal.gw_cython.openmp_available`) and the matrix products.
+        This is worthwhile only for large cells, with more than about 1000
+        points each.
+    """
+    Aa = A @ a
+    c_A = ((A * A) @ a) @ a
+    Bb = B @ b
+    c_B = ((B * B) @ b) @ b
+    with controller.limit(limits=num_threads, user_api="blas"):
+        return gw_cython_core(
+            A, a, Aa, c_A, B, b, Bb, c_B, max_iters_descent, max_iters_ot, num_threads
+        )
+
+
+def partial_gw(
+    A: DistanceMatrix,
+    a: Distribution,
+    B: DistanceMatrix,
+    b: Distribution,
+    transported_mass: float,
+    max_iters_descent: int = 1000,
+    max_iters_ot: int = 200000,
+    num_threads: int = 1,
+) -> tuple[Matrix, float]:
+    """
+    Compute the partial Gromov-Wasserstein distance between two metric measure spaces.
+
+    Only a fraction `transported_mass` of the mass of each space is
+    matched; the remaining mass is discarded where it is most costly to
+    match. This is appropriate when one or both cells may be incomplete
+    reconstructions.
+
+    :param transported_mass: The fraction of the mass to be transported, in (0, 1].
+    :return: A pair (P, dist) where P is a coupling matrix of total mass
+        `transported_mass`, and `dist` is the GW distance between the
+        renormalized sub-measures of `a` and `b` matched by P.
+
+    For `num_threads` see :func:`cajal.run_gw.gw`.
+    """
+    with controller.limit(limits=num_threads, user_api="blas"):
+        return partial_gw_cython_core(
+            A, a, B, b, transported_mass, max_iters_descent, max_iters_ot, num_threads
+        )
+
+
+def fused_gw_pairwise_parallel(
+    cells: list[
+        tuple[
+            DistanceMatrix,  # Squareform distance matrix
+            Distribution,  # Probability distribution on cells
+            Matrix,  # Features of the points of the cell
+        ]
+    ],
+    num_processes: int,
+    alpha: float,
+    categorical_columns: Collection[int] = (),
+    names: Optional[list[str]] = None,
+    gw_dist_csv: Optional[str] = None,
+    gw_coupling_mat_csv: Optional[str] = None,
+    return_coupling_mats: bool = False,
+    num_threads: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> tuple[
+    DistanceMatrix,  # Pairwise fused GW distance matrix (Squareform)
+    Optional[list[tuple[int, int, Matrix]]],
+]:
+    """Compute the pairwise fused Gromov-Wasserstein distances between cells.
+
+    The fused GW distance takes into account both the intracell distances and
+    the features of the points (for example, the radius and the structure_id of
+    the neuron at each sample point, see
+    :func:`cajal.sample_swc.euclidean_point_cloud_features`). For a coupling P,
+    the cost is `alpha` times the GW cost of P plus `(1-alpha)` times the cost
+    <M,P> of matching the features, where M is computed by
+    :func:`cajal.run_gw.feature_cost_matrix`. When `alpha` is 1 this is the usual
+    GW distance.
+
+    :param cells: A list of triples (A,a,F) where `A` is a squareform intracell
+        distance matrix, `a` is a probability distribution on the points of
+        `A`, and `F` is an array of shape (n,k) whose rows are the features of
+        the points of `A`. All cells should have the same number `k` of features.
+    :param alpha: A real number between 0 and 1, the weight of the
+        intracell distances against the features.
+    :param categorical_columns: Indices of the columns of the feature
+        matrices which should be treated as categorical.
+
+    For other parameters and the return value see
+    :func:`cajal.run_gw.gw_pairwise_parallel`.
+    """
+    GW_cells = []
+    for A, a, F in cells:
+        GW_cells.append(GW_cell(A, a, np.asarray(F, dtype=np.float64)))
+    executor, num_threads = _pairwise_executor(
+        [A.shape[0] for A, _, _ in cells], num_processes, num_threads, executor
+    )
+    return _gw_pairwise_driver(
+        len(GW_cells),
+        _fused_gw_index,
+        _init_fused_gw_pool,
+        (GW_cells, alpha, categorical_columns, num_threads),
+        executor,
+        names,
+        gw_dist_csv,
+        gw_coupling_mat_csv,
+        return_coupling_mats,
+    )
+
+
+def fused_gw(
+    A: DistanceMatrix,
+    a: Distribution,
+    B: DistanceMatrix,
+    b: Distribution,
+    M: Matrix,
+    alpha: float,
+    max_iters_descent: int = 1000,
+    max_iters_ot: int = 200000,
+    num_threads: int = 1,
 ) -> tuple[Matrix, float]:
-    """Compute the Gromov-Wasserstein distance between two metric measure spaces."""
+    """
+    Compute the fused Gromov-Wasserstein distance between two metric measure spaces.
+
+    :param M: The feature cost matrix, of shape (n,m), for example as computed by
+        :func:`cajal.run_gw.feature_cost_matrix`.
+    :param alpha: A real number between 0 and 1, the weight of the
+        intracell distances against the features.
+
+    For `num_threads` see :func:`cajal.run_gw.gw`.
+    """
     Aa = A @ a
     c_A = ((A * A) @ a) @ a
     Bb = B @ b
     c_B = ((B * B) @ b) @ b
-    return gw_cython_core(A, a, Aa, c_A, B, b, Bb, c_B, max_iters_descent, max_iters_ot)
+    with controller.limit(limits=num_threads, user_api="blas"):
+        return fused_gw_cython_core(
+            A,
+            a,
+            Aa,
+            c_A,
+            B,
+            b,
+            Bb,
+            c_B,
+            np.ascontiguousarray(M, dtype=np.float64),
+            alpha,
+            max_iters_descent,
+            max_iters_ot,
+            num_threads,
+        )
 
 
 def uniform(n : int) -> npt.NDArray[np.float_]:
@@ -442,6 +893,10 @@ def compute_gw_distance_matrix(
     gw_coupling_mat_csv_loc: Optional[str] = None,
     return_coupling_mats: bool = False,
     verbose: Optional[bool] = False,
+    transported_mass: float = 1.0,
+    dtype: npt.DTypeLike = np.float64,
+    num_threads: Optional[int] = None,
+    executor: Optional[Executor] = None,
 ) -> tuple[
     DistanceMatrix,  # Pairwise GW distance matrix (Squareform)
     Optional[list[tuple[int, int, Matrix]]],
@@ -474,4 +929,8 @@ def compute_gw_distance_matrix(
         gw_dist_csv_loc,
         gw_coupling_mat_csv_loc,
         return_coupling_mats,
+        transported_mass,
+        dtype,
+        num_threads,
+        executor,
     )
@@ -4,25 +4,25 @@ Functions for sampling points from a triangular mesh
 from __future__ import annotations
 import os
 import sys
-import csv
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import numpy.typing as npt
 import potpourri3d as pp3d
-import networkx as nx
-import networkx.algorithms.shortest_paths as nxsp
-from scipy.spatial.distance import squareform, cdist, euclidean, pdist
-import trimesh
-import itertools as it
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import squareform, pdist
 import warnings
 from typing import (
     Tuple,
     List,
-    Set,
     Dict,
     Optional,
     Iterator,
     Callable,
     Literal,
+    Sequence,
 )
 
 if sys.version_info >= (3, 10):
@@ -31,9 +31,8 @@ if sys.version_info >= (3, 10):
     VertexArray: TypeAlias = npt.NDArray[np.float_]
     FaceArray: TypeAlias = npt.NDArray[np.int_]
 
-from pathos.pools import ProcessPool
-
-from .utilities import write_csv_block
+from .parallel import Executor, TaskFailure, default_executor
+from .utilities import BinaryFormat, Err, write_csv_block
 
 # We represent a mesh as a pair (vertices, faces) : Tuple[VertexArray,FaceArray].
 # A VertexArray is a numpy array of shape (n, 3), where n is the number of vertices in the mesh.
@@ -45,11 +44,125 @@ from .utilities import write_csv_block
 # representing triangular faces joining those three points.
 
 
-def read_obj(file_path: str) -> Tuple[VertexArray, FaceArray]:
+# read_obj reads the file in blocks of this many bytes, so that the text of a large
+# file is never held in memory all at once.
+_OBJ_BLOCK_SIZE = 1 << 24
+
+
+def _whitespace(text: npt.NDArray[np.uint8]) -> npt.NDArray[np.bool_]:
+    return (
+        (text == ord(" "))
+        | (text == ord("\t"))
+        | (text == ord("\r"))
+        | (text == ord("\n"))
+    )
+
+
+def _drop_from(
+    text: npt.NDArray[np.uint8], marker: str, boundary: npt.NDArray[np.bool_]
+) -> npt.NDArray[np.uint8]:
+    """
+    Delete the characters of `text` from each occurrence of `marker` up to the next \
+    `boundary` position (exclusive).
+    """
+    is_marker = text == ord(marker)
+    if not np.any(is_marker):
+        return text
+    count = np.cumsum(is_marker, dtype=np.int32)
+    base = np.maximum.accumulate(np.where(boundary, count, 0))
+    return text[(count == base) | boundary]
+
+
+def _parse_obj_numbers(
+    text: npt.NDArray[np.uint8], dtype: type
+) -> Tuple[npt.NDArray, npt.NDArray[np.int_]]:
+    """
+    Parse the whitespace-separated numbers on each line of `text`, a sequence of \
+    newline-terminated lines.
+
+    :return: The numbers on all lines, concatenated, and the number on each line.
+    """
+    if text.shape[0] == 0:
+        return np.zeros((0,), dtype=dtype), np.zeros((0,), dtype=np.int_)
+    space = _whitespace(text)
+    token_start = ~space
+    token_start[1:] &= space[:-1]
+    line_start = np.flatnonzero(text == ord("\n"))[:-1] + 1
+    counts = np.add.reduceat(
+        token_start, np.concatenate(([0], line_start)), dtype=np.int_
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(  # type: ignore[call-overload]
+            text.tobytes(), dtype=dtype, sep=" "
+        )
+    if values.shape[0] != np.sum(counts):
+        raise ValueError("Could not parse the numbers in the file.")
+    return values, counts
+
+
+def _parse_obj_block(block: bytes) -> Tuple[VertexArray, FaceArray]:
+    """
+    Parse the vertices and faces in `block`, a sequence of newline-terminated lines.
+    """
+    if not block:
+        return np.zeros((0, 3), dtype=np.float64), np.zeros((0, 3), dtype=np.int64)
+    text = np.frombuffer(block, dtype=np.uint8).copy()
+    line_end = np.flatnonzero(text == ord("\n"))
+    line_start = np.concatenate(([0], line_end[:-1] + 1))
+    # The keyword of a line is its first character, if it is followed by whitespace.
+    followed_by_space = _whitespace(text[np.minimum(line_start + 1, text.shape[0] - 1)])
+    keyword = np.repeat(
+        np.where(followed_by_space, text[line_start], 0), line_end + 1 - line_start
+    )
+    text[line_start[followed_by_space]] = ord(" ")
+
+    vertex_text = text[keyword == ord("v")]
+    vertex_text = _drop_from(vertex_text, "#", vertex_text == ord("\n"))
+    coords, counts = _parse_obj_numbers(vertex_text, np.float64)
+    if np.any(counts < 3):
+        raise ValueError("A vertex has fewer than three coordinates.")
+    # Drop the optional w coordinate or vertex colors.
+    offsets = np.cumsum(counts) - counts
+    vertices = coords[offsets[:, np.newaxis] + np.arange(3)]
+
+    face_text = text[keyword == ord("f")]
+    face_text = _drop_from(face_text, "#", face_text == ord("\n"))
+    # Keep only the vertex index from each token "v/vt/vn" of a face.
+    face_text = _drop_from(face_text, "/", _whitespace(face_text))
+    indices, counts = _parse_obj_numbers(face_text, np.int64)
+    if np.any(counts < 3):
+        raise ValueError("A face has fewer than three vertices.")
+    # Split polygons into triangles (v0, v_j, v_j+1) fanning out from their first vertex.
+    offsets = np.cumsum(counts) - counts
+    num_triangles = counts - 2
+    first = np.repeat(offsets, num_triangles)
+    j = (
+        np.arange(first.shape[0])
+        - np.repeat(np.cumsum(num_triangles) - num_triangles, num_triangles)
+        + 1
+    )
+    faces = np.stack(
+        (indices[first], indices[first + j], indices[first + j + 1]), axis=1
+    )
+    return vertices, faces
+
+
+def read_obj(
+    file_path: str, block_size: int = _OBJ_BLOCK_SIZE
+) -> Tuple[VertexArray, FaceArray]:
     """
     Reads in the vertices and triangular faces of a .obj file.
 
+    The file is read in blocks of `block_size` bytes, and the numbers in each \
+    block are parsed in bulk by NumPy. Vertex lines may have more than three numbers \
+    (only the first three are kept), face tokens may be of the form "v/vt/vn" \
+    (only the vertex index is kept), and faces with more than three vertices are split \
+    into triangles. Vertex textures, normals, and all other lines are skipped. \
+    Relative (negative) vertex indices are not supported.
+
     :param file_path: Path to .obj file
+    :param block_size: How many bytes to read from the file at a time.
 
     :return: Ordered pair `(vertices, faces)`, where:
 
@@ -58,18 +171,184 @@ def read_obj(file_path: str) -> Tuple[VertexArray, FaceArray]:
         * `faces` is an array of shape `(m,3)`, where `m` is the number of \
            faces; the `k`-th row gives the indices for the vertices in the `k`-th face.
     """
-    obj_file = open(file_path, "r")
-    obj_split = csv.reader(obj_file, delimiter=" ")
-    vertices = []
-    faces = []
-    for line in obj_split:
-        if line[0] == "v":
-            vertices.append([float(x) for x in line[1:]])
-        elif line[0] == "f":
-            faces.append([float(x) for x in line[1:]])
-        # Skipping over any vertex textures or normals
-    obj_file.close()
-    return np.array(vertices), (np.array(faces) - 1).astype("int64")
+    vertex_blocks: List[VertexArray] = []
+    face_blocks: List[FaceArray] = []
+    remainder = b""
+    with open(file_path, "rb") as obj_file:
+        while True:
+            block = obj_file.read(block_size)
+            if not block:
+                break
+            block = remainder + block
+            # Only parse whole lines; the last, partial line is kept for the next block.
+            cut = block.rfind(b"\n") + 1
+            remainder = block[cut:]
+            vertices, faces = _parse_obj_block(block[:cut])
+            vertex_blocks.append(vertices)
+            face_blocks.append(faces)
+    vertices, faces = _parse_obj_block(remainder + b"\n")
+    vertex_blocks.append(vertices)
+    face_blocks.append(faces)
+    faces = np.concatenate(face_blocks) - 1
+    if np.any(faces < 0):
+        raise ValueError("Relative (negative) vertex indices are not supported.")
+    return np.concatenate(vertex_blocks), faces
+
+
+def _face_components(
+    num_vertices: int, faces: FaceArray
+) -> Tuple[npt.NDArray[np.int_], int]:
+    """
+    Label the connected components of the graph of edges of the mesh.
+
+    :return: A pair (labels, k), where k is the number of connected components and \
+        `labels` gives the component of each vertex, numbered from 0 to k-1 in the \
+        order of their lowest vertex. Vertices which lie on no face are labelled -1.
+    """
+    used = np.zeros(num_vertices, dtype=bool)
+    used[faces.ravel()] = True
+    adjacency = sparse.coo_matrix(
+        (
+            np.ones(faces.size, dtype=np.int8),
+            (faces.ravel(), np.roll(faces, 1, axis=1).ravel()),
+        ),
+        shape=(num_vertices, num_vertices),
+    )
+    _, labels = csgraph.connected_components(adjacency, directed=False)
+    _, first, inverse = np.unique(labels[used], return_index=True, return_inverse=True)
+    rank = np.empty_like(first)
+    rank[np.argsort(first)] = np.arange(first.shape[0])
+    labels = np.full(num_vertices, -1, dtype=np.int_)
+    labels[used] = rank[inverse]
+    return labels, first.shape[0]
+
+
+def _find_root(parent: List[int], node: int) -> int:
+    """
+    Return the root of `node` in the union-find forest `parent`, halving the path.
+    """
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+def _nearest_outside(
+    vertices: VertexArray,
+    used: npt.NDArray[np.int_],
+    tree: cKDTree,
+    vertex_group: npt.NDArray[np.int_],
+    num_groups: int,
+    known: npt.NDArray[np.int_],
+    reach: npt.NDArray[np.float_],
+) -> Tuple[npt.NDArray[np.float_], npt.NDArray[np.int_], npt.NDArray[np.int_]]:
+    """
+    For each group of vertices, find the shortest segment from a vertex of the group \
+    to a vertex outside of it.
+
+    :param used: The indices of the vertices to consider.
+    :param tree: A KD-tree of `vertices[used]`.
+    :param vertex_group: The group of each vertex in `used`, from 0 to num_groups-1. \
+        There must be at least two groups.
+    :param known: For each vertex in `used`, how many of its nearest neighbors \
+        (itself included) are known to be in its group. Groups only grow, so this \
+        is kept between calls, and updated in place.
+    :param reach: The distance from each vertex in `used` to the last of these \
+        neighbors, updated in place.
+    :return: Arrays (d, u, v), where the shortest segment from group g to the other \
+        groups runs from vertex u[g] of the group to vertex v[g] outside of it.
+    """
+    best_d = np.full(num_groups, np.inf)
+    best_u = np.zeros(num_groups, dtype=np.int_)
+    best_v = np.zeros(num_groups, dtype=np.int_)
+    sizes = np.bincount(vertex_group, minlength=num_groups)
+    largest = int(np.argmax(sizes))
+    active = np.arange(used.shape[0])
+    if 2 * sizes[largest] > used.shape[0]:
+        # Most neighbors of a vertex of the largest group are in the group, so the
+        # other vertices are queried against a KD-tree of the group instead.
+        inside = vertex_group == largest
+        dist, nearest = cKDTree(vertices[used[inside]]).query(vertices[used[~inside]])
+        i = int(np.argmin(dist))
+        best_d[largest] = dist[i]
+        best_u[largest] = used[inside][nearest[i]]
+        best_v[largest] = used[~inside][i]
+        active = active[~inside]
+    # Query twice as many neighbors of each vertex as are known to be in its group,
+    # until it either has a neighbor outside its group or its neighbors are further
+    # away than the best segment found for its group so far. The vertices with the
+    # fewest known neighbors are queried first, as they are the cheapest.
+    while active.shape[0] > 0:
+        num_neighbors = np.minimum(np.maximum(2 * known[active], 2), used.shape[0])
+        k = int(num_neighbors.min())
+        batch, rest = active[num_neighbors == k], active[num_neighbors != k]
+        dist, neighbors = tree.query(vertices[used[batch]], k=k)
+        outside = vertex_group[neighbors] != vertex_group[batch][:, np.newaxis]
+        has_outside = outside.any(axis=1)
+        first = np.where(has_outside, np.argmax(outside, axis=1), k)
+        known[batch] = first
+        reach[batch] = np.where(
+            first > 0, dist[np.arange(batch.shape[0]), np.maximum(first - 1, 0)], 0.0
+        )
+        found = np.flatnonzero(has_outside)
+        found_d = dist[found, first[found]]
+        found_group = vertex_group[batch[found]]
+        # The shortest segment found for each group comes first.
+        order = np.lexsort((found_d, found_group))
+        _, shortest = np.unique(found_group[order], return_index=True)
+        shortest = order[shortest]
+        improved = shortest[found_d[shortest] < best_d[found_group[shortest]]]
+        rows, groups = found[improved], found_group[improved]
+        best_d[groups] = found_d[improved]
+        best_u[groups] = used[batch[rows]]
+        best_v[groups] = used[neighbors[rows, first[rows]]]
+        active = np.concatenate((batch[~has_outside], rest))
+        active = active[reach[active] < best_d[vertex_group[active]]]
+    return best_d, best_u, best_v
+
+
+def _component_bridges(
+    vertices: VertexArray, labels: npt.NDArray[np.int_], num_components: int
+) -> Tuple[npt.NDArray[np.int_], npt.NDArray[np.int_], npt.NDArray[np.float_]]:
+    """
+    Find line segments between vertices of different components, of minimal total \
+    length, such that the components together with the segments form a connected graph.
+
+    The segments are found with Boruvka's algorithm. In each round, every group of \
+    already connected components is joined to the group of its nearest vertex \
+    outside of it, so that the number of groups is at least halved.
+
+    :return: Arrays (u, v, d) of the endpoints of the num_components - 1 segments \
+        and their lengths.
+    """
+    used = np.flatnonzero(labels >= 0)
+    tree = cKDTree(vertices[used])
+    known = np.zeros(used.shape[0], dtype=np.int_)
+    reach = np.zeros(used.shape[0])
+    # The group of connected components which each component belongs to.
+    group = np.arange(num_components)
+    u: List[int] = []
+    v: List[int] = []
+    d: List[float] = []
+    while len(u) < num_components - 1:
+        num_groups = int(group.max()) + 1
+        best_d, best_u, best_v = _nearest_outside(
+            vertices, used, tree, group[labels[used]], num_groups, known, reach
+        )
+        parent = list(range(num_groups))
+        for g in np.argsort(best_d, kind="stable"):
+            a = _find_root(parent, group[labels[best_u[g]]])
+            b = _find_root(parent, group[labels[best_v[g]]])
+            # Two groups may have chosen the same segment, or segments of equal length
+            # which would close a cycle.
+            if a != b:
+                parent[a] = b
+                u.append(int(best_u[g]))
+                v.append(int(best_v[g]))
+                d.append(float(best_d[g]))
+        roots = np.array([_find_root(parent, g) for g in range(num_groups)])
+        _, group = np.unique(roots[group], return_inverse=True)
+    return np.array(u, dtype=np.int_), np.array(v, dtype=np.int_), np.array(d)
 
 
 def connect_mesh(vertices: VertexArray, faces: FaceArray) -> FaceArray:
@@ -83,72 +362,43 @@ def connect_mesh(vertices: VertexArray, faces: FaceArray) -> FaceArray:
         original faces array; the mesh represented by (vertices, new_faces) is \
         connected.
     """
-
-    mesh = trimesh.Trimesh(vertices=vertices, faces=faces)
-    # The nodes of "graph" are natural numbers which are array indices for the array "vertices".
-    graph = trimesh.graph.vertex_adjacency_graph(mesh)
-    # The elements of connected_components[k] are nodes from "graph", i.e.,
-    # natural number array indices.
-    connected_components: List[Set[int]] = [
-        i[1] for i in enumerate(nx.connected_components(graph))
-    ]
-    if len(connected_components) == 1:
+    labels, num_components = _face_components(vertices.shape[0], faces)
+    if num_components <= 1:
         return faces
 
-    # We build a graph spt_graph whose nodes are connected components,
-    # represented as integer indices for the list connected_components.
-    spt_graph = nx.Graph()
-
-    # spt_graph is a weighted graph; the weight between components i and j is the
-    # minimum distance in 3D space from a node in connected_components[i] to a node
-    # in connected_components[j].
-
-    # Then, we form a minimum spanning tree T for spt_graph. If T contains an
-    # edge between i and j, we add a new face to the mesh connecting components
-    # i and j.  If there are k connected components of the mesh to begin with,
-    # then a total of k-1 new faces will be added to the mesh
-
-    # We build a a minimum spanning tree of edges I can add between components
-
-    # connections will associate to each pair of components i, j a new face
-    # straddling the two components.  Not all new faces in "connections" will
-    # be added to the mesh - only the ones that lie along an edge in the
-    # minimal spanning tree.
-    connections: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
-
-    # Add components as nodes in graph
-    for i in range(len(connected_components)):
-        spt_graph.add_node(i)
-    # For every pair of components, find nearest points
-    for i in range(len(connected_components)):
-        for j in range(i + 1, len(connected_components)):
-            # Set bigger component as reference so we can make KDTree of that and loop over smaller
-            ref, query = (
-                (i, j)
-                if len(connected_components[i]) > len(connected_components[j])
-                else (j, i)
-            )
-            ref_ids = list(connected_components[ref])
-            query_ids = list(connected_components[query])
-            # dist_ij is a rectangular matrix of floats.
-            # dist_ij[i, j] is the distance between the i-th node of component ref_ids
-            # and the j-th node of query_ids.
-            dist_ij = cdist(vertices[ref_ids], vertices[query_ids])
-            nearest: Tuple[int, int]
-            nearest = np.unravel_index(dist_ij.argmin(), dist_ij.shape)  # type: ignore[assignment]
-            next_nearest = np.argpartition(dist_ij[nearest[0]], 1)[1]
-            face: Tuple[int, int, int] = (
-                ref_ids[nearest[0]],
-                query_ids[nearest[1]],
-                query_ids[next_nearest],
-            )
-            # Save face so I know to add it if this edge is in SPT
-            connections[(i, j)] = face
-            spt_graph.add_edge(i, j, weight=dist_ij[nearest])
+    # We form a minimum spanning tree T of the graph whose nodes are the connected
+    # components, where the weight between components i and j is the minimum distance
+    # in 3D space between them. If T contains an edge between i and j, we add a new
+    # face to the mesh connecting components i and j.  If there are k connected
+    # components of the mesh to begin with, then a total of k-1 new faces will be
+    # added to the mesh.
+    u, v, _ = _component_bridges(vertices, labels, num_components)
+    vertex_order = np.argsort(labels, kind="stable")
+    vertex_order = vertex_order[labels[vertex_order] >= 0]
+    sizes = np.bincount(labels[vertex_order], minlength=num_components)
+    members = np.split(vertex_order, np.cumsum(sizes)[:-1])
+    trees: Dict[int, cKDTree] = {}
     new_faces: List[Tuple[int, int, int]] = []
-    for u, v, _ in nx.minimum_spanning_edges(spt_graph):
-        new_faces.append(connections[(min(u, v), max(u, v))])
-    return np.vstack([faces, np.array(new_faces)])
+    for ref, query in zip(u, v):
+        # As the third vertex of the face take the next nearest vertex to `ref` in
+        # the component of `query`, preferring the smaller of the two components.
+        if sizes[labels[ref]] < sizes[labels[query]]:
+            ref, query = query, ref
+        component = labels[query]
+        if sizes[component] == 1:
+            ref, query = query, ref
+            component = labels[query]
+        if sizes[component] == 1:
+            new_faces.append((ref, query, query))
+            continue
+        if component not in trees:
+            trees[component] = cKDTree(vertices[members[component]])
+        _, nearest = trees[component].query(vertices[ref], k=2)
+        next_nearest = int(members[component][nearest[1]])
+        if next_nearest == query:
+            next_nearest = int(members[component][nearest[0]])
+        new_faces.append((ref, query, next_nearest))
+    return np.vstack([faces, np.array(new_faces, dtype=faces.dtype)])
 
 
 def disconnect_mesh(
@@ -158,6 +408,10 @@ def disconnect_mesh(
     Returns the list of connected submeshes of the given mesh, as\
      ordered pairs (vertices_i, faces_i).
 
+    The components are listed in the order of their first vertex in `vertices`, \
+    and the vertices of each component are kept in their original order. \
+    Vertices which lie on no face are discarded.
+
     Args:
         * vertices (VertexArray) : vertices of the mesh
         * faces (FaceArray): faces of the mesh
@@ -166,26 +420,28 @@ def disconnect_mesh(
         * List of ordered pairs (vertices_i, faces_i) corresponding to \
           the connected components of the original mesh
     """
-    mesh = trimesh.Trimesh(vertices=vertices, faces=faces)
-    graph = trimesh.graph.vertex_adjacency_graph(mesh)
-    connected_components = [i[1] for i in enumerate(nx.connected_components(graph))]
-    if len(connected_components) == 1:
+    labels, num_components = _face_components(vertices.shape[0], faces)
+    if num_components <= 1:
         return [(vertices, faces)]
 
-    disconn_meshes = []
-    for component in connected_components:
-        v_ids = list(component)
-        new_vertices = vertices[v_ids]
-        index = np.min(faces)
-        v_ids = [v_id + index for v_id in v_ids]
-        keep_faces = faces[np.sum(np.isin(faces, v_ids), axis=1) == 3]
-        convert_ids = dict(zip(v_ids, range(index, len(v_ids) + index)))
-        new_faces = np.array([convert_ids[x] for x in keep_faces.flatten()]).reshape(
-            keep_faces.shape
+    vertex_order = np.argsort(labels, kind="stable")
+    vertex_order = vertex_order[labels[vertex_order] >= 0]
+    sizes = np.bincount(labels[vertex_order], minlength=num_components)
+    # The index of each vertex in the vertex array of its component.
+    position = np.zeros(vertices.shape[0], dtype=faces.dtype)
+    position[vertex_order] = np.arange(vertex_order.shape[0]) - np.repeat(
+        np.cumsum(sizes) - sizes, sizes
+    )
+    face_labels = labels[faces[:, 0]]
+    face_order = np.argsort(face_labels, kind="stable")
+    face_sizes = np.bincount(face_labels, minlength=num_components)
+    return [
+        (vertices[vertex_ids], position[faces[face_ids]])
+        for vertex_ids, face_ids in zip(
+            np.split(vertex_order, np.cumsum(sizes)[:-1]),
+            np.split(face_order, np.cumsum(face_sizes)[:-1]),
         )
-        disconn_meshes.append((new_vertices, new_faces))
-
-    return disconn_meshes
+    ]
 
 
 def cell_generator(
@@ -219,26 +475,194 @@ def cell_generator(
             yield (os.path.splitext(file_name)[0], vertices, faces)
 
 
-def sample_vertices(vertices: VertexArray, n_sample: int) -> Optional[VertexArray]:
+def vertex_areas(vertices: VertexArray, faces: FaceArray) -> npt.NDArray[np.float_]:
+    """
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face
+    :return: The area of the surface around each vertex, i.e., one third of the total \
+        area of the faces which contain it. Vertices which lie on no face have area 0.
+    """
+    face_areas = 0.5 * np.linalg.norm(
+        np.cross(
+            vertices[faces[:, 1]] - vertices[faces[:, 0]],
+            vertices[faces[:, 2]] - vertices[faces[:, 0]],
+        ),
+        axis=1,
+    )
+    return np.bincount(
+        faces.ravel(),
+        weights=np.repeat(face_areas / 3, 3),
+        minlength=vertices.shape[0],
+    )
+
+
+def sample_vertex_indices(
+    vertices: VertexArray,
+    faces: Optional[FaceArray],
+    n_sample: int,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
+) -> Optional[npt.NDArray[np.int_]]:
+    """
+    Choose `n_sample` distinct vertices of the mesh.
+
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face. Only required for \
+        the "area" sampling method; if it is given, vertices which lie on no face are \
+        never sampled by the "area" and "farthest" methods.
+    :param n_sample: number of vertices to sample
+    :param sampling: How to choose the vertices.
+        The "even" method takes evenly spaced indices into the vertex array, so its \
+        result depends on the order of the vertices in the file.
+        The "area" method samples vertices at random without replacement, with \
+        probabilities proportional to their :func:`cajal.sample_mesh.vertex_areas`, \
+        so that the sample is spread uniformly over the surface.
+        The "farthest" method starts from a random vertex and repeatedly adds the vertex \
+        farthest (in Euclidean distance) from the vertices already chosen. \
+        This spreads the sample points most evenly, so that fewer of them are needed \
+        to represent the shape of the cell equally well.
+    :param seed: The seed of the random number generator used by the "area" and \
+        "farthest" methods, so that the sample is reproducible.
+    :return: None, if there are fewer vertices which may be sampled than points to \
+        sample. Otherwise, a numpy array of `n_sample` vertex indices.
+    """
+    if sampling == "even":
+        if vertices.shape[0] < n_sample:
+            warnings.warn("Fewer vertices than points to sample, skipping")
+            return None
+        return np.linspace(0, vertices.shape[0] - 1, n_sample).astype("uint32")
+    if sampling == "area":
+        if faces is None:
+            raise ValueError("Area-weighted sampling requires the faces of the mesh.")
+        weights = vertex_areas(vertices, faces)
+    elif sampling == "farthest":
+        weights = np.ones(vertices.shape[0])
+        if faces is not None:
+            weights[np.setdiff1d(np.arange(vertices.shape[0]), faces)] = 0.0
+    else:
+        raise ValueError("Sampling must be one of 'even', 'area' or 'farthest'.")
+    candidates = np.flatnonzero(weights > 0)
+    if candidates.shape[0] < n_sample:
+        warnings.warn("Fewer vertices than points to sample, skipping")
+        return None
+    rng = np.random.default_rng(seed)
+    if sampling == "area":
+        # Weighted sampling without replacement (Efraimidis and Spirakis): keep the
+        # n_sample smallest exponential variates scaled down by the weights.
+        keys = rng.exponential(size=candidates.shape[0]) / weights[candidates]
+        return np.sort(candidates[np.argpartition(keys, n_sample - 1)[:n_sample]])
+    points = vertices[candidates]
+    sample = np.empty(n_sample, dtype=np.int_)
+    sample[0] = rng.integers(candidates.shape[0])
+    min_dist = np.sum((points - points[sample[0]]) ** 2, axis=1)
+    min_dist[sample[0]] = -np.inf
+    for i in range(1, n_sample):
+        sample[i] = np.argmax(min_dist)
+        np.minimum(
+            min_dist, np.sum((points - points[sample[i]]) ** 2, axis=1), out=min_dist
+        )
+        min_dist[sample[i]] = -np.inf
+    return candidates[sample]
+
+
+def sample_vertices(
+    vertices: VertexArray,
+    n_sample: int,
+    faces: Optional[FaceArray] = None,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
+) -> Optional[VertexArray]:
     """
-    Evenly samples n vertices. Most .obj vertices are ordered \
-    counter-clockwise, so evenly sampling from vertex matrix \
-    can roughly approximate even sampling across the mesh
+    Sample n vertices, by default evenly spaced in the vertex matrix. Most .obj \
+    vertices are ordered counter-clockwise, so evenly sampling from vertex matrix \
+    can roughly approximate even sampling across the mesh. For the other sampling \
+    methods see :func:`cajal.sample_mesh.sample_vertex_indices`.
 
     :param vertices: 3D coordinates for vertices
     :param n_sample: number of vertices to sample
+    :param faces: row of vertices contained in each face, required for "area" sampling
+    :param sampling: How to choose the vertices, one of "even", "area" or "farthest".
+    :param seed: The seed for the "area" and "farthest" sampling methods.
     :return: None, if there are fewer vertices than points to sample. \
     Otherwise, a numpy array of sampled vertices, of shape (n_sample, 3).
     """
+    sample = sample_vertex_indices(vertices, faces, n_sample, sampling, seed)
+    return None if sample is None else vertices[sample, :]
 
-    if vertices.shape[0] < n_sample:
-        warnings.warn("Fewer vertices than points to sample, skipping")
-        return None
-    return vertices[np.linspace(0, vertices.shape[0] - 1, n_sample).astype("uint32"), :]
+
+# The heat method solvers of the most recently used meshes, keyed by the contents of the
+# mesh, so that computing distances for several sets of sample points on the same mesh
+# factors its matrices only once.
+_HEAT_SOLVER_CACHE_SIZE = 4
+_heat_solvers: OrderedDict[bytes, pp3d.MeshHeatMethodDistanceSolver] = OrderedDict()
+
+
+def _mesh_key(vertices: VertexArray, faces: FaceArray) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for arr in (vertices, faces):
+        arr = np.ascontiguousarray(arr)
+        digest.update(str((arr.dtype, arr.shape)).encode())
+        digest.update(arr.data)
+    return digest.digest()
+
+
+def heat_solver(
+    vertices: VertexArray, faces: FaceArray
+) -> pp3d.MeshHeatMethodDistanceSolver:
+    """
+    Return a heat method distance solver for the mesh. Constructing the solver \
+    factors the Laplacian of the mesh, which is the bulk of the cost of the heat \
+    method; the solvers for the last few meshes are cached, so that they are \
+    reused if this is called again with a mesh with the same vertices and faces.
+
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face
+    """
+    key = _mesh_key(vertices, faces)
+    solver = _heat_solvers.pop(key, None)
+    if solver is None:
+        solver = pp3d.MeshHeatMethodDistanceSolver(vertices, faces)
+    _heat_solvers[key] = solver
+    while len(_heat_solvers) > _HEAT_SOLVER_CACHE_SIZE:
+        _heat_solvers.popitem(last=False)
+    return solver
+
+
+def heat_geodesic_distances(
+    vertices: VertexArray,
+    faces: FaceArray,
+    sample: npt.NDArray[np.int_],
+) -> npt.NDArray[np.float_]:
+    """
+    Compute the pairwise geodesic distances between the vertices `sample` with the \
+    heat method, using the cached solver from :func:`cajal.sample_mesh.heat_solver`.
+    The heat method is not exactly symmetric, so the distance between two vertices is \
+    taken to be the larger of the distances computed from either one.
+
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face
+    :param sample: indices of the vertices between which to compute the distances
+    :return: A square matrix of shape (len(sample), len(sample)).
+    """
+    solver = heat_solver(vertices, faces)
+    sources, inverse = np.unique(sample, return_inverse=True)
+    dist_mat = np.empty((sources.shape[0], sources.shape[0]), dtype=np.float64)
+    for i, source in enumerate(sources):
+        dist_mat[i] = solver.compute_distance(source)[sources]
+    upper = np.triu_indices(sources.shape[0], 1)
+    symmetric = np.maximum(dist_mat[upper], dist_mat.T[upper])
+    dist_mat[upper] = symmetric
+    dist_mat.T[upper] = symmetric
+    np.fill_diagonal(dist_mat, 0.0)
+    return dist_mat[np.ix_(inverse, inverse)]
 
 
 def get_geodesic_heat_one_mesh(
-    vertices: VertexArray, faces: FaceArray, n_sample: int
+    vertices: VertexArray,
+    faces: FaceArray,
+    n_sample: int,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
 ) -> Optional[npt.NDArray[np.float_]]:
     r"""
     Given a mesh, randomly sample n_sample points from the mesh, \
@@ -254,25 +678,99 @@ def get_geodesic_heat_one_mesh(
     :param vertices: 3D coordinates for vertices
     :param faces: row of vertices contained in each face
     :param n_sample: number of vertices to sample
+    :param sampling: How to choose the vertices, see \
+        :func:`cajal.sample_mesh.sample_vertex_indices`.
+    :param seed: The seed for the "area" and "farthest" sampling methods.
 
     :return: heat geodesic distance in vector form, of shape \
         (n_sample \* (n_sample - 1)/2, 1)
     """
-    if vertices.shape[0] < n_sample:
-        warnings.warn("Fewer vertices than points to sample, skipping")
-        return None
-    even_sample = np.linspace(0, vertices.shape[0] - 1, n_sample).astype("uint32")
-    solver = pp3d.MeshHeatMethodDistanceSolver(vertices, faces)
-    dist_mat = solver.compute_distance(even_sample[0])[even_sample]
-    for i in range(1, len(even_sample)):
-        dist_mat = np.c_[dist_mat, solver.compute_distance(even_sample[i])[even_sample]]
-    dist_mat = np.maximum(dist_mat, dist_mat.T)  # symmetrize
-    dist_vec = squareform(dist_mat)
-    return dist_vec
+    return get_geodesic_heat_multi(vertices, faces, [n_sample], sampling, seed)[0]
+
+
+def get_geodesic_heat_multi(
+    vertices: VertexArray,
+    faces: FaceArray,
+    n_samples: Sequence[int],
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
+) -> List[Optional[npt.NDArray[np.float_]]]:
+    """
+    Compute the heat geodesic intracell distance matrices of a mesh for several numbers \
+    of sample points at once, as by :func:`cajal.sample_mesh.get_geodesic_heat_one_mesh`. \
+    The mesh is factored once, and the distances from each vertex which is sampled \
+    for more than one resolution are computed once.
+
+    :param n_samples: The numbers of vertices to sample.
+    :param sampling: How to choose the vertices, see \
+        :func:`cajal.sample_mesh.sample_vertex_indices`.
+    :param seed: The seed for the "area" and "farthest" sampling methods.
+    :return: A list containing, for each element of `n_samples`, the heat geodesic \
+        distance in vector form, or None if there are fewer vertices than points to sample.
+    """
+    samples = [
+        sample_vertex_indices(vertices, faces, n_sample, sampling, seed)
+        for n_sample in n_samples
+    ]
+    all_samples = [sample for sample in samples if sample is not None]
+    if not all_samples:
+        return [None] * len(samples)
+    sources = np.unique(np.concatenate(all_samples))
+    dist_mat = heat_geodesic_distances(vertices, faces, sources)
+    dist_vecs: List[Optional[npt.NDArray[np.float_]]] = []
+    for sample in samples:
+        if sample is None:
+            dist_vecs.append(None)
+        else:
+            index = np.searchsorted(sources, sample)
+            dist_vecs.append(squareform(dist_mat[np.ix_(index, index)], checks=False))
+    return dist_vecs
+
+
+def mesh_graph(vertices: VertexArray, faces: FaceArray) -> sparse.csr_matrix:
+    """
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face
+    :return: The sparse adjacency matrix of the edges of the mesh, weighted by their \
+        lengths. Each edge is stored once, from the lower to the higher vertex index.
+    """
+    edges = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    weights = np.linalg.norm(vertices[edges[:, 0]] - vertices[edges[:, 1]], axis=1)
+    return sparse.csr_matrix(
+        (weights, (edges[:, 0], edges[:, 1])),
+        shape=(vertices.shape[0], vertices.shape[0]),
+    )
+
+
+def graph_geodesic_distances(
+    vertices: VertexArray,
+    faces: FaceArray,
+    sample: npt.NDArray[np.int_],
+) -> npt.NDArray[np.float_]:
+    """
+    Compute the pairwise distances between the vertices `sample` along the \
+    (distance-weighted) graph of edges of the mesh, with one multi-source run \
+    of Dijkstra's algorithm.
+
+    :param vertices: 3D coordinates for vertices
+    :param faces: row of vertices contained in each face
+    :param sample: indices of the vertices between which to compute the distances
+    :return: A square matrix of shape (len(sample), len(sample)). Vertices in \
+        different connected components of the mesh are at infinite distance.
+    """
+    dist_mat = csgraph.dijkstra(
+        mesh_graph(vertices, faces), directed=False, indices=sample
+    )[:, sample]
+    return np.minimum(dist_mat, dist_mat.T)
 
 
 def get_geodesic_networkx_one_mesh(
-    vertices: VertexArray, faces: FaceArray, n_sample: int
+    vertices: VertexArray,
+    faces: FaceArray,
+    n_sample: int,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
 ) -> Optional[npt.NDArray[np.float_]]:
     """
     Given a mesh, randomly sample n_sample points from the \
@@ -284,32 +782,24 @@ def get_geodesic_networkx_one_mesh(
     :param vertices: 3D coordinates for vertices
     :param faces: row of vertices contained in each face
     :param n_sample: number of vertices to sample
+    :param sampling: How to choose the vertices, see \
+        :func:`cajal.sample_mesh.sample_vertex_indices`.
+    :param seed: The seed for the "area" and "farthest" sampling methods.
     :return: graph geodesic distance in vector form
     """
-    if vertices.shape[0] < n_sample:
-        warnings.warn("Fewer vertices than points to sample, skipping")
+    sample = sample_vertex_indices(vertices, faces, n_sample, sampling, seed)
+    if sample is None:
         return None
-    graph = nx.Graph()
-    for i in range(vertices.shape[0]):
-        graph.add_node(i)
-    for i in range(faces.shape[0]):
-        for edge_id in [(0, 1), (1, 2), (2, 0)]:
-            v1 = faces[i, edge_id[0]]
-            v2 = faces[i, edge_id[1]]
-            graph.add_edge(v1, v2, weight=euclidean(vertices[v1], vertices[v2]))
-    even_sample = np.linspace(0, vertices.shape[0] - 1, n_sample).astype("uint32")
-    arguments = list(it.combinations(even_sample, 2))
-    dist_vec = np.zeros(len(arguments))
-    for i in range(len(arguments)):
-        pair = arguments[i]
-        dist_vec[i] = nxsp.generic.shortest_path_length(
-            graph, source=pair[0], target=pair[1], weight="weight"
-        )
-    return dist_vec
+    return squareform(graph_geodesic_distances(vertices, faces, sample), checks=False)
 
 
 def get_geodesic(
-    vertices: VertexArray, faces: FaceArray, n_sample: int, method: str
+    vertices: VertexArray,
+    faces: FaceArray,
+    n_sample: int,
+    method: str,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
 ) -> Optional[npt.NDArray[np.float_]]:
     """
     Sample `n_sample` many points and compute an intracell distance matrix of pairwise \
@@ -317,9 +807,9 @@ def get_geodesic(
     """
 
     if method == "networkx":
-        return get_geodesic_networkx_one_mesh(vertices, faces, n_sample)
+        return get_geodesic_networkx_one_mesh(vertices, faces, n_sample, sampling, seed)
     elif method == "heat":
-        return get_geodesic_heat_one_mesh(vertices, faces, n_sample)
+        return get_geodesic_heat_one_mesh(vertices, faces, n_sample, sampling, seed)
 
     raise Exception("Invalid method, must be one of 'networkx' or 'heat'")
 
@@ -335,43 +825,58 @@ def compute_intracell_all(
     infolder: str,
     n_sample: int,
     metric: Literal["euclidean"] | Literal["geodesic"],
-    pool: ProcessPool,
+    executor: Executor,
     segment: bool = True,
     method: Literal["networkx"] | Literal["heat"] = "networkx",
-) -> Iterator[Tuple[str, Optional[npt.NDArray[np.float_]]]]:
-    if metric == "geodesic" and not segment:
-        cell_gen = pool.imap(
-            _connect_helper, cell_generator(infolder, segment), chunksize=1
-        )
-    else:
-        cell_gen = cell_generator(infolder, segment)
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
+) -> Iterator[Tuple[str, Optional[npt.NDArray[np.float_]] | Err[TaskFailure]]]:
+    """
+    Compute the intracell distance matrices of all cells in `infolder`, in parallel.
+    For the parameters see :func:`cajal.sample_mesh.compute_icdm_all`.
+
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        Its backend must be able to run closures, i.e. not "processes" or "cluster".
+    :return: An iterator over pairs (cell_name, icdm), where icdm is a vectorform
+        intracell distance matrix, or an `Err` wrapping the
+        :class:`cajal.parallel.TaskFailure` if the computation failed for that cell.
+    """
+    cell_gen = cell_generator(infolder, segment)
 
+    compute_icdm: Callable[
+        [Tuple[str, VertexArray, FaceArray]],
+        Tuple[str, Optional[npt.NDArray[np.float_]]],
+    ]
     if metric == "geodesic":
-        chunksize = 1 if method == "networkx" else 20
-        compute_geodesic: Callable[
-            [Tuple[str, VertexArray, FaceArray]],
-            Tuple[str, Optional[npt.NDArray[np.float_]]],
-        ]
+        chunksize = 20
 
-        def compute_geodesic(
+        def compute_icdm(
             t: tuple[str, VertexArray, FaceArray]
         ) -> tuple[str, Optional[npt.NDArray[np.float_]]]:
-            return t[0], get_geodesic(t[1], t[2], n_sample, method)
+            if not segment:
+                t = _connect_helper(t)
+            return t[0], get_geodesic(t[1], t[2], n_sample, method, sampling, seed)
 
-        # compute_geodesic = lambda t: (t[0], get_geodesic(t[1], t[2], n_sample, method))
-        return pool.imap(compute_geodesic, cell_gen, chunksize=chunksize)
+    elif metric == "euclidean":
+        chunksize = 1000
 
-    # metric is not "geodesic".
-    if metric == "euclidean":
-        pt_clouds = pool.imap(
-            lambda t: (t[0], sample_vertices(t[1], n_sample)), cell_gen, chunksize=1000
-        )
-        return pool.imap(
-            lambda t: (t[0], None if t[1] is None else pdist(t[1])),
-            pt_clouds,
-            chunksize=1000,
-        )
-    raise Exception("Metric should be either 'geodesic' or 'euclidean'")
+        def compute_icdm(
+            t: tuple[str, VertexArray, FaceArray]
+        ) -> tuple[str, Optional[npt.NDArray[np.float_]]]:
+            pt_cloud = sample_vertices(t[1], n_sample, t[2], sampling, seed)
+            return t[0], None if pt_cloud is None else pdist(pt_cloud)
+
+    else:
+        raise Exception("Metric should be either 'geodesic' or 'euclidean'")
+
+    # The cells are generated lazily, so the executor cannot size the chunks itself.
+    results = executor.imap(
+        compute_icdm, cell_gen, chunksize=executor.chunksize or chunksize
+    )
+    return (
+        (result.item[0], Err(result)) if isinstance(result, TaskFailure) else result
+        for result in results
+    )
 
 
 def compute_icdm_all(
@@ -382,6 +887,10 @@ def compute_icdm_all(
     num_processes: int = 8,
     segment: bool = True,
     method: Literal["networkx"] | Literal["heat"] = "heat",
+    executor: Optional[Executor] = None,
+    sampling: Literal["even"] | Literal["area"] | Literal["farthest"] = "even",
+    seed: int = 0,
+    binary: Optional[BinaryFormat] = None,
 ) -> List[str]:
     r"""
     Go through every Wavefront \*.obj file in the given input directory `infolder`
@@ -396,11 +905,12 @@ def compute_icdm_all(
     :param num_processes: Number of independent processes which will be created.
         Recommended to set this equal to the number of cores on your machine.
     :param method: How to compute geodesic distance.
-        The "networkx" method is more precise, and takes between 5 - 15 seconds for
-        a cell with 50 sample points. The "heat" method is a faster but rougher
-        approximation, and takes between 0.05 - 0.15 seconds for a cell with
-        50 sample points. This flag is not relevant if the user is sampling
-        Euclidean distances.
+        The "networkx" method computes the exact shortest path distances
+        along the edges of the mesh (with :func:`scipy.sparse.csgraph.dijkstra`,
+        despite the name). The "heat" method approximates the geodesic distances
+        along the surface with the heat method. Both take on the order of 0.1
+        seconds for a cell with 50 sample points. This flag is not relevant if the
+        user is sampling Euclidean distances.
     :param segment: If `segment` is True, each \*.obj file will be segmented into its
         set of connected components before being returned, so an \*.obj file with multiple
         connected components will be understood to contain multiple distinct cells.
@@ -412,15 +922,29 @@ def compute_icdm_all(
         is warned that this imputing of data carries the same consequences with regard
         to scientific interpretation of the results as any other kind of data imputation
         for incomplete data sets.
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored; it must be able to run closures, so
+        its backend should not be "processes" or "cluster". By default a "dill"
+        backend with `num_processes` workers is used. If its `on_error` is
+        "return", the cells for which the computation raised an exception are
+        also returned, paired with the error.
+    :param sampling: How to choose the sample points among the vertices of each cell,
+        one of "even", "area" or "farthest", see
+        :func:`cajal.sample_mesh.sample_vertex_indices`. The "area" and "farthest"
+        methods do not depend on the order of the vertices in the file and spread the
+        points more evenly over the surface, so that a smaller `n_sample` suffices.
+    :param seed: The seed for the "area" and "farthest" sampling methods.
+    :param binary: If given, the matrices are written to `out_csv` in the binary
+        container it describes rather than as CSV, see
+        :func:`cajal.utilities.write_csv_block`.
     :return: Names of cells for which sampling failed because the cells have
         fewer than `n_sample` points.
     """
 
-    pool = ProcessPool(nodes=num_processes)
-    dist_mats = compute_intracell_all(infolder, n_sample, metric, pool, segment, method)
+    executor = default_executor(executor, num_processes, "dill")
+    dist_mats = compute_intracell_all(
+        infolder, n_sample, metric, executor, segment, method, sampling, seed
+    )
     batch_size = 1000
-    failed_cells = write_csv_block(out_csv, n_sample, dist_mats, batch_size)
-    pool.close()
-    pool.join()
-    pool.clear()
+    failed_cells = write_csv_block(out_csv, n_sample, dist_mats, batch_size, binary)
     return failed_cells
@@ -1,15 +1,232 @@
 # Functions for sampling points from a 2D segmented image
+import functools
 import os
+import tempfile
 import warnings
-from typing import List, Iterator, Tuple
+from typing import Iterable, List, Iterator, Literal, Optional, Tuple, Union
 import numpy as np
 import numpy.typing as npt
+from scipy import ndimage
 from skimage import measure
 import tifffile
 from scipy.spatial.distance import pdist
-import itertools as it
-from pathos.pools import ProcessPool
-from .utilities import write_csv_block
+from .parallel import Executor, TaskFailure, default_executor
+from .utilities import BinaryFormat, Err, write_csv_block
+
+# How many intracell distance matrices are read from a shard file at a time.
+_SHARD_BLOCK_ROWS = 1000
+
+
+def resample_curves(
+    curves: List[npt.NDArray[np.float_]], n_sample: int, closed: bool = True
+) -> npt.NDArray[np.float_]:
+    """
+    Sample points evenly spaced by arc length along a family of polygonal curves.
+    The points are distributed among the curves in proportion to their lengths, \
+    as though the curves were traversed one after the other.
+
+    :param curves: A list of arrays of shape (k_i, d), the vertices of each curve \
+        in order; for example the contours of a cell in a 2D image, or a projection \
+        of a neuron or a mesh to the plane.
+    :param n_sample: How many points to sample.
+    :param closed: Whether each curve returns from its last vertex to its first. \
+        If True, the first sample point is the first vertex and the spacing wraps \
+        around; if False, the first and last vertices of the family are both sampled.
+    :return: An array of shape (n_sample, d).
+    """
+    if closed:
+        curves = [
+            (
+                curve
+                if np.array_equal(curve[0], curve[-1])
+                else np.vstack((curve, curve[:1]))
+            )
+            for curve in curves
+        ]
+    pts = np.concatenate(curves)
+    if pts.shape[0] == 1:
+        return np.repeat(pts, n_sample, axis=0)
+    seg_lengths = np.linalg.norm(np.diff(pts, axis=0), axis=1)
+    # The step from the end of one curve to the start of the next is not traversed.
+    seg_lengths[np.cumsum([curve.shape[0] for curve in curves])[:-1] - 1] = 0.0
+    arc_length = np.concatenate(([0.0], np.cumsum(seg_lengths)))
+    if closed:
+        positions = np.arange(n_sample) * (arc_length[-1] / n_sample)
+    else:
+        positions = np.linspace(0.0, arc_length[-1], n_sample)
+    seg = np.minimum(
+        np.searchsorted(arc_length, positions, side="right") - 1,
+        seg_lengths.shape[0] - 1,
+    )
+    frac = np.divide(
+        positions - arc_length[seg],
+        seg_lengths[seg],
+        out=np.zeros(n_sample),
+        where=seg_lengths[seg] > 0,
+    )
+    return pts[seg] + frac[:, np.newaxis] * (pts[seg + 1] - pts[seg])
+
+
+def open_tiff(file_path: str) -> npt.NDArray[np.int_]:
+    """
+    Open a segmented image without reading it into memory.
+
+    Uncompressed images are memory-mapped directly. Compressed, tiled or stripped
+    images are decoded one tile or strip at a time into a temporary file on disk,
+    which is memory-mapped, so that images larger than the available memory can be
+    processed by :func:`cajal.sample_seg.cell_boundaries` with `strip_rows` set.
+
+    :param file_path: Path to a .tif file.
+    :return: A read-only numpy memmap of the image.
+    """
+    try:
+        return tifffile.memmap(file_path, mode="r")
+    except ValueError:
+        return tifffile.imread(file_path, out="memmap")
+
+
+def _cell_boxes(
+    imarray: npt.NDArray[np.int_], strip_rows: int
+) -> Tuple[npt.NDArray[np.int_], npt.NDArray[np.int_]]:
+    """
+    Find the bounding box of every value in the image, reading `strip_rows` rows of
+    the image at a time.
+
+    :return: A pair (cell_ids, boxes), where `cell_ids` are the distinct values of the
+        image in increasing order and `boxes` is an array of shape (len(cell_ids), 4)
+        whose rows (start row, stop row, start column, stop column) are the bounding
+        boxes of the cells, with exclusive stops.
+    """
+    strip_ids = []
+    strip_boxes = []
+    for start in range(0, imarray.shape[0], strip_rows):
+        strip = np.asarray(imarray[start : start + strip_rows])
+        # Relabel the cells as 0, ..., k-1, so that the bounding boxes of all cells
+        # can be found in one pass with find_objects regardless of the size of the ids.
+        ids, labels = np.unique(strip, return_inverse=True)
+        slices = ndimage.find_objects(
+            labels.reshape(strip.shape) + 1, max_label=ids.shape[0]
+        )
+        strip_ids.append(ids)
+        strip_boxes.append(
+            np.array(
+                [
+                    [rows.start, rows.stop, cols.start, cols.stop]
+                    for rows, cols in slices
+                ]
+            )
+            + [start, start, 0, 0]
+        )
+    if len(strip_ids) == 1:
+        return strip_ids[0], strip_boxes[0]
+    # Merge the boxes of the parts of the cells which span several strips.
+    cell_ids, inverse = np.unique(np.concatenate(strip_ids), return_inverse=True)
+    all_boxes = np.concatenate(strip_boxes)
+    boxes = np.empty((cell_ids.shape[0], 4), dtype=all_boxes.dtype)
+    boxes[:, [0, 2]] = np.iinfo(all_boxes.dtype).max
+    boxes[:, [1, 3]] = np.iinfo(all_boxes.dtype).min
+    for i in [0, 2]:
+        np.minimum.at(boxes[:, i], inverse, all_boxes[:, i])
+    for i in [1, 3]:
+        np.maximum.at(boxes[:, i], inverse, all_boxes[:, i])
+    return cell_ids, boxes
+
+
+def _crop_cells(
+    imarray: npt.NDArray[np.int_], background: int, strip_rows: Optional[int] = None
+) -> Iterator[Tuple[int, npt.NDArray[np.bool_], Tuple[int, int]]]:
+    """
+    Crop each cell which does not touch the border of the image to its bounding box.
+
+    :param strip_rows: If given, the bounding boxes are found reading this many rows
+        of the image at a time, and only the bounding box of each cell is read after
+        that, so that `imarray` may be a memmap of an image larger than memory.
+    :return: An iterator over triples (cell, mask, offset), in increasing order of the
+        cell ids, where `mask` is the boolean mask of the cell in its bounding box
+        grown by one pixel on each side, and `offset` is the position of the top left
+        corner of the box in the image.
+    """
+    height, width = imarray.shape
+    cell_ids, boxes = _cell_boxes(imarray, strip_rows or max(height, 1))
+    # A cell touches the border of the image if and only if its bounding box does.
+    keep = (
+        (cell_ids != background)
+        & (boxes[:, 0] > 0)
+        & (boxes[:, 1] < height)
+        & (boxes[:, 2] > 0)
+        & (boxes[:, 3] < width)
+    )
+    for cell, (row, row_stop, col, col_stop) in zip(cell_ids[keep], boxes[keep]):
+        # Cells which do not touch the border have a margin of at least one pixel.
+        box = np.asarray(imarray[row - 1 : row_stop + 1, col - 1 : col_stop + 1])
+        yield cell, box == cell, (row - 1, col - 1)
+
+
+def _sample_cell_boundary(
+    cell_mask_offset: Tuple[int, npt.NDArray[np.bool_], Tuple[int, int]],
+    n_sample: int,
+    discard_cells_with_holes: bool,
+    only_longest: bool,
+    spacing: Literal["index"] | Literal["arc_length"],
+) -> Optional[npt.NDArray[np.float_]]:
+    cell, mask, offset = cell_mask_offset
+    boundary_pts_list = measure.find_contours(
+        mask.astype(np.float64), 0.5, fully_connected="high"
+    )
+    if discard_cells_with_holes and len(boundary_pts_list) > 1:
+        warnings.warn("More than one boundary for cell " + str(cell))
+        return None
+    if only_longest:
+        boundary_pts_list = [max(boundary_pts_list, key=lambda ell: ell.shape[0])]
+    if spacing == "arc_length":
+        return resample_curves(boundary_pts_list, n_sample) + offset
+    boundary_pts: npt.NDArray[np.float_]
+    if only_longest:
+        boundary_pts = boundary_pts_list[0]
+    else:
+        boundary_pts = np.concatenate(boundary_pts_list)
+    if boundary_pts.shape[0] < n_sample:
+        warnings.warn(
+            "Fewer than "
+            + str(n_sample)
+            + " pixels around boundary of cell "
+            + str(cell)
+        )
+    indices = np.linspace(0, boundary_pts.shape[0] - 1, n_sample)
+    return boundary_pts[indices.astype("uint32")] + offset
+
+
+def _iter_cell_boundaries(
+    imarray: npt.NDArray[np.int_],
+    n_sample: int,
+    background: int,
+    discard_cells_with_holes: bool,
+    only_longest: bool,
+    executor: Optional[Executor],
+    spacing: Literal["index"] | Literal["arc_length"],
+    strip_rows: Optional[int],
+) -> Iterator[npt.NDArray[np.float_]]:
+    """
+    Lazily compute the boundaries returned by :func:`cajal.sample_seg.cell_boundaries`.
+    """
+    sample = functools.partial(
+        _sample_cell_boundary,
+        n_sample=n_sample,
+        discard_cells_with_holes=discard_cells_with_holes,
+        only_longest=only_longest,
+        spacing=spacing,
+    )
+    cells = _crop_cells(imarray, background, strip_rows)
+    results: Iterable[Union[Optional[npt.NDArray[np.float_]], TaskFailure]]
+    if executor is None:
+        results = map(sample, cells)
+    else:
+        results = executor.imap(sample, cells)
+    for result in results:
+        if isinstance(result, TaskFailure):
+            raise result.exception
+        if result is not None:
+            yield result
 
 
 def cell_boundaries(
@@ -18,11 +235,17 @@ def cell_boundaries(
     background: int = 0,
     discard_cells_with_holes: bool = False,
     only_longest: bool = False,
+    executor: Optional[Executor] = None,
+    spacing: Literal["index"] | Literal["arc_length"] = "index",
+    strip_rows: Optional[int] = None,
 ) -> List[Tuple[int, npt.NDArray[np.float_]]]:
     """
     Sample n coordinates from the boundary of each cell in a segmented image,
     skipping cells that touch the border of the image
 
+    Each cell is cropped to its bounding box before its contours are traced, so the
+    cost is proportional to the size of the image plus the total area of the cells.
+
     :param imarray: 2D segmented image where the pixels belonging to\
           different cells have different values
     :param n_sample: number of pixel coordinates to sample from boundary of each cell
@@ -35,56 +258,51 @@ def cell_boundaries(
           only_longest is irrelevant. Otherwise, this determines whether \
           we sample points from only the longest boundary (presumably \
           the exterior) or from all boundaries, exterior and interior.
+    :param executor: If given, the boundaries of the cells are traced in parallel \
+          with this :class:`cajal.parallel.Executor`, which is useful for \
+          large images with many cells. By default they are traced serially.
+    :param spacing: If "index", the points are taken at evenly spaced indices \
+          into the list of boundary pixels, which repeats pixels if there are fewer \
+          than `n_sample` of them. If "arc_length", the points are evenly spaced \
+          along the boundary, see :func:`cajal.sample_seg.resample_curves`.
+    :param strip_rows: If given, the cells are located by reading this many rows of \
+          the image at a time, and then each cell is read from its bounding box, so \
+          that the whole image is never held in memory at once if `imarray` is a \
+          memmap as returned by :func:`cajal.sample_seg.open_tiff`. Cells which span \
+          several strips are traced whole. The result does not depend on `strip_rows`.
     :return:
-       list of float numpy arrays of shape (n_sample, 2) \
-       containing points sampled from the contours.
+       list of pairs (i, boundary), where the cells are numbered in increasing \
+       order of their values in `imarray` and `boundary` is a float numpy array \
+       of shape (n_sample, 2) containing points sampled from the contours.
     """
 
-    cell_ids = set(np.unique(imarray))
-    remove_cells = set()
-    remove_cells.update(np.unique(imarray[0, :]))
-    remove_cells.update(np.unique(imarray[-1, :]))
-    remove_cells.update(np.unique(imarray[:, 0]))
-    remove_cells.update(np.unique(imarray[:, -1]))
-    cell_id_list = list(cell_ids.difference(remove_cells))
-
-    outlist: List[npt.NDArray[np.float_]] = []
-    for cell in cell_id_list:
-        if cell == background:  # Don't draw a boundary around background
-            continue
-        cell_imarray = (imarray == cell) * 1
-        boundary_pts_list = measure.find_contours(
-            cell_imarray, 0.5, fully_connected="high"
-        )
-        if discard_cells_with_holes and len(boundary_pts_list) > 1:
-            warnings.warn("More than one boundary for cell " + str(cell))
-            continue
-        boundary_pts: npt.NDArray[np.float_]
-        if only_longest:
-            boundary_pts_list.sort(key=lambda ell: ell.shape[0])
-            boundary_pts = boundary_pts_list[0]
-        else:
-            boundary_pts = np.concatenate(boundary_pts_list)
-        if boundary_pts.shape[0] < n_sample:
-            warnings.warn(
-                "Fewer than "
-                + str(n_sample)
-                + " pixels around boundary of cell "
-                + str(cell)
+    return list(
+        enumerate(
+            _iter_cell_boundaries(
+                imarray,
+                n_sample,
+                background,
+                discard_cells_with_holes,
+                only_longest,
+                executor,
+                spacing,
+                strip_rows,
             )
-        indices = np.linspace(0, boundary_pts.shape[0] - 1, n_sample)
-        outlist.append(boundary_pts[indices.astype("uint32")])
-    return list(enumerate(outlist))
+        )
+    )
 
 
 def _compute_intracell_all(
     infolder: str,
     n_sample: int,
-    pool: ProcessPool,
+    executor: Executor,
     background: int,
     discard_cells_with_holes: bool,
     only_longest: bool,
-) -> Iterator[Tuple[str, npt.NDArray[np.float_]]]:
+    spacing: Literal["index"] | Literal["arc_length"],
+    strip_rows: Optional[int],
+    shard_dir: str,
+) -> Iterator[Tuple[str, Union[npt.NDArray[np.float_], Err[TaskFailure]]]]:
     file_names = [
         file_name
         for file_name in os.listdir(infolder)
@@ -92,41 +310,59 @@ def _compute_intracell_all(
     ]
     cell_names = [os.path.splitext(file_name)[0] for file_name in file_names]
 
-    # compute_cell_boundaries: Callable[[str], List[Tuple[int, npt.NDArray[np.float_]]]]
-    def compute_cell_boundaries(file_name: str):
-        return cell_boundaries(
-            tifffile.imread(os.path.join(infolder, file_name)),  # type: ignore
-            n_sample,
-            background,
-            discard_cells_with_holes,
-            only_longest,
-        )
+    # Compute the boundaries of all cells in one image and their intracell distance
+    # matrices, one cell at a time, and append the matrices to a binary shard file.
+    # Only the path of the shard and the number of cells are sent back to the calling
+    # process, which streams the matrices from the shard to the output.
+    def compute_cell_icdms(task: Tuple[int, str]) -> Tuple[str, int]:
+        index, file_name = task
+        file_path = os.path.join(infolder, file_name)
+        shard = os.path.join(shard_dir, str(index) + ".f8")
+        num_cells = 0
+        with open(shard, "wb") as shard_file:
+            for bdary in _iter_cell_boundaries(
+                (
+                    tifffile.imread(file_path)  # type: ignore
+                    if strip_rows is None
+                    else open_tiff(file_path)
+                ),
+                n_sample,
+                background,
+                discard_cells_with_holes,
+                only_longest,
+                None,
+                spacing,
+                strip_rows,
+            ):
+                shard_file.write(pdist(bdary).tobytes())
+                num_cells += 1
+        return shard, num_cells
 
-    cell_names_repeat: Iterator[Iterator[str]]
-    cell_names_repeat = map(it.repeat, cell_names)
-    cell_bdary_lists: Iterator[
-        Tuple[Iterator[str], Iterator[Tuple[int, npt.NDArray[np.float_]]]]
-    ]
-    cell_bdary_lists = zip(
-        cell_names_repeat, pool.imap(compute_cell_boundaries, file_names, chunksize=100)
-    )
-    cell_bdary_list_iters: Iterator[
-        Iterator[Tuple[str, Tuple[int, npt.NDArray[np.float_]]]]
-    ]
-    cell_bdary_list_iters = map(lambda tup: zip(tup[0], tup[1]), cell_bdary_lists)
-    cell_bdary_list_flattened: Iterator[Tuple[str, Tuple[int, npt.NDArray[np.float_]]]]
-    cell_bdary_list_flattened = it.chain.from_iterable(cell_bdary_list_iters)
-
-    def restructure_and_get_pdist(
-        tup: tuple[str, tuple[int, npt.NDArray[np.float_]]]
-    ) -> tuple[str, npt.NDArray[np.float_]]:
-        name = tup[0] + "_" + str(tup[1][0])
-        pd = pdist(tup[1][1])
-        return name, pd
-
-    return pool.imap(
-        restructure_and_get_pdist, cell_bdary_list_flattened, chunksize=1000
+    # Each image is a large task, so they are sent to the workers one at a time.
+    chunksize = executor.chunksize or 1
+    results = executor.imap(
+        compute_cell_icdms,
+        list(enumerate(file_names)),
+        chunksize=chunksize,
+        # Bound the number of shards waiting to be written.
+        max_in_flight=2 * chunksize * executor.num_workers,
     )
+    row_length = n_sample * (n_sample - 1) // 2
+    for cell_name, result in zip(cell_names, results):
+        if isinstance(result, TaskFailure):
+            yield cell_name, Err(result)
+            continue
+        shard, num_cells = result
+        with open(shard, "rb") as shard_file:
+            for start in range(0, num_cells, _SHARD_BLOCK_ROWS):
+                block = np.fromfile(
+                    shard_file,
+                    dtype=np.float64,
+                    count=min(_SHARD_BLOCK_ROWS, num_cells - start) * row_length,
+                ).reshape(-1, row_length)
+                for i, icdm in enumerate(block, start):
+                    yield cell_name + "_" + str(i), icdm
+        os.remove(shard)
 
 
 def compute_icdm_all(
@@ -137,13 +373,23 @@ def compute_icdm_all(
     background: int = 0,
     discard_cells_with_holes: bool = False,
     only_longest: bool = False,
-) -> None:
+    executor: Optional[Executor] = None,
+    spacing: Literal["index"] | Literal["arc_length"] = "index",
+    strip_rows: Optional[int] = None,
+    binary: Optional[BinaryFormat] = None,
+) -> List[Tuple[str, Err[TaskFailure]]]:
     """
     Read in each segmented image in a folder (assumed to be .tif), \
     save n pixel coordinates sampled from the boundary
     of each cell in the segmented image, \
     skipping cells that touch the border of the image.
 
+    Each worker computes the intracell distance matrices of the cells of an image one
+    at a time and appends them to a temporary binary file in the directory of
+    `out_csv`, from which they are streamed to `out_csv`, so that neither the
+    boundaries nor the matrices of a whole image are held in memory or sent
+    between processes.
+
     :param infolder: path to folder containing .tif files.
     :param out_csv: path to csv file to save cell boundaries.
     :param n_sample: number of pixel coordinates \
@@ -160,16 +406,41 @@ def compute_icdm_all(
          the exterior) or from all boundaries, exterior and interior.
 
     :param num_processes: How many threads to run while sampling.
-    :return: None (writes to file)
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored; it must be able to run closures, so
+        its backend should not be "processes" or "cluster". By default a "dill"
+        backend with `num_processes` workers is used.
+    :param spacing: How to space the points along the boundary, "index" or \
+        "arc_length", see :func:`cajal.sample_seg.cell_boundaries`. \
+        Evenly spaced points represent the shape equally well with a smaller `n_sample`.
+    :param strip_rows: If given, each image is opened with \
+        :func:`cajal.sample_seg.open_tiff` and read this many rows at a time, \
+        see :func:`cajal.sample_seg.cell_boundaries`, so that images larger than \
+        the memory of the workers can be processed.
+    :param binary: If given, the matrices are written to `out_csv` in the binary \
+        container it describes rather than as CSV, see \
+        :func:`cajal.utilities.write_csv_block`.
+    :return: The images for which the computation raised an exception, paired with the
+        error, if the executor's `on_error` is "return"; otherwise the empty list.
+        The intracell distance matrices are written to `out_csv`.
     """
 
-    pool = ProcessPool(nodes=num_processes)
-    name_dist_mat_pairs = _compute_intracell_all(
-        infolder, n_sample, pool, background, discard_cells_with_holes, only_longest
-    )
-    batch_size: int = 1000
-    write_csv_block(out_csv, n_sample, name_dist_mat_pairs, batch_size)
-    pool.close()
-    pool.join()
-    pool.clear()
-    return None
+    executor = default_executor(executor, num_processes, "dill")
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(out_csv))
+    ) as shard_dir:
+        name_dist_mat_pairs = _compute_intracell_all(
+            infolder,
+            n_sample,
+            executor,
+            background,
+            discard_cells_with_holes,
+            only_longest,
+            spacing,
+            strip_rows,
+            shard_dir,
+        )
+        batch_size: int = 1000
+        return write_csv_block(
+            out_csv, n_sample, name_dist_mat_pairs, batch_size, binary
+        )
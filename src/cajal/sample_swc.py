@@ -2,20 +2,39 @@
 Functions for sampling points from an SWC reconstruction of a neuron.
 """
 
+import functools
 import math
-from typing import Callable, Iterator, Union
+import pickle
+from typing import Callable, Iterator, Optional, Union
 
 import numpy as np
 import numpy.typing as npt
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import euclidean, pdist
 from tqdm import tqdm
 
-from .swc import (NeuronNode, NeuronTree, SWCForest, default_name_validate,
-                  get_filenames, read_swc, weighted_depth)
-from .utilities import Err, T, write_csv_block
-from .weighted_tree import (WeightedTree, WeightedTree_of, WeightedTreeChild,
-                            WeightedTreeRoot, weighted_depth_wt,
-                            weighted_dist_from_root)
+from .parallel import Executor, TaskFailure, adaptive_chunksize
+from .swc import (
+    NeuronNode,
+    NeuronTree,
+    SWCArray,
+    SWCArray_of,
+    SWCForest,
+    default_name_validate,
+    get_filenames,
+    read_swc,
+    read_swc_array,
+)
+from .utilities import BinaryFormat, Err, T, write_csv_block
+from .weighted_tree import (
+    WeightedTree,
+    WeightedTree_of,
+    WeightedTreeArrays_of,
+    WeightedTreeChild,
+    WeightedTreeRoot,
+    weighted_depth_wt,
+    weighted_dist_from_root,
+)
 
 # Warning: Of 509 neurons downloaded from the Allen Brain Initiative
 # database, about 5 had a height of at least 1000 nodes. Therefore on
@@ -24,67 +43,65 @@ from .weighted_tree import (WeightedTree, WeightedTree_of, WeightedTreeChild,
 # iterative style when possible.
 
 
-def _count_nodes_helper(
-    node_a: NeuronNode, node_b: NeuronNode, stepsize: float, offset: float
-) -> tuple[int, float]:
-    """
-    Count nodes in the tree between `node_a` and `node_b` at the given stepsize/offset.
+def _as_swc_array(forest: Union[SWCForest, SWCArray]) -> SWCArray:
+    return forest if isinstance(forest, SWCArray) else SWCArray_of(forest)
 
-    :param node_a: A node in the graph being sampled; the parent of node_b.
-    :param node_b: A node in the graph being sampled; the child of node_a.
-    :param stepsize: The sampling parameter controlling the distance between points \
-    sampled from along the line segments of the graph.
-    :param offset: The height above `node_a` of the last point which was sampled from the graph. \
-    It is assumed that offset < stepsize; otherwise, it would be possible to choose a lower point \
-    above node_a which is at least stepsize away from the one above it.
 
-    :return: `num_intermediary nodes`, the number of points on the line segment from `a` to `b`
-    which would be returned if one sampled uniformly from the least point already sampled above `a`
-    to `b` at a distance of `stepsize` between sampled points.
-    :return: `leftover`, the height of the least sampled point on the line segment from `a` to `b`
-    after sampling according to this procedure.
+def _euclidean_segments(
+    arr: SWCArray,
+) -> tuple[npt.NDArray[np.int_], npt.NDArray[np.float_], npt.NDArray[np.float_]]:
     """
-    cumulative = (
-        euclidean(np.array(node_a.coord_triple), np.array(node_b.coord_triple)) + offset
-    )
-    num_intermediary_nodes = math.floor(cumulative / stepsize)
-    leftover = cumulative - (num_intermediary_nodes * stepsize)
-    return num_intermediary_nodes, leftover
-
-
-def _count_nodes_at_given_stepsize(tree: NeuronTree, stepsize: float) -> int:
-    r"""Count how many nodes will be returned if the user samples points at `stepsize`.
+    Compute the data needed to sample points from the line segments of `arr` at \
+    any step size.
+
+    :return: A triple (nodes, child_depths, parent_depths). `nodes` are the indices of the \
+    non-root nodes of `arr`, each standing for the line segment from its parent to it, \
+    in the order in which the segments are sampled: level by level across all \
+    components at once, as in a breadth-first search started from all roots. \
+    `child_depths` and `parent_depths` are the geodesic distances of these nodes and \
+    of their parents from the root.
+    """
+    root_distances = arr.root_distances()
+    nodes = np.flatnonzero(arr.parent >= 0)
+    nodes = nodes[np.argsort(arr.node_depths()[nodes], kind="stable")]
+    return nodes, root_distances[nodes], root_distances[arr.parent[nodes]]
 
-    We sample uniformly from `tree`, starting at the root and adding
-    all points at (geodesic) depth `stepsize`, 2 \* stepsize, 3 \*
-    stepsize, and so on until we reach the end of the graph.
 
-    :return: the number of points which would be sampled at this stepsize.
+def _samples_per_segment(
+    child_depths: npt.NDArray[np.float_],
+    parent_depths: npt.NDArray[np.float_],
+    stepsize: float,
+) -> npt.NDArray[np.int_]:
+    r"""
+    Count the points sampled from each line segment at `stepsize`.
 
+    We sample uniformly from the forest, starting at the roots and adding all points at
+    (geodesic) depth `stepsize`, 2 \* stepsize, 3 \* stepsize, and so on until we reach
+    the end of the graph. Thus the segment from depth `a` to depth `b` contains the
+    points at depths k \* stepsize with a < k \* stepsize <= b.
     """
-    treelist = [(tree, 0.0)]
-    acc: int = 1
-    while bool(treelist):
-        new_treelist: list[tuple[NeuronTree, float]] = []
-        for tree0, offset in treelist:
-            for child_tree in tree0.child_subgraphs:
-                nodes, new_offset = _count_nodes_helper(
-                    tree0.root, child_tree.root, stepsize, offset
-                )
-                acc += nodes
-                new_treelist.append((child_tree, new_offset))
-        treelist = new_treelist
-    return acc
+    return (
+        np.floor(child_depths / stepsize) - np.floor(parent_depths / stepsize)
+    ).astype(np.int_)
 
 
-def _binary_stepwise_search(forest: SWCForest, num_samples: int) -> float:
+def _binary_stepwise_search(
+    segments: tuple[
+        npt.NDArray[np.int_], npt.NDArray[np.float_], npt.NDArray[np.float_]
+    ],
+    num_roots: int,
+    num_samples: int,
+) -> float:
     """
     Return the epsilon which will cause exactly `num_samples` points to be sampled.
 
     We assume the the forest is sampled at `stepsize` epsilon. The
-    user should ensure that len(forest) <= num_samples.
+    user should ensure that num_roots <= num_samples.
+
+    :param segments: As returned by :func:`cajal.sample_swc._euclidean_segments`.
+    :param num_roots: The number of connected components of the forest.
     """
-    if len(forest) > num_samples:
+    if num_roots > num_samples:
         raise Exception(
             "More trees in the forest than num_samples. \
         All root nodes of all connected components are returned as sample points, \
@@ -92,15 +109,17 @@ def _binary_stepwise_search(forest: SWCForest, num_samples: int) -> float:
         Recommend discarding smaller trees. \
         "
         )
-
-    max_depth = max((weighted_depth(tree) for tree in forest))
+    _, child_depths, parent_depths = segments
+    max_depth = float(np.max(child_depths, initial=0.0))
+    if max_depth == 0.0:
+        raise Exception("The forest has no line segments of positive length.")
     max_reps = 50
     counter = 0
     step_size = max_depth
     adjustment = step_size / 2
     while counter < max_reps:
-        num_nodes_this_step_size = sum(
-            map(lambda tree: _count_nodes_at_given_stepsize(tree, step_size), forest)
+        num_nodes_this_step_size = num_roots + int(
+            np.sum(_samples_per_segment(child_depths, parent_depths, step_size))
         )
         if num_nodes_this_step_size < num_samples:
             step_size -= adjustment
@@ -113,72 +132,154 @@ def _binary_stepwise_search(forest: SWCForest, num_samples: int) -> float:
     raise Exception("Binary search timed out.")
 
 
+def _sample_segments_euclidean(
+    arr: SWCArray,
+    segments: tuple[
+        npt.NDArray[np.int_], npt.NDArray[np.float_], npt.NDArray[np.float_]
+    ],
+    step_size: float,
+) -> tuple[npt.NDArray[np.int_], npt.NDArray[np.int_], npt.NDArray[np.float_]]:
+    """
+    Sample points uniformly throughout the forest, starting at the roots, \
+    at the given step size.
+
+    :param segments: As returned by :func:`cajal.sample_swc._euclidean_segments`.
+    :return: A triple of arrays (a, b, x) with one entry for each sample point, \
+    such that the sample point lies the fraction `x` of the way from node `a` to its \
+    child `b`. The roots come first, as (root, root, 0.0); then the points on the \
+    line segments, in the order of `segments`.
+    """
+    nodes, child_depths, parent_depths = segments
+    counts = _samples_per_segment(child_depths, parent_depths, step_size)
+    child = np.repeat(nodes, counts)
+    # The sample points on a segment are at depths k * step_size for consecutive k.
+    k = np.repeat(np.floor(parent_depths / step_size) + 1, counts) + (
+        np.arange(child.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    start = np.repeat(parent_depths, counts)
+    length = np.repeat(child_depths - parent_depths, counts)
+    roots = arr.roots()
+    return (
+        np.concatenate((roots, arr.parent[child])),
+        np.concatenate((roots, child)),
+        np.concatenate((np.zeros(roots.shape[0]), (k * step_size - start) / length)),
+    )
+
+
+def _interpolate(
+    values: npt.NDArray[np.float_],
+    a: npt.NDArray[np.int_],
+    b: npt.NDArray[np.int_],
+    x: npt.NDArray[np.float_],
+) -> npt.NDArray[np.float_]:
+    if values.ndim > 1:
+        x = x[:, np.newaxis]
+    return values[a] * (1 - x) + values[b] * x
+
+
 def get_sample_pts_euclidean(
-    forest: SWCForest, step_size: float
+    forest: Union[SWCForest, SWCArray], step_size: float
 ) -> list[npt.NDArray[np.float_]]:
     """
     Sample points uniformly throughout the forest, starting at the roots, \
      at the given step size.
 
+    :param forest: The cell to be sampled, as an SWCForest or an :class:`swc.SWCArray`.
     :return: a list of (x,y,z) coordinate triples, \
     represented as numpy floating point \
     arrays of shape (3,). The list length depends (inversely) \
     on the value of `step_size`.
     """
-    sample_pts_list: list[npt.NDArray[np.float_]] = []
-    for tree in forest:
-        sample_pts_list.append(np.array(tree.root.coord_triple))
-    treelist = [(tree, 0.0) for tree in forest]
-    while bool(treelist):
-        new_treelist: list[tuple[NeuronTree, float]] = []
-        for tree, offset in treelist:
-            root_triple = np.array(tree.root.coord_triple)
-            for child_tree in tree.child_subgraphs:
-                child_triple = np.array(child_tree.root.coord_triple)
-                dist = euclidean(root_triple, child_triple)
-                assert step_size >= offset
-                num_nodes, leftover = _count_nodes_helper(
-                    tree.root, child_tree.root, step_size, offset
-                )
-                spacing = np.linspace(
-                    start=step_size - offset,
-                    stop=dist - leftover,
-                    num=num_nodes,
-                    endpoint=True,
-                )
-                assert spacing.shape[0] == num_nodes
-                for x in spacing:
-                    sample_pts_list.append((root_triple * x) + (child_triple * (1 - x)))
-                assert leftover >= 0
-                assert leftover < step_size
-                new_treelist.append((child_tree, leftover))
-        treelist = new_treelist
-    return sample_pts_list
+    arr = _as_swc_array(forest)
+    a, b, x = _sample_segments_euclidean(arr, _euclidean_segments(arr), step_size)
+    return list(_interpolate(arr.coords, a, b, x))
+
+
+def _sample_features(
+    arr: SWCArray,
+    a: npt.NDArray[np.int_],
+    b: npt.NDArray[np.int_],
+    x: npt.NDArray[np.float_],
+) -> npt.NDArray[np.float_]:
+    return np.stack(
+        (_interpolate(arr.radius, a, b, x), arr.structure_id[b].astype(np.float64)),
+        axis=1,
+    )
+
+
+def get_sample_features_euclidean(
+    forest: Union[SWCForest, SWCArray], step_size: float
+) -> npt.NDArray[np.float_]:
+    """
+    Compute the features of the points sampled by \
+    :func:`cajal.sample_swc.get_sample_pts_euclidean` at the given step size.
+
+    :return: An array of shape (n,2), in the same order as the list of points returned by \
+    :func:`cajal.sample_swc.get_sample_pts_euclidean`. The first column is the radius \
+    of the neuron at the sample point, linearly interpolated between the two \
+    nodes on either side of it; the second column is the structure_id of the \
+    child node of the line segment containing the sample point.
+    """
+    arr = _as_swc_array(forest)
+    return _sample_features(
+        arr, *_sample_segments_euclidean(arr, _euclidean_segments(arr), step_size)
+    )
 
 
-def euclidean_point_cloud(forest: SWCForest, num_samples: int) -> npt.NDArray[np.float_]:
+def _euclidean_samples(
+    arr: SWCArray, num_samples: int
+) -> tuple[npt.NDArray[np.int_], npt.NDArray[np.int_], npt.NDArray[np.float_]]:
+    """
+    Sample `num_samples` points from `arr`, in the form returned by \
+    :func:`cajal.sample_swc._sample_segments_euclidean`.
+    """
+    roots = arr.roots()
+    if roots.shape[0] >= num_samples:
+        roots = roots[:num_samples]
+        return roots, roots, np.zeros(num_samples)
+    segments = _euclidean_segments(arr)
+    step_size = _binary_stepwise_search(segments, roots.shape[0], num_samples)
+    return _sample_segments_euclidean(arr, segments, step_size)
+
+
+def euclidean_point_cloud(
+    forest: Union[SWCForest, SWCArray], num_samples: int
+) -> npt.NDArray[np.float_]:
     r"""
     Compute the (Euclidean) point cloud matrix for the forest with n sample points.
 
-    :param forest: The cell to be sampled.
+    :param forest: The cell to be sampled, as an SWCForest or an :class:`swc.SWCArray`.
     :param num_samples: How many points to be sampled.
     :return: A rectangular matrix of shape (n,3).
     """
-    if len(forest) >= num_samples:
-        pts: list[npt.NDArray[np.float_]] = []
-        for i in range(num_samples):
-            pts.append(np.array(forest[i].root.coord_triple))
-    else:
-        step_size = _binary_stepwise_search(forest, num_samples)
-        pts = get_sample_pts_euclidean(forest, step_size)
-    return np.stack(pts)
+    arr = _as_swc_array(forest)
+    return _interpolate(arr.coords, *_euclidean_samples(arr, num_samples))
+
+
+def euclidean_point_cloud_features(
+    forest: Union[SWCForest, SWCArray], num_samples: int
+) -> npt.NDArray[np.float_]:
+    r"""
+    Compute the features of the points sampled by \
+    :func:`cajal.sample_swc.euclidean_point_cloud` (and \
+    :func:`cajal.sample_swc.icdm_euclidean`) with n sample points.
+
+    :param forest: The cell to be sampled, as an SWCForest or an :class:`swc.SWCArray`.
+    :param num_samples: How many points to be sampled.
+    :return: A matrix of shape (n,2) whose rows are the (radius, structure_id) \
+        of the sample points, see :func:`cajal.sample_swc.get_sample_features_euclidean`.
+    """
+    arr = _as_swc_array(forest)
+    return _sample_features(arr, *_euclidean_samples(arr, num_samples))
 
 
-def icdm_euclidean(forest: SWCForest, num_samples: int) -> npt.NDArray[np.float_]:
+def icdm_euclidean(
+    forest: Union[SWCForest, SWCArray], num_samples: int
+) -> npt.NDArray[np.float_]:
     r"""
     Compute the (Euclidean) intracell distance matrix for the forest with n sample points.
 
-    :param forest: The cell to be sampled.
+    :param forest: The cell to be sampled, as an SWCForest or an :class:`swc.SWCArray`.
     :param num_samples: How many points to be sampled.
     :return: A condensed (vectorform) matrix of length n\* (n-1)/2.
     """
@@ -328,6 +429,49 @@ def geodesic_distance(
             return _geodesic_distance_children(wt1, h1, wt2, h2)
 
 
+def geodesic_distances(
+    pts_list: list[tuple[WeightedTree, float]]
+) -> npt.NDArray[np.float_]:
+    r"""
+    Compute the pairwise geodesic distances between the given points of a weighted tree.
+
+    This gives the same result as calling :func:`cajal.sample_swc.geodesic_distance` on
+    each pair of points, but all pairs are handled at once with array operations:
+    if the lowest common ancestor of the nodes below p1 and p2 is at distance `r` from
+    the root, then the path from p1 to p2 passes through the point at distance
+    min(`r`, d(p1), d(p2)) from the root, where d(p) is the distance of p from the root.
+
+    :param pts_list: A list of points (wt, h) in the same weighted tree, in the form \
+        returned by :func:`cajal.sample_swc.get_sample_pts_geodesic`.
+    :return: A condensed distance matrix of length n\*(n-1)/2, where n is the length \
+        of `pts_list`.
+    """
+    n = len(pts_list)
+    if n < 2:
+        return np.zeros((0,), dtype=np.float64)
+    root = pts_list[0][0]
+    while isinstance(root, WeightedTreeChild):
+        root = root.parent
+    arrays = WeightedTreeArrays_of(root)
+    index = {id(wt): i for i, wt in enumerate(arrays.nodes)}
+    nodes = np.array([index[id(wt)] for wt, _ in pts_list], dtype=np.int_)
+    heights = np.array([h for _, h in pts_list], dtype=np.float64)
+    pt_dist = arrays.dist_from_root[nodes] - heights
+    # Compute the lowest common ancestors only for the distinct nodes in pts_list.
+    distinct, inverse = np.unique(nodes, return_inverse=True)
+    a, b = np.triu_indices(distinct.shape[0], 1)
+    lca = np.zeros((distinct.shape[0], distinct.shape[0]), dtype=np.int_)
+    lca[a, b] = arrays.lca(distinct[a], distinct[b])
+    lca[b, a] = lca[a, b]
+    lca[np.diag_indices_from(lca)] = distinct
+    i, j = np.triu_indices(n, 1)
+    meet = np.minimum(
+        arrays.dist_from_root[lca[inverse[i], inverse[j]]],
+        np.minimum(pt_dist[i], pt_dist[j]),
+    )
+    return pt_dist[i] + pt_dist[j] - 2 * meet
+
+
 def get_sample_pts_geodesic(
     tree: NeuronTree, num_sample_pts: int
 ) -> list[tuple[WeightedTree, float]]:
@@ -374,6 +518,141 @@ def get_sample_pts_geodesic(
     raise Exception("Binary search timed out.")
 
 
+def _locate_geodesic_samples(
+    tree: NeuronTree, pts_list: list[tuple[WeightedTree, float]]
+) -> Iterator[tuple[NeuronNode, NeuronNode, float]]:
+    """
+    Locate the given sample points of `tree` on the line segments of `tree`.
+
+    :return: An iterator over triples (node, parent, x), one for each element of
+        `pts_list`, such that the sample point lies the fraction `x` of the way from
+        `node` to its parent `parent`. For the root, this is (root, root, 0.0).
+    """
+    nodes: dict[int, NeuronNode] = {t.root.sample_number: t.root for t in tree}
+    for wt, h in pts_list:
+        if isinstance(wt, WeightedTreeRoot):
+            yield (tree.root, tree.root, 0.0)
+            continue
+        # The sample point lies on the path from wt up to its parent in the
+        # weighted tree, which passes through nodes of degree two in `tree`.
+        top_id = (
+            tree.root.sample_number
+            if isinstance(wt.parent, WeightedTreeRoot)
+            else wt.parent.unique_id
+        )
+        node = nodes[wt.unique_id]
+        while True:
+            parent = nodes[node.parent_sample_number]
+            edge = euclidean(node.coord_triple, parent.coord_triple)
+            if h <= edge or parent.sample_number == top_id:
+                x = min(h / edge, 1.0) if edge > 0 else 0.0
+                yield (node, parent, x)
+                break
+            h -= edge
+            node = parent
+
+
+def get_sample_features_geodesic(
+    tree: NeuronTree, pts_list: list[tuple[WeightedTree, float]]
+) -> npt.NDArray[np.float_]:
+    """
+    Compute the features of the given sample points of `tree`.
+
+    :param tree: A NeuronTree.
+    :param pts_list: Sample points, as returned by \
+        :func:`cajal.sample_swc.get_sample_pts_geodesic` for the same tree.
+    :return: An array of shape (n,2), with one row for each element of `pts_list`. \
+        The first column is the radius of the neuron at the sample point, \
+        linearly interpolated between the two nodes on either side of it; the \
+        second column is the structure_id of the child node of the line segment \
+        containing the sample point.
+    """
+    features: list[tuple[float, float]] = [
+        (node.radius * (1 - x) + parent.radius * x, node.structure_id)
+        for node, parent, x in _locate_geodesic_samples(tree, pts_list)
+    ]
+    return np.array(features, dtype=np.float64)
+
+
+def get_sample_coords_geodesic(
+    tree: NeuronTree, pts_list: list[tuple[WeightedTree, float]]
+) -> npt.NDArray[np.float_]:
+    """
+    Compute the (x,y,z) coordinates of the given sample points of `tree`.
+
+    :param tree: A NeuronTree.
+    :param pts_list: Sample points, as returned by \
+        :func:`cajal.sample_swc.get_sample_pts_geodesic` for the same tree.
+    :return: An array of shape (n,3), with one row for each element of `pts_list`.
+    """
+    coords = [
+        np.array(node.coord_triple) * (1 - x) + np.array(parent.coord_triple) * x
+        for node, parent, x in _locate_geodesic_samples(tree, pts_list)
+    ]
+    return np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+
+def swc_landmarks(
+    forest: SWCForest,
+    sample_pts: npt.NDArray[np.float_],
+    num_landmarks: Optional[int] = None,
+) -> npt.NDArray[np.int_]:
+    """
+    Choose landmarks among the sample points of a neuron: for each root, branch
+    point and leaf of `forest`, the sample point closest to it.
+
+    The Voronoi cells of these landmarks with respect to the intracell distance
+    matrix (see :func:`cajal.qgw.voronoi_clusters`) follow the branches of the
+    neuron, and are a clustering for the quantized GW distance which costs
+    O(n * num_landmarks) time to compute.
+
+    :param forest: The neuron.
+    :param sample_pts: The coordinates of the sample points, an array of shape (n,3),
+        as returned by :func:`cajal.sample_swc.euclidean_point_cloud` or
+        :func:`cajal.sample_swc.get_sample_coords_geodesic`.
+    :param num_landmarks: If the neuron has more than this many roots, branch points and
+        leaves, a subset of them is chosen by farthest point sampling.
+    :return: The indices of the landmarks in `sample_pts`, without repetitions.
+    """
+    key_coords = np.array(
+        [
+            t.root.coord_triple
+            for tree in forest
+            for t in tree
+            if len(t.child_subgraphs) != 1 or t is tree
+        ],
+        dtype=np.float64,
+    )
+    _, nearest = cKDTree(sample_pts).query(key_coords)
+    landmarks = np.unique(nearest)
+    if num_landmarks is not None and landmarks.shape[0] > num_landmarks:
+        coords = sample_pts[landmarks]
+        chosen = [0]
+        min_dist = np.linalg.norm(coords - coords[0], axis=1)
+        for _ in range(1, num_landmarks):
+            chosen.append(int(np.argmax(min_dist)))
+            np.minimum(
+                min_dist,
+                np.linalg.norm(coords - coords[chosen[-1]], axis=1),
+                out=min_dist,
+            )
+        landmarks = np.sort(landmarks[chosen])
+    return landmarks
+
+
+def geodesic_features(tree: NeuronTree, num_samples: int) -> npt.NDArray[np.float_]:
+    """
+    Compute the features of the points sampled by :func:`cajal.sample_swc.icdm_geodesic`.
+
+    :return: An array of shape (`num_samples`, 2) whose rows are the \
+        (radius, structure_id) of the sample points, in the same order as the \
+        rows of the intracell distance matrix.
+    """
+    return get_sample_features_geodesic(
+        tree, get_sample_pts_geodesic(tree, num_samples)
+    )
+
+
 def icdm_geodesic(tree: NeuronTree, num_samples: int) -> npt.NDArray[np.float_]:
     r"""
     Compute the intracell distance matrix for `tree` using the geodesic metric.
@@ -386,18 +665,7 @@ def icdm_geodesic(tree: NeuronTree, num_samples: int) -> npt.NDArray[np.float_]:
         (`num_samples` \* `num_samples` - 1/2, ). Contains the entries in the intracell geodesic
         distance matrix for `tree` lying strictly above the diagonal.
     """
-    pts_list = get_sample_pts_geodesic(tree, num_samples)
-    dist_list = []
-    for i in range(len(pts_list)):
-        for j in range(i + 1, len(pts_list)):
-            wt1, h1 = pts_list[i]
-            wt2, h2 = pts_list[j]
-            dist_list.append(geodesic_distance(wt1, h1, wt2, h2))
-            assert (
-                len(dist_list)
-                == math.comb(num_samples, 2) - math.comb(num_samples - i, 2) + j - i
-            )
-    return np.array(dist_list)
+    return geodesic_distances(get_sample_pts_geodesic(tree, num_samples))
 
 
 def read_preprocess_compute_euclidean(
@@ -411,7 +679,11 @@ def read_preprocess_compute_euclidean(
     Read the \*.swc file `file_name` from disk as an `SWCForest`.
     Apply the function `preprocess` to the forest. If it returns an error, return that error.
     Otherwise, return the intracell distance matrix in vector form.
+    If there is no preprocessing, the file is read with the faster
+    :func:`swc.read_swc_array` instead.
     """
+    if preprocess is _identity:
+        return icdm_euclidean(read_swc_array(file_name), n_sample)
     loaded_forest, _ = read_swc(file_name)
     forest = preprocess(loaded_forest)
     if isinstance(forest, Err):
@@ -460,13 +732,90 @@ def read_preprocess_compute_geodesic(
     return icdm_geodesic(tree, n_sample)
 
 
+def _identity(forest: SWCForest) -> SWCForest:
+    return forest
+
+
+def _first_component(forest: SWCForest) -> NeuronTree:
+    return forest[0]
+
+
+def _read_preprocess_compute_named(
+    compute: Callable[[str, int, Callable], Union[Err[T], npt.NDArray[np.float_]]],
+    n_sample: int,
+    preprocess: Callable,
+    name_and_path: tuple[str, str],
+) -> tuple[str, Union[Err[T], npt.NDArray[np.float_]]]:
+    """
+    Apply `compute` (one of :func:`cajal.sample_swc.read_preprocess_compute_euclidean`
+    or :func:`cajal.sample_swc.read_preprocess_compute_geodesic`) to a file, and
+    return the result together with the cell name.
+    """
+    name, file_path = name_and_path
+    return name, compute(file_path, n_sample, preprocess)
+
+
+def _compute_icdm_all(
+    compute: Callable[[str, int, Callable], Union[Err[T], npt.NDArray[np.float_]]],
+    cell_names: list[str],
+    file_paths: list[str],
+    out_csv: str,
+    n_sample: int,
+    preprocess: Callable,
+    num_processes: int,
+    executor: Optional[Executor],
+    ordered: bool,
+    binary: Optional[BinaryFormat],
+) -> list[tuple[str, Err[T]]]:
+    """
+    Apply `compute` to all files in parallel and stream the results to `out_csv`.
+    For the parameters see :func:`cajal.sample_swc.compute_icdm_all_euclidean`.
+    """
+    if executor is None:
+        # Use the standard library's pickle when possible; it is faster than dill.
+        try:
+            pickle.dumps(preprocess)
+            backend = "processes"
+        except Exception:
+            backend = "dill"
+        executor = Executor(backend, num_processes, on_error="return")
+    task = functools.partial(
+        _read_preprocess_compute_named, compute, n_sample, preprocess
+    )
+    chunksize = executor.chunksize or adaptive_chunksize(
+        len(file_paths), executor.num_workers
+    )
+    results = executor.imap(
+        task,
+        list(zip(cell_names, file_paths)),
+        ordered=ordered,
+        chunksize=chunksize,
+        # Bound the number of matrices waiting to be written.
+        max_in_flight=2 * chunksize * executor.num_workers,
+    )
+    icdms = (
+        (result.item[0], Err(result)) if isinstance(result, TaskFailure) else result
+        for result in results
+    )
+    return write_csv_block(
+        out_csv,
+        n_sample,
+        iter(tqdm(icdms, total=len(cell_names))),
+        3 * executor.num_workers,
+        binary,
+    )
+
+
 def compute_icdm_all_euclidean(
     infolder: str,
     out_csv: str,
     n_sample: int,
-    preprocess: Callable[[SWCForest], Union[Err[T], SWCForest]] = lambda forest: forest,
+    preprocess: Callable[[SWCForest], Union[Err[T], SWCForest]] = _identity,
     num_processes: int = 8,
-    name_validate : Callable[str, bool] = default_name_validate
+    name_validate: Callable[str, bool] = default_name_validate,
+    executor: Optional[Executor] = None,
+    ordered: bool = True,
+    binary: Optional[BinaryFormat] = None,
 ) -> list[tuple[str, Err[T]]]:
     r"""
     Compute the intracell Euclidean distance matrices for all swc cells in `infolder`.
@@ -512,29 +861,37 @@ def compute_icdm_all_euclidean(
         machine.
     :param name_validate: A boolean test on strings. Files will be read from the directory
         if name_validate is True (truthy).
+    :param executor: Where to run the computation, see :class:`cajal.parallel.Executor`.
+        If given, `num_processes` is ignored. By default, `num_processes` worker processes
+        are used, serializing with pickle if `preprocess` is picklable (defined at the
+        top level of a module) and with dill otherwise; and a file on which
+        reading or sampling raises an exception is reported in the returned list,
+        with the error wrapping a :class:`cajal.parallel.TaskFailure`.
+    :param ordered: If True, the cells are written to `out_csv` in the same order as
+        the files are listed in `infolder`. If False, they are written in the order
+        in which they are finished, which keeps all processes busy when a few
+        cells take much longer than the others.
+    :param binary: If given, the matrices are written to `out_csv` in the binary
+        container it describes rather than as CSV, see
+        :func:`cajal.utilities.write_csv_block`.
     :return: List of pairs (cell_name, error), where cell_name is the cell for
         which sampling failed, and `error` is a wrapper around a message indicating
         why the neuron was not sampled from.
     """
     cell_names, file_paths = get_filenames(infolder, name_validate)
     assert len(cell_names) == len(file_paths)
-
-    def rpce(file_path: str) -> Union[Err[T], npt.NDArray[np.float_]]:
-        return read_preprocess_compute_euclidean(file_path, n_sample, preprocess)
-
-    # args = zip([file_paths,repeat(n_sample),repeat(preprocess)])
-    icdms: Iterator[Union[Err[T], npt.NDArray[np.float_]]]
-    failed_cells: list[tuple[str, Err[T]]]
-    # with ProcessPool(nodes=num_processes) as pool:
-    # icdms = pool.imap(rpce, file_paths)
-    icdms = map(rpce, file_paths)
-    # icdms = pool.starmap(read_preprocess_compute_euclidean,args)
-    tq_icdms = tqdm(icdms, total=len(cell_names))
-
-    failed_cells = write_csv_block(
-        out_csv, n_sample, zip(cell_names, tq_icdms), 3 * num_processes
+    return _compute_icdm_all(
+        read_preprocess_compute_euclidean,
+        cell_names,
+        file_paths,
+        out_csv,
+        n_sample,
+        preprocess,
+        num_processes,
+        executor,
+        ordered,
+        binary,
     )
-    return failed_cells
 
 
 def compute_icdm_all_geodesic(
@@ -542,9 +899,10 @@ def compute_icdm_all_geodesic(
     out_csv: str,
     n_sample: int,
     num_processes: int = 8,
-    preprocess: Callable[
-        [SWCForest], Union[Err[T], NeuronTree]
-    ] = lambda forest: forest[0],
+    preprocess: Callable[[SWCForest], Union[Err[T], NeuronTree]] = _first_component,
+    executor: Optional[Executor] = None,
+    ordered: bool = True,
+    binary: Optional[BinaryFormat] = None,
 ) -> list[tuple[str, Err[T]]]:
     """
     Compute the intracell geodesic distance matrices for all swc cells in `infolder`.
@@ -559,16 +917,15 @@ def compute_icdm_all_geodesic(
     The default preprocessing is to take the largest component.
     """
     cell_names, file_paths = get_filenames(infolder, default_name_validate)
-
-    def rpcg(file_path) -> Union[Err[T], npt.NDArray[np.float_]]:
-        return read_preprocess_compute_geodesic(file_path, n_sample, preprocess)
-
-    icdms: Iterator[Err[T] | npt.NDArray[np.float_]]
-    failed_cells: list[tuple[str, Err[T]]]
-    # with ProcessPool(nodes=num_processes) as pool:
-    # pool.restart(force=True)
-    icdms = map(rpcg, file_paths)
-    tq_icdms = tqdm(icdms, total=len(cell_names))
-    failed_cells = write_csv_block(out_csv, n_sample, zip(cell_names, tq_icdms), 10)
-
-    return failed_cells
+    return _compute_icdm_all(
+        read_preprocess_compute_geodesic,
+        cell_names,
+        file_paths,
+        out_csv,
+        n_sample,
+        preprocess,
+        num_processes,
+        executor,
+        ordered,
+        binary,
+    )
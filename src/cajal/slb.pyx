@@ -3,6 +3,7 @@
 SLB2
 """
 
+cimport cython
 import numpy as np
 cimport numpy as np
 from .gw_cython import intersection
@@ -187,3 +188,61 @@ def l2(np.ndarray[DTYPE_t,ndim=1,mode='c'] f,
         
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _l2_rows(
+    const double[::1] f, const double[::1] cum_u,
+    const double[::1] g, const double[::1] cum_v) nogil:
+    # The same computation as l2, for one pair of rows of a TLB signature.
+    cdef Py_ssize_t flen = f.shape[0]
+    cdef Py_ssize_t glen = g.shape[0]
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t j = 0
+    cdef double acc = 0.0
+    cdef double progress = 0.0
+    cdef double nxt
+    while i < flen and j < glen:
+        if cum_u[i] < cum_v[j]:
+            nxt = cum_u[i]
+            acc += (f[i] - g[j]) ** 2 * (nxt - progress)
+            i += 1
+        else:
+            nxt = cum_v[j]
+            acc += (f[i] - g[j]) ** 2 * (nxt - progress)
+            j += 1
+            if nxt == cum_u[i]:
+                i += 1
+        progress = nxt
+    return acc
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tlb_cost_matrix(
+        const double[:,::1] f,
+        const double[:,::1] cum_u,
+        const double[:,::1] g,
+        const double[:,::1] cum_v):
+    """
+    Compute the cost matrix for the third lower bound (TLB) between two cells.
+
+    Entry (i,j) is the squared L^2 distance between the inverse cumulative
+    distribution functions of the distances from point i of X and point j of Y,
+    as computed by :func:`l2`.
+
+    :param f: Shape (n,n). Row i is the list of distances from point i of X, sorted.
+    :param cum_u: Shape (n,n). Row i is the cumulative sum of the weights of
+        the points of X, listed in the same order as row i of `f`.
+    :param g: Shape (m,m), as `f`, for Y.
+    :param cum_v: Shape (m,m), as `cum_u`, for Y.
+    :return: An (n,m) matrix of costs.
+    """
+    cdef Py_ssize_t n = f.shape[0]
+    cdef Py_ssize_t m = g.shape[0]
+    cdef Py_ssize_t i, j
+    C = np.empty((n, m), dtype=np.float64)
+    cdef double[:,::1] C_view = C
+    with nogil:
+        for i in range(n):
+            for j in range(m):
+                C_view[i, j] = _l2_rows(f[i], cum_u[i], g[j], cum_v[j])
+    return C
@@ -0,0 +1,237 @@
+"""
+Functions to approximate the Gromov-Wasserstein distance between point clouds
+by the sliced Gromov-Wasserstein distance of Vayer et al. (NeurIPS 2019),
+without forming intracell distance matrices.
+"""
+from __future__ import annotations
+
+import itertools as it
+from typing import Iterable, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from .run_gw import Distribution, DistanceMatrix, Matrix, csv_output_writer, uniform
+
+
+def random_projections(
+    dim: int, num_projections: int, seed: Optional[int] = None
+) -> Matrix:
+    """
+    Sample directions uniformly at random from the unit sphere.
+
+    The same projections should be used for all cells in a dataset; generate
+    them once and pass them to :func:`cajal.sliced_gw.sliced_signature` or
+    :func:`cajal.sliced_gw.sliced_gw_pairwise`.
+
+    :param dim: The dimension of the ambient space of the point clouds.
+    :param num_projections: How many directions to sample.
+    :param seed: Seed for the random number generator.
+    :return: A matrix of shape (dim, num_projections) whose columns are unit vectors.
+    """
+    rng = np.random.default_rng(seed)
+    theta = rng.standard_normal((dim, num_projections))
+    theta /= np.linalg.norm(theta, axis=0, keepdims=True)
+    return theta
+
+
+def _principal_axes(X: Matrix, a: Distribution) -> Matrix:
+    """Center X at its barycenter and rotate it onto its principal axes."""
+    Xc = X - a @ X
+    cov = (Xc * a[:, np.newaxis]).T @ Xc
+    _, eigvecs = np.linalg.eigh(cov)
+    return Xc @ eigvecs[:, ::-1]
+
+
+def sliced_signature(
+    X: Matrix,
+    projections: Matrix,
+    num_quantiles: int,
+    distribution: Optional[Distribution] = None,
+    align: bool = True,
+) -> Matrix:
+    """
+    Compute the data about a point cloud needed to compute its sliced GW
+    distance to other point clouds.
+
+    The point cloud is projected onto each direction in `projections`, and the
+    quantile function of each projected distribution is evaluated at
+    `num_quantiles` evenly spaced levels. Cells with different numbers of
+    points are thereby brought to a common size. This takes O(n log n) time
+    and O(n) memory per direction, for a cell with n points.
+
+    :param X: A point cloud of shape (n, d). If d is less than the dimension of
+        `projections`, the points are padded with zeros.
+    :param projections: A matrix of unit vectors of shape (D, L), with D >= d,
+        as returned by :func:`cajal.sliced_gw.random_projections`.
+    :param num_quantiles: The number K of quantile levels.
+    :param distribution: A probability distribution on the points of X;
+        the uniform distribution by default.
+    :param align: If True, the point cloud is first rotated onto its principal axes,
+        so that the result does not depend on the orientation of the cell.
+        (The GW distance is invariant under rotations, but the sliced GW distance is not.)
+    :return: A matrix of shape (K, L). Column l contains the quantiles of the
+        projection onto direction l, centered to have mean zero.
+    """
+    n, d = X.shape
+    D, L = projections.shape
+    if d > D:
+        raise ValueError("Point cloud has more dimensions than the projections.")
+    a = uniform(n) if distribution is None else np.asarray(distribution, dtype=float)
+    X = np.asarray(X, dtype=np.float64)
+    if align:
+        X = _principal_axes(X, a)
+    proj = X @ projections[:d, :]
+    order = np.argsort(proj, axis=0)
+    sorted_proj = np.take_along_axis(proj, order, axis=0)
+    levels = (np.arange(num_quantiles) + 0.5) / num_quantiles
+    if distribution is None:
+        indices = np.broadcast_to(
+            np.floor(levels * n).astype(int)[:, np.newaxis], (num_quantiles, L)
+        )
+    else:
+        cum = np.cumsum(a[order], axis=0)
+        cum /= cum[-1]
+        # Search all columns at once by shifting column l by l.
+        offsets = np.arange(L)
+        flat = (
+            np.searchsorted(
+                (cum + offsets).T.reshape(-1),
+                (levels[:, np.newaxis] + offsets).T.reshape(-1),
+            )
+            .reshape(L, num_quantiles)
+            .T
+        )
+        indices = np.minimum(flat - offsets * n, n - 1)
+    Q = np.take_along_axis(sorted_proj, indices, axis=0)
+    Q -= Q.mean(axis=0, keepdims=True)
+    return np.ascontiguousarray(Q)
+
+
+def _sliced_gw_block(
+    U: npt.NDArray[np.float_], V: npt.NDArray[np.float_]
+) -> npt.NDArray[np.float_]:
+    r"""
+    Compute the sliced GW cost between each signature in U and each signature in V.
+
+    For centered vectors u, v of length K with uniform weights, the one-dimensional GW cost
+    of the coupling u_k <-> v_k,
+
+    .. math:: \frac{1}{K^2}\sum_{i,j} ((u_i-u_j)^2 - (v_i-v_j)^2)^2,
+
+    expands into
+    (2K(S_4(u) + S_4(v)) + 6(S_2(u)^2+S_2(v)^2)
+    - 4K\sum u_k^2v_k^2 - 4S_2(u)S_2(v) - 8(\sum u_kv_k)^2)/K^2,
+    where S_p(u) is the sum of the p-th powers of u. As in Vayer et al., the
+    cost is restricted to this coupling and the anti-monotone one, which pairs u
+    with v reversed, and the smaller of the two is returned; this is not in
+    general the optimal one-dimensional GW coupling.
+
+    :param U: An array of shape (L, N1, K) of signatures, one per projection.
+    :param V: An array of shape (L, N2, K).
+    :return: An array of shape (N1, N2).
+    """
+    K = U.shape[2]
+    U2 = U * U
+    V2 = V * V
+    s2u = U2.sum(axis=2)
+    s2v = V2.sum(axis=2)
+    s4u = (U2 * U2).sum(axis=2)
+    s4v = (V2 * V2).sum(axis=2)
+    const = (
+        2 * K * (s4u[:, :, np.newaxis] + s4v[:, np.newaxis, :])
+        + 6 * (s2u[:, :, np.newaxis] ** 2 + s2v[:, np.newaxis, :] ** 2)
+        - 4 * s2u[:, :, np.newaxis] * s2v[:, np.newaxis, :]
+    )
+    V_T = np.swapaxes(V, 1, 2)
+    V2_T = np.swapaxes(V2, 1, 2)
+    cost_monotone = const - 4 * K * (U2 @ V2_T) - 8 * (U @ V_T) ** 2
+    cost_anti = const - 4 * K * (U2 @ V2_T[:, ::-1, :]) - 8 * (U @ V_T[:, ::-1, :]) ** 2
+    cost = np.minimum(cost_monotone, cost_anti) / (K * K)
+    return np.maximum(cost, 0.0).mean(axis=0)
+
+
+def sliced_gw_pairwise(
+    ptclouds: Iterable[Matrix],
+    num_projections: int = 50,
+    num_quantiles: int = 256,
+    projections: Optional[Matrix] = None,
+    seed: Optional[int] = None,
+    distributions: Optional[Iterable[Distribution]] = None,
+    align: bool = True,
+    names: Optional[list[str]] = None,
+    gw_dist_csv: Optional[str] = None,
+    block_size: int = 256,
+) -> DistanceMatrix:
+    """
+    Compute the pairwise sliced Gromov-Wasserstein distances between point clouds.
+
+    This is a fast approximation to the GW distance which works directly on
+    the coordinates of the points, and never forms an intracell distance matrix;
+    memory use is O(n) per cell rather than O(n^2). The point clouds are
+    projected onto random lines, and on each line the GW problem between the
+    projections (with squared distances) is solved in closed form by sorting.
+    All pairs of cells are compared at once by a few matrix products per block
+    of cells.
+
+    The result is the square root of the average one-dimensional GW cost,
+    divided by two. Because the distances on each line are squared, it is
+    measured in squared units, and its values are not directly comparable to
+    those of :func:`cajal.run_gw.gw_pairwise_parallel`; it is intended for ranking
+    and nearest neighbor queries.
+
+    :param ptclouds: A list of point clouds, arrays of shape (n_i, d_i).
+        Point clouds of lower dimension are padded with zeros.
+    :param num_projections: How many random directions to use. Ignored if
+        `projections` is given.
+    :param num_quantiles: The number of quantile levels at which the projected
+        distributions are compared, see :func:`cajal.sliced_gw.sliced_signature`.
+    :param projections: A matrix of unit vectors of shape (D, L), as returned by
+        :func:`cajal.sliced_gw.random_projections`. Passing the same projections
+        makes results computed on different batches of cells consistent.
+    :param seed: Seed for generating the projections if `projections` is None.
+    :param distributions: Probability distributions on the points of each cell;
+        uniform by default.
+    :param align: Whether to rotate each cell onto its principal axes first,
+        see :func:`cajal.sliced_gw.sliced_signature`.
+    :param names: A list of unique cell identifiers, required if `gw_dist_csv` is given.
+    :param gw_dist_csv: If this is a file path, the distances are written to this file
+        in the same format as :func:`cajal.run_gw.gw_pairwise_parallel`.
+    :param block_size: How many cells are compared against all others at one
+        time; memory use is proportional to `block_size * len(ptclouds) * num_projections`.
+    :return: A square matrix of pairwise sliced GW distances.
+    """
+    ptclouds = list(ptclouds)
+    if projections is None:
+        dim = max(X.shape[1] for X in ptclouds)
+        projections = random_projections(dim, num_projections, seed)
+    if distributions is None:
+        distributions = [None] * len(ptclouds)
+    signatures = np.stack(
+        [
+            sliced_signature(X, projections, num_quantiles, a, align)
+            for X, a in zip(ptclouds, distributions)
+        ]
+    )
+    # Shape (L, N, K).
+    signatures = np.ascontiguousarray(np.transpose(signatures, (2, 0, 1)))
+    N = signatures.shape[1]
+    cost = np.zeros((N, N))
+    for i0 in range(0, N, block_size):
+        i1 = min(i0 + block_size, N)
+        cost[i0:i1, :] = _sliced_gw_block(signatures[:, i0:i1, :], signatures)
+    dmat = np.sqrt(cost) / 2.0
+    # Symmetrize against rounding, and zero the diagonal.
+    dmat = (dmat + dmat.T) / 2.0
+    np.fill_diagonal(dmat, 0.0)
+    if gw_dist_csv is not None:
+        if names is None:
+            raise Exception("Must supply list of cell identifiers for writing to file.")
+        for _ in csv_output_writer(
+            names,
+            gw_dist_csv,
+            None,
+            ((i, j, None, dmat[i, j]) for i, j in it.combinations(range(N), 2)),
+        ):
+            pass
+    return dmat
@@ -7,6 +7,7 @@ from __future__ import annotations
 
 import os
 import sys
+import warnings
 import operator
 from copy import copy
 from dataclasses import dataclass
@@ -15,10 +16,10 @@ import csv
 from typing import Callable, Iterator, Literal, Container, Optional
 
 import numpy as np
-from scipy.spatial.distance import euclidean
-from pathos.pools import ProcessPool
+import numpy.typing as npt
 import dill
 
+from .parallel import Executor, TaskFailure, default_executor
 from .utilities import Err, T
 
 dill.settings["recurse"] = True
@@ -204,6 +205,79 @@ def read_swc(file_path: str) -> tuple[SWCForest, dict[int, NeuronTree]]:
     return sorted(components, key=num_nodes, reverse=True), tree_index
 
 
+def read_swc_array(file_path: str) -> SWCArray:
+    r"""
+    Read the \*.swc file at `file_path` into an :class:`swc.SWCArray`.
+
+    This is much faster than :func:`swc.read_swc`, as the numeric columns are parsed in
+    bulk by NumPy rather than line by line in Python, and the nodes are sorted with
+    array operations rather than by walking up the tree from each node.
+    The same validation is performed: an exception is raised if any line has fewer
+    than seven whitespace-separated strings. Lines starting with "#" are comments.
+    :func:`sample_swc.compute_icdm_all_euclidean` uses this reader when no
+    preprocessing function is given; other callers must call it directly.
+
+    :param file_path: A path to an \*.swc file.
+    :return: An SWCArray whose components are sorted by the number of nodes, in
+        decreasing order as in :func:`swc.read_swc`. Within each component, the nodes
+        are in breadth-first order, as for :func:`swc.SWCArray_of`: they are sorted by
+        their depth, nodes of the same depth are sorted by the position of their
+        parent, and siblings are in the order in which they appear in the file.
+    """
+    try:
+        with warnings.catch_warnings():
+            # An empty file is not an error.
+            warnings.simplefilter("ignore", UserWarning)
+            table = np.loadtxt(
+                file_path, comments="#", usecols=range(7), ndmin=2, dtype=np.float64
+            )
+    except ValueError:
+        # Let the line-by-line reader report which row is malformed.
+        read_swc_node_dict(file_path)
+        raise
+    sample_number = table[:, 0].astype(np.int32)
+    parent_sample_number = table[:, 6].astype(np.int32)
+    by_sample_number = np.argsort(sample_number, kind="stable")
+    sorted_sample_numbers = sample_number[by_sample_number]
+    if np.any(sorted_sample_numbers[1:] == sorted_sample_numbers[:-1]):
+        raise ValueError("File " + file_path + " has repeated sample numbers.")
+    has_parent = parent_sample_number != -1
+    position = np.searchsorted(sorted_sample_numbers, parent_sample_number[has_parent])
+    position[position == sorted_sample_numbers.shape[0]] = 0
+    if np.any(sorted_sample_numbers[position] != parent_sample_number[has_parent]):
+        raise ValueError(
+            "File "
+            + file_path
+            + " refers to a parent sample number which is not in the file."
+        )
+    parent = np.full(sample_number.shape[0], -1, dtype=np.int32)
+    parent[has_parent] = by_sample_number[position]
+    unsorted = SWCArray(
+        sample_number=sample_number,
+        structure_id=table[:, 1].astype(np.int32),
+        coords=np.ascontiguousarray(table[:, 2:5]),
+        radius=np.ascontiguousarray(table[:, 5]),
+        parent=parent,
+    )
+    depth, root = unsorted._sum_to_root(has_parent.astype(np.int_))
+    component_size = np.bincount(root, minlength=len(unsorted))[root]
+    file_position = np.arange(len(unsorted))
+    # rank[i] is the position of node i among the nodes of the same depth; the
+    # ranks of each depth are assigned from those of the depth above.
+    rank = np.zeros(len(unsorted), dtype=np.int_)
+    by_depth = np.argsort(depth, kind="stable")
+    level_starts = np.searchsorted(depth[by_depth], np.arange(depth.max(initial=0) + 2))
+    for d in range(level_starts.shape[0] - 1):
+        level = by_depth[level_starts[d] : level_starts[d + 1]]
+        if d == 0:
+            level_order = np.lexsort((file_position[level], -component_size[level]))
+        else:
+            level_order = np.lexsort((file_position[level], rank[parent[level]]))
+        rank[level[level_order]] = np.arange(level.shape[0])
+    order = np.lexsort((rank, depth, rank[root]))
+    return unsorted.subarray(order)
+
+
 def linearize(forest: SWCForest) -> list[NeuronNode]:
     """
     Linearize the SWCForest into a list of NeuronNodes where the sample number of each node is just
@@ -291,6 +365,246 @@ def forest_from_linear(ell: list[NeuronNode]) -> SWCForest:
     return components
 
 
+@dataclass(eq=False)
+class SWCArray:
+    r"""
+    A compact representation of the contents of an \*.swc file as a structure of arrays, \
+    with one entry in each array for each node. The nodes are topologically sorted, i.e., \
+    the parent of each node comes before it, so that parents can be handled before their \
+    children by operating on the arrays in order.
+
+    An SWCArray takes roughly a tenth of the memory of the equivalent
+    :class:`swc.SWCForest`, is cheap to serialize, and the functions on it are
+    vectorized with NumPy rather than traversing the graph in Python.
+
+    :ivar sample_number: The sample number of each node.
+    :ivar structure_id: The structure id of each node.
+    :ivar coords: An array of shape (n,3), the xyz coordinates of each node.
+    :ivar radius: The radius of each node.
+    :ivar parent: The index in the arrays (not the sample number) of the parent of each \
+        node, or -1 if the node is a root.
+    """
+
+    sample_number: npt.NDArray[np.int32]
+    structure_id: npt.NDArray[np.int32]
+    coords: npt.NDArray[np.float64]
+    radius: npt.NDArray[np.float64]
+    parent: npt.NDArray[np.int32]
+
+    def __len__(self) -> int:
+        return self.parent.shape[0]
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SWCArray)
+            and np.array_equal(self.sample_number, other.sample_number)
+            and np.array_equal(self.structure_id, other.structure_id)
+            and np.array_equal(self.coords, other.coords)
+            and np.array_equal(self.radius, other.radius)
+            and np.array_equal(self.parent, other.parent)
+        )
+
+    def roots(self) -> npt.NDArray[np.int_]:
+        """
+        :return: The indices of the roots of the components, in order.
+        """
+        return np.flatnonzero(self.parent < 0)
+
+    def edge_lengths(self) -> npt.NDArray[np.float64]:
+        """
+        :return: The Euclidean distance between each node and its parent (0 for the roots).
+        """
+        has_parent = self.parent >= 0
+        lengths = np.zeros(len(self), dtype=np.float64)
+        lengths[has_parent] = np.linalg.norm(
+            self.coords[has_parent] - self.coords[self.parent[has_parent]], axis=1
+        )
+        return lengths
+
+    def _sum_to_root(
+        self, values: npt.NDArray
+    ) -> tuple[npt.NDArray, npt.NDArray[np.int_]]:
+        """
+        Sum `values` along the path from each node to the root of its component.
+
+        This uses pointer jumping: each step doubles the length of the path that has
+        been summed over, so there are O(log depth) vectorized passes.
+
+        :return: The sums, and the index of the root of each node's component.
+        :raises ValueError: If the parent pointers contain a cycle.
+        """
+        sums = values.copy()
+        ancestor = self.parent.astype(np.int_)
+        root = np.arange(len(self))
+        active = np.flatnonzero(ancestor >= 0)
+        for _ in range(len(self).bit_length() + 1):
+            if active.shape[0] == 0:
+                return sums, root
+            up = ancestor[active]
+            sums[active] += sums[up]
+            root[active] = root[up]
+            ancestor[active] = ancestor[up]
+            active = active[ancestor[active] >= 0]
+        raise ValueError("The parent pointers contain a cycle.")
+
+    def root_distances(self) -> npt.NDArray[np.float64]:
+        """
+        :return: The geodesic distance between each node and the root of its component.
+        """
+        return self._sum_to_root(self.edge_lengths())[0]
+
+    def node_depths(self) -> npt.NDArray[np.int_]:
+        """
+        :return: The number of edges between each node and the root of its component.
+        """
+        return self._sum_to_root((self.parent >= 0).astype(np.int_))[0]
+
+    def component_roots(self) -> npt.NDArray[np.int_]:
+        """
+        :return: The index of the root of the component of each node.
+        """
+        return self._sum_to_root(np.zeros(len(self), dtype=np.int_))[1]
+
+    def total_length(self) -> float:
+        """
+        Return the sum of lengths of all edges in the graph.
+        """
+        return float(np.sum(self.edge_lengths()))
+
+    def weighted_depth(self) -> float:
+        """
+        Return the maximal geodesic distance from the root of a component to any \
+        node in the same component.
+        """
+        return float(np.max(self.root_distances(), initial=0.0))
+
+    def discrete_depth(self) -> int:
+        """
+        Return the maximal number of edges between the root of a component and \
+        any node in the same component.
+        """
+        return int(np.max(self.node_depths(), initial=0))
+
+    def branching_degree(self) -> npt.NDArray[np.int_]:
+        """
+        :return: The number of children of each node.
+        """
+        return np.bincount(self.parent[self.parent >= 0], minlength=len(self))
+
+    def node_type_counts(self) -> dict[int, int]:
+        """
+        :return: A dictionary whose keys are all structure_id's in the graph and whose \
+            values are the multiplicities with which that node type occurs.
+        """
+        ids, counts = np.unique(self.structure_id, return_counts=True)
+        return {int(i): int(c) for i, c in zip(ids, counts)}
+
+    def subarray(self, index: npt.NDArray[np.int_]) -> SWCArray:
+        """
+        Restrict to the nodes in `index`. A node whose parent is not in `index` \
+        becomes a root.
+
+        :param index: Indices of nodes, such that each node in `index` which has its \
+            parent in `index` comes after its parent.
+        """
+        position = np.full(len(self), -1, dtype=np.int32)
+        position[index] = np.arange(index.shape[0], dtype=np.int32)
+        parent = self.parent[index]
+        return SWCArray(
+            sample_number=self.sample_number[index],
+            structure_id=self.structure_id[index],
+            coords=self.coords[index],
+            radius=self.radius[index],
+            parent=np.where(parent >= 0, position[parent], -1).astype(np.int32),
+        )
+
+    def filter(self, keep: npt.NDArray[np.bool_]) -> SWCArray:
+        """
+        Return the subgraph of nodes for which `keep` is True. As for \
+        :func:`swc.filter_forest`, a node whose parent is removed becomes a root.
+
+        :param keep: A boolean array of length `len(self)`, for example \
+            `np.isin(arr.structure_id, [1, 3, 4])`.
+        """
+        return self.subarray(np.flatnonzero(keep))
+
+    def components(self) -> list[SWCArray]:
+        """
+        :return: The connected components of the graph, sorted by the number of nodes \
+            in decreasing order as in :func:`swc.read_swc`.
+        """
+        roots = self.component_roots()
+        order = np.argsort(roots, kind="stable")
+        starts = np.flatnonzero(np.diff(roots[order], prepend=-1))
+        pieces = np.split(order, starts[1:])
+        pieces.sort(key=len, reverse=True)
+        return [self.subarray(piece) for piece in pieces]
+
+
+def SWCArray_of(forest: SWCForest) -> SWCArray:
+    """
+    Convert an SWCForest to an SWCArray. The nodes are listed component by component, \
+    each component in breadth-first order, as for :func:`swc.linearize`; but unlike \
+    :func:`swc.linearize` the sample numbers are kept.
+    """
+    nodes: list[NeuronNode] = []
+    parents: list[int] = []
+    for top_level_tree in forest:
+        # queue is a queue of ordered pairs (index, tree) where index is the
+        # position of the parent of tree in nodes.
+        queue: deque[tuple[int, NeuronTree]] = deque([(-1, top_level_tree)])
+        while bool(queue):
+            parent_index, tree = queue.popleft()
+            queue.extend(
+                (len(nodes), child_tree) for child_tree in tree.child_subgraphs
+            )
+            nodes.append(tree.root)
+            parents.append(parent_index)
+    return SWCArray(
+        sample_number=np.array([node.sample_number for node in nodes], dtype=np.int32),
+        structure_id=np.array([node.structure_id for node in nodes], dtype=np.int32),
+        coords=np.array(
+            [node.coord_triple for node in nodes], dtype=np.float64
+        ).reshape(-1, 3),
+        radius=np.array([node.radius for node in nodes], dtype=np.float64),
+        parent=np.array(parents, dtype=np.int32),
+    )
+
+
+def forest_from_array(arr: SWCArray) -> SWCForest:
+    """
+    Convert an SWCArray to an SWCForest, with one tree for each root in `arr`, \
+    in the same order. This is inverse to :func:`swc.SWCArray_of`. The parent sample \
+    number of each node is the sample number of its parent in `arr`, or -1 for a root.
+    """
+    sample_numbers = arr.sample_number.tolist()
+    trees: list[NeuronTree] = []
+    components: SWCForest = []
+    for sample_number, structure_id, coords, radius, parent in zip(
+        sample_numbers,
+        arr.structure_id.tolist(),
+        arr.coords.tolist(),
+        arr.radius.tolist(),
+        arr.parent.tolist(),
+    ):
+        tree = NeuronTree(
+            root=NeuronNode(
+                sample_number=sample_number,
+                structure_id=structure_id,
+                coord_triple=(coords[0], coords[1], coords[2]),
+                radius=radius,
+                parent_sample_number=sample_numbers[parent] if parent >= 0 else -1,
+            ),
+            child_subgraphs=[],
+        )
+        trees.append(tree)
+        if parent >= 0:
+            trees[parent].child_subgraphs.append(tree)
+        else:
+            components.append(tree)
+    return components
+
+
 def write_swc(outfile: str, forest: SWCForest) -> None:
     """
     Write `forest` to `outfile`. Overwrite whatever is in `outfile`.
@@ -630,14 +944,7 @@ def total_length(tree: NeuronTree) -> float:
     """
     Return the sum of lengths of all edges in the graph.
     """
-    acc_length = 0.0
-    for tree0 in tree:
-        for child_tree in tree0.child_subgraphs:
-            acc_length += euclidean(
-                np.array(tree0.root.coord_triple),
-                np.array(child_tree.root.coord_triple),
-            )
-    return acc_length
+    return SWCArray_of([tree]).total_length()
 
 
 def weighted_depth(tree: NeuronTree) -> float:
@@ -645,27 +952,7 @@ def weighted_depth(tree: NeuronTree) -> float:
     Return the weighted depth/ weighted height of the tree,
     i.e., the maximal geodesic distance from the root to any other point.
     """
-    treelist = [(tree, 0.0)]
-    max_depth = 0.0
-
-    while bool(treelist):
-        newlist: list[tuple[NeuronTree, float]] = []
-        for tree0, depth in treelist:
-            if depth > max_depth:
-                max_depth = depth
-            for child_tree in tree0.child_subgraphs:
-                newlist.append(
-                    (
-                        child_tree,
-                        depth
-                        + euclidean(
-                            np.array(tree0.root.coord_triple),
-                            np.array(child_tree.root.coord_triple),
-                        ),
-                    )
-                )
-        treelist = newlist
-    return max_depth
+    return SWCArray_of([tree]).weighted_depth()
 
 
 def discrete_depth(tree: NeuronTree) -> int:
@@ -769,10 +1056,16 @@ def diagnostics(
     test: Callable[[SWCForest], Optional[Err[str]]],
     parallel_processes: int,
     name_validate: Callable[[str], bool] = default_name_validate,
+    executor: Optional[Executor] = None,
 ) -> None:
     """
     Go through every SWC in infolder and apply `test` to the forest. \
     Print the names of cells failing the tests.
+
+    :param executor: Where to run the tests, see :class:`cajal.parallel.Executor`.
+        If given, `parallel_processes` is ignored; it must be able to run closures, so
+        its backend should not be "processes" or "cluster". By default a "dill"
+        backend with `parallel_processes` workers is used.
     """
 
     cell_names, file_paths = get_filenames(infolder, name_validate)
@@ -781,16 +1074,14 @@ def diagnostics(
         loaded_forest, _ = read_swc(file_path)
         return test(loaded_forest)
 
-    pool = ProcessPool(nodes=parallel_processes)
-    results = pool.imap(check_errs, file_paths)
+    executor = default_executor(executor, parallel_processes, "dill")
+    results = executor.imap(check_errs, file_paths)
 
     for cell_name, result in zip(cell_names, results):
         if isinstance(result, Err):
             print(cell_name + " " + str(result.code))
-
-    pool.close()
-    pool.join()
-    pool.clear()
+        elif isinstance(result, TaskFailure):
+            print(cell_name + " " + repr(result.exception))
 
 
 def read_preprocess_save(
@@ -852,6 +1143,7 @@ def batch_filter_and_preprocess(
     err_log: Optional[str],
     suffix: Optional[str] = None,
     name_validate: Callable[[str], bool] = default_name_validate,
+    executor: Optional[Executor] = None,
 ) -> None:
     r"""
 
@@ -882,6 +1174,9 @@ def batch_filter_and_preprocess(
         starting with '.', the marker for hidden files on Linux. The user may need \
         to write their own function to ensure that various kinds of backup /autosave files \
         and metadata files are not read into memory.
+    :param executor: Where to run the computation, see :func:`cajal.swc.diagnostics`. \
+        If its `on_error` is "return", cells on which reading or preprocessing raised \
+        an exception are written to `err_log` together with the exception.
     """
 
     if suffix is None:
@@ -898,21 +1193,22 @@ def batch_filter_and_preprocess(
         outpath = os.path.join(outfolder, cell_name + suffix + ".swc")
         return read_preprocess_save(file_path, outpath, preprocess)
 
-    pool = ProcessPool(nodes=parallel_processes)
-    results = pool.imap(rps, zip(cell_names, file_paths))
+    executor = default_executor(executor, parallel_processes, "dill")
+    results = executor.imap(rps, list(zip(cell_names, file_paths)))
 
-    if err_log is not None:
-        with open(err_log, "w", newline="") as outfile:
-            for cell_name, result in zip(cell_names, results):
-                if result == "success":
-                    pass
-                elif isinstance(result, Err):
+    outfile = open(err_log, "w", newline="") if err_log is not None else None
+    try:
+        for cell_name, result in zip(cell_names, results):
+            if result == "success":
+                pass
+            elif isinstance(result, Err):
+                if outfile is not None:
                     outfile.write(cell_name + " " + str(result.code) + "\n")
-                else:
-                    raise ValueError(
-                        "Should be error result or 'success' string literal."
-                    )
-
-    pool.close()
-    pool.join()
-    pool.clear()
+            elif isinstance(result, TaskFailure):
+                if outfile is not None:
+                    outfile.write(cell_name + " " + repr(result.exception) + "\n")
+            else:
+                raise ValueError("Should be error result or 'success' string literal.")
+    finally:
+        if outfile is not None:
+            outfile.close()
@@ -7,6 +7,7 @@ from dataclasses import dataclass
 from typing import Union
 
 import numpy as np
+import numpy.typing as npt
 from scipy.spatial.distance import euclidean
 
 from .swc import NeuronTree
@@ -108,3 +109,81 @@ def weighted_depth_wt(tree: WeightedTree) -> float:
                 newlist.append((child_tree, depth + child_tree.dist))
         treelist = newlist
     return max_depth
+
+
+@dataclass
+class WeightedTreeArrays:
+    """
+    A WeightedTree flattened into arrays, for computing many geodesic distances \
+    at once. The nodes are numbered in breadth-first order, starting with the root at 0.
+
+    :ivar nodes: The nodes of the tree; node `i` is `nodes[i]`.
+    :ivar parent: The parent of each node. The root is its own parent.
+    :ivar depth: The unweighted depth of each node, i.e., the number of edges \
+        between it and the root.
+    :ivar dist_from_root: The weighted distance between each node and the root.
+    :ivar ancestors: An array of shape (k, n), where `ancestors[j, i]` is the \
+        ancestor of node `i` which is 2^j edges above it (or the root, if there is none).
+    """
+
+    nodes: list[WeightedTree]
+    parent: npt.NDArray[np.int_]
+    depth: npt.NDArray[np.int_]
+    dist_from_root: npt.NDArray[np.float_]
+    ancestors: npt.NDArray[np.int_]
+
+    def lca(
+        self, a: npt.NDArray[np.int_], b: npt.NDArray[np.int_]
+    ) -> npt.NDArray[np.int_]:
+        """
+        Compute the lowest common ancestors of the pairs of nodes (a[k], b[k]), \
+        by binary lifting.
+
+        :param a: Node indices.
+        :param b: Node indices, an array of the same shape as `a`.
+        :return: An array of the same shape as `a`, whose k-th entry is the deepest \
+            node lying above both a[k] and b[k]. A node counts as lying above itself.
+        """
+        swap = self.depth[a] < self.depth[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        # Lift the deeper node of each pair to the depth of the other one.
+        diff = self.depth[a] - self.depth[b]
+        for j in range(self.ancestors.shape[0]):
+            a = np.where((diff >> j) & 1, self.ancestors[j][a], a)
+        # Lift both nodes as far as possible while keeping them apart.
+        for j in reversed(range(self.ancestors.shape[0])):
+            up_a = self.ancestors[j][a]
+            up_b = self.ancestors[j][b]
+            apart = up_a != up_b
+            a = np.where(apart, up_a, a)
+            b = np.where(apart, up_b, b)
+        return np.where(a == b, a, self.parent[a])
+
+
+def WeightedTreeArrays_of(tree: WeightedTreeRoot) -> WeightedTreeArrays:
+    """
+    Flatten `tree` into a :class:`cajal.weighted_tree.WeightedTreeArrays`.
+    """
+    nodes: list[WeightedTree] = [tree]
+    parent: list[int] = [0]
+    depth: list[int] = [0]
+    dist_from_root: list[float] = [0.0]
+    i = 0
+    while i < len(nodes):
+        for child_tree in nodes[i].subtrees:
+            nodes.append(child_tree)
+            parent.append(i)
+            depth.append(depth[i] + 1)
+            dist_from_root.append(dist_from_root[i] + child_tree.dist)
+        i += 1
+    parent_arr = np.array(parent, dtype=np.int_)
+    ancestors = [parent_arr]
+    for _ in range(1, max(depth).bit_length()):
+        ancestors.append(ancestors[-1][ancestors[-1]])
+    return WeightedTreeArrays(
+        nodes=nodes,
+        parent=parent_arr,
+        depth=np.array(depth, dtype=np.int_),
+        dist_from_root=np.array(dist_from_root, dtype=np.float64),
+        ancestors=np.array(ancestors, dtype=np.int_).reshape(-1, len(nodes)),
+    )
@@ -0,0 +1,58 @@
+from cajal.parallel import Executor, TaskFailure, adaptive_chunksize
+from cajal.run_gw import cell_iterator_csv, uniform, gw_pairwise_parallel
+from cajal.qgw import slb_parallel_memory
+import numpy as np
+
+
+def _square(x):
+    if x == 3:
+        raise ValueError("three")
+    return x * x
+
+
+def _init_offset(offset):
+    global _OFFSET
+    _OFFSET = offset
+
+
+def _add_offset(x):
+    return x + _OFFSET
+
+
+def test_executor():
+    for backend in ["serial", "threads", "processes", "dill", "cluster"]:
+        executor = Executor(backend, num_workers=2, on_error="return")
+        results = list(executor.imap(_square, range(10)))
+        assert isinstance(results[3], TaskFailure)
+        assert results[3].item == 3
+        assert [x for i, x in enumerate(results) if i != 3] == [
+            i * i for i in range(10) if i != 3
+        ]
+        with executor.session(_init_offset, (100,)) as session:
+            for _ in range(2):
+                results = session.imap(_add_offset, range(10), ordered=False)
+                assert sorted(results) == list(range(100, 110))
+        try:
+            list(Executor(backend, num_workers=2).imap(_square, range(10)))
+            assert False
+        except ValueError:
+            pass
+    assert adaptive_chunksize(None, 4) == 1
+    assert adaptive_chunksize(80, 4) == 5
+    assert adaptive_chunksize(10**6, 4) == 100
+
+
+def test_drivers():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:5]]
+    gw_dmat, _ = gw_pairwise_parallel(cells, num_processes=2)
+    for backend in ["serial", "threads", "cluster"]:
+        gw_dmat_executor, _ = gw_pairwise_parallel(
+            cells, num_processes=2, executor=Executor(backend, num_workers=2)
+        )
+        assert np.allclose(gw_dmat, gw_dmat_executor)
+    slb_dmat = slb_parallel_memory(icdms[:5], None, 2)
+    slb_dmat_serial = slb_parallel_memory(
+        icdms[:5], None, 2, executor=Executor("serial")
+    )
+    assert np.allclose(slb_dmat, slb_dmat_serial)
@@ -1,4 +1,19 @@
-from cajal.qgw import slb_parallel, combined_slb_quantized_gw
+from cajal.qgw import (
+    slb_parallel,
+    slb_parallel_memory,
+    tlb_parallel,
+    tlb_parallel_memory,
+    combined_slb_quantized_gw,
+    quantized_fused_gw_parallel_memory,
+    quantized_gw_parallel,
+    quantized_icdm,
+    quantized_gw,
+    quantize_cells_parallel,
+)
+from cajal.parallel import Executor
+from cajal.run_gw import cell_iterator_csv, gw, uniform
+from scipy.spatial.distance import pdist, squareform
+import numpy as np
 import os
 
 def test():
@@ -8,6 +23,12 @@ def test():
         num_processes=2,
     )
     os.remove("tests/gw1.csv")
+    tlb_parallel(
+        intracell_csv_loc="tests/icdm.csv",
+        out_csv="tests/tlb.csv",
+        num_processes=2,
+    )
+    os.remove("tests/tlb.csv")
     combined_slb_quantized_gw(
         input_icdm_csv_location="tests/icdm.csv",
         gw_out_csv_location="tests/slb_qgw.csv",
@@ -18,3 +39,134 @@ def test():
         verbose=False,
         chunksize=20
     )
+    combined_slb_quantized_gw(
+        input_icdm_csv_location="tests/icdm.csv",
+        gw_out_csv_location="tests/tlb_qgw.csv",
+        num_processes=2,
+        num_clusters=20,
+        accuracy=0.97,
+        nearest_neighbors=3,
+        verbose=False,
+        chunksize=20,
+        lower_bound="tlb",
+    )
+    os.remove("tests/tlb_qgw.csv")
+
+
+def test_quantized_fused():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    rng = np.random.default_rng(0)
+    cells = [(A, uniform(A.shape[0]), rng.random((A.shape[0], 2))) for A in icdms[:5]]
+    dmat = quantized_fused_gw_parallel_memory(
+        cells, num_processes=2, num_clusters=20, alpha=0.5
+    )
+    assert dmat.shape == (5, 5)
+    # With alpha = 1 the features are ignored.
+    dmat = quantized_fused_gw_parallel_memory(
+        cells, num_processes=2, num_clusters=20, alpha=1.0
+    )
+    qcells = [quantized_icdm(A, a, 20) for A, a, _ in cells]
+    for i in range(5):
+        for j in range(i + 1, 5):
+            _, qgw_dist = quantized_gw(qcells[i], qcells[j])
+            assert abs(dmat[i, j] - qgw_dist) <= 1e-8 * qgw_dist
+
+
+def test_quantized_partial():
+    quantized_gw_parallel(
+        intracell_csv_loc="tests/icdm.csv",
+        num_processes=2,
+        num_clusters=20,
+        out_csv="tests/qgw_partial.csv",
+        transported_mass=0.8,
+    )
+    os.remove("tests/qgw_partial.csv")
+    # Y is the left 80% of X, so the partial distance should be the smaller one.
+    rng = np.random.default_rng(0)
+    pts = rng.random((300, 3))
+    X = squareform(pdist(pts[np.argsort(pts[:, 0])]))
+    Y = np.ascontiguousarray(X[:240, :240])
+    qX = quantized_icdm(X, uniform(300), 20)
+    qY = quantized_icdm(Y, uniform(240), 20)
+    _, qgw_dist = quantized_gw(qX, qY)
+    P, partial_dist = quantized_gw(qX, qY, transported_mass=0.8)
+    assert abs(P.sum() - 0.8) <= 1e-10
+    assert np.all(P.sum(axis=1) <= 1 / 300 + 1e-12)
+    assert np.all(P.sum(axis=0) <= 1 / 240 + 1e-12)
+    assert partial_dist < qgw_dist
+
+
+def test_quantized_float32():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    q64 = [quantized_icdm(A, uniform(A.shape[0]), 20) for A in icdms[:3]]
+    q32 = [
+        quantized_icdm(A, uniform(A.shape[0]), 20, dtype=np.float32) for A in icdms[:3]
+    ]
+    assert q32[0].icdm.dtype == np.float32
+    for i, j in [(0, 1), (0, 2), (1, 2)]:
+        _, d64 = quantized_gw(q64[i], q64[j])
+        _, d32 = quantized_gw(q32[i], q32[j])
+        assert abs(d64 - d32) <= 1e-5 * d64
+
+
+def test_quantized_loss():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    A, B = [quantized_icdm(A, uniform(A.shape[0]), 20) for A in icdms[:2]]
+    P_dense, d_dense = quantized_gw(A, B, loss="dense")
+    P_sparse, d_sparse = quantized_gw(A, B, loss="sparse")
+    assert abs(d_dense - d_sparse) <= 1e-8 * d_dense
+    _, d_approx = quantized_gw(A, B, loss="approximate")
+    assert d_approx >= 0
+    _, d_dense = quantized_gw(A, B, transported_mass=0.8, loss="dense")
+    _, d_sparse = quantized_gw(A, B, transported_mass=0.8, loss="sparse")
+    assert abs(d_dense - d_sparse) <= 1e-8 * d_dense
+
+
+def test_quantize():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:4]]
+    for method in ["hierarchical", "kmedoids", "minibatch_kmedoids", "farthest_point"]:
+        for q, (A, _) in zip(
+            quantize_cells_parallel(cells, 2, 10, method=method), cells
+        ):
+            perm = q.permutation
+            assert np.array_equal(q.icdm, A[np.ix_(perm, perm)])
+            assert np.array_equal(
+                q.sub_icdm, q.icdm[np.ix_(q.q_indices[:-1], q.q_indices[:-1])]
+            )
+            for c in range(q.ns):
+                block = q.icdm[
+                    q.q_indices[c] : q.q_indices[c + 1],
+                    q.q_indices[c] : q.q_indices[c + 1],
+                ]
+                # The medoid comes first, and the other points are sorted by distance to it.
+                assert np.isclose(block[0].sum(), block.sum(axis=0).min())
+                assert np.all(np.diff(block[0]) >= 0)
+
+
+def test_quantize_failure():
+    _, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:4]]
+    # A distribution with the wrong number of points.
+    cells[2] = (cells[2][0], uniform(cells[2][0].shape[0] - 1))
+    for backend in ["serial", "processes"]:
+        try:
+            quantize_cells_parallel(
+                cells, 2, 10, executor=Executor(backend, 2, on_error="return")
+            )
+            assert False
+        except ValueError as e:
+            assert str(e) == "Could not quantize the cells at indices [2]"
+
+
+def test_lower_bounds():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    slb = slb_parallel_memory(list(icdms), None, 2)
+    tlb = tlb_parallel_memory(list(icdms), None, 2)
+    N = len(icdms)
+    for i in range(N):
+        for j in range(i + 1, N):
+            a, b = uniform(icdms[i].shape[0]), uniform(icdms[j].shape[0])
+            _, gw_dist = gw(icdms[i], a, icdms[j], b)
+            assert slb[i, j] <= tlb[i, j] + 1e-10
+            assert tlb[i, j] <= gw_dist + 1e-10
@@ -1,4 +1,16 @@
-from cajal.run_gw import compute_gw_distance_matrix
+from cajal.run_gw import (
+    compute_gw_distance_matrix,
+    cell_iterator_csv,
+    uniform,
+    gw,
+    partial_gw,
+    gw_pairwise_parallel,
+    fused_gw_pairwise_parallel,
+    _split_parallelism,
+)
+from cajal.gw_cython import openmp_available
+from scipy.spatial.distance import pdist, squareform
+import numpy as np
 import os
 
 
@@ -20,3 +32,85 @@ def test():
         gw_coupling_mat_csv_loc="tests/gw_coupling_mat.csv",
         verbose=False,
     )
+    compute_gw_distance_matrix(
+        intracell_csv_loc="tests/icdm.csv",
+        gw_dist_csv_loc="tests/gw_partial.csv",
+        num_processes=2,
+        verbose=False,
+        transported_mass=0.8,
+    )
+    os.remove("tests/gw_partial.csv")
+
+
+def test_fused():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:5]]
+    rng = np.random.default_rng(0)
+    fused_cells = [
+        (
+            A,
+            a,
+            np.stack((rng.random(A.shape[0]), rng.integers(1, 4, A.shape[0])), axis=1),
+        )
+        for A, a in cells
+    ]
+    gw_dmat, _ = gw_pairwise_parallel(cells, num_processes=2)
+    fused_dmat, _ = fused_gw_pairwise_parallel(
+        fused_cells, num_processes=2, alpha=1.0, categorical_columns=[1]
+    )
+    assert np.allclose(gw_dmat, fused_dmat)
+    fused_gw_pairwise_parallel(
+        fused_cells, num_processes=2, alpha=0.5, categorical_columns=[1]
+    )
+
+
+def test_partial_gw():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    A, B = icdms[0], icdms[1]
+    a, b = uniform(A.shape[0]), uniform(B.shape[0])
+    _, gw_dist = gw(A, a, B, b)
+    _, partial_dist = partial_gw(A, a, B, b, 1.0)
+    assert abs(partial_dist - gw_dist) <= 1e-8 * gw_dist
+    P, _ = partial_gw(A, a, B, b, 0.8)
+    assert abs(P.sum() - 0.8) <= 1e-10
+    assert np.all(P.sum(axis=1) <= a + 1e-12)
+    assert np.all(P.sum(axis=0) <= b + 1e-12)
+    # Y is a truncated copy of X, so 80% of the mass of X matches Y exactly.
+    rng = np.random.default_rng(0)
+    X = squareform(pdist(rng.random((60, 3))))
+    Y = np.ascontiguousarray(X[:48, :48])
+    _, gw_dist = gw(X, uniform(60), Y, uniform(48))
+    _, partial_dist = partial_gw(X, uniform(60), Y, uniform(48), 0.8)
+    assert partial_dist <= 1e-6 * gw_dist
+
+
+def test_float32():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:5]]
+    gw_dmat, _ = gw_pairwise_parallel(cells, num_processes=2)
+    gw_dmat32, _ = gw_pairwise_parallel(cells, num_processes=2, dtype=np.float32)
+    assert np.allclose(gw_dmat, gw_dmat32, rtol=1e-4)
+    partial_dmat32, _ = gw_pairwise_parallel(
+        cells, num_processes=2, transported_mass=0.8, dtype=np.float32
+    )
+    assert partial_dmat32.shape == (5, 5)
+
+
+def test_num_threads():
+    names, icdms = zip(*cell_iterator_csv("tests/icdm.csv"))
+    A, B = icdms[0], icdms[1]
+    a, b = uniform(A.shape[0]), uniform(B.shape[0])
+    _, dist = gw(A, a, B, b)
+    _, dist_threaded = gw(A, a, B, b, num_threads=2)
+    assert np.isclose(dist, dist_threaded)
+    cells = [(A, uniform(A.shape[0])) for A in icdms[:4]]
+    gw_dmat, _ = gw_pairwise_parallel(cells, num_processes=2)
+    gw_dmat_threaded, _ = gw_pairwise_parallel(cells, num_processes=2, num_threads=2)
+    assert np.allclose(gw_dmat, gw_dmat_threaded)
+    # Many small problems are spread across processes.
+    assert _split_parallelism([50] * 10, 8, None) == (8, 1)
+    assert _split_parallelism([50] * 10, 8, 4) == (2, 4)
+    if openmp_available():
+        # A single large problem gets all the threads.
+        assert _split_parallelism([2000, 2000], 8, None) == (1, 8)
+        assert _split_parallelism([50, 50], 8, None, min_problem_size=2500) == (1, 8)
@@ -1,10 +1,25 @@
 from src.cajal.sample_mesh import (
+    read_obj,
+    connect_mesh,
+    disconnect_mesh,
+    _face_components,
     compute_icdm_all,
     _connect_helper,
     cell_generator,
     get_geodesic,
     sample_vertices,
+    sample_vertex_indices,
+    vertex_areas,
+    graph_geodesic_distances,
+    heat_solver,
+    get_geodesic_heat_one_mesh,
+    get_geodesic_heat_multi,
 )
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial.distance import cdist, pdist
+import networkx as nx
+import numpy as np
+import trimesh
 import os
 
 
@@ -21,3 +36,135 @@ def test():
             name, vertices, faces = next(cell_gen)
             sample_vertices(vertices, 20)
             get_geodesic(vertices, faces, 20, m)
+
+
+def test_graph_geodesic_distances():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    vertices, faces = np.asarray(mesh.vertices), np.asarray(mesh.faces)
+    graph = nx.Graph()
+    for face in faces:
+        for a, b in [(0, 1), (1, 2), (2, 0)]:
+            graph.add_edge(
+                face[a],
+                face[b],
+                weight=np.linalg.norm(vertices[face[a]] - vertices[face[b]]),
+            )
+    sample = np.array([0, 7, 50, 121])
+    dist_mat = graph_geodesic_distances(vertices, faces, sample)
+    for i, v in enumerate(sample):
+        for j, w in enumerate(sample):
+            assert np.isclose(
+                dist_mat[i, j], nx.shortest_path_length(graph, v, w, weight="weight")
+            )
+
+
+def test_heat_multi():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    vertices, faces = np.asarray(mesh.vertices), np.asarray(mesh.faces)
+    assert heat_solver(vertices, faces) is heat_solver(vertices.copy(), faces.copy())
+    dist_vecs = get_geodesic_heat_multi(vertices, faces, [10, 30])
+    for n, dist_vec in zip([10, 30], dist_vecs):
+        assert np.allclose(dist_vec, get_geodesic_heat_one_mesh(vertices, faces, n))
+
+
+def test_read_obj():
+    obj_file = "tests/test_read_obj.obj"
+    with open(obj_file, "w") as f:
+        f.write(
+            "# comment\n"
+            "v 0 0 0\n"
+            "v  1.5 0 0 1.0\n"
+            "vt 0.5 0.5\n"
+            "vn 0 0 1\n"
+            "v 1 1 0 # comment\n"
+            "v 0 1 0 0.2 0.3 0.4\n"
+            "f 1/1/1 2/1/1 3/1/1\n"
+            "f 1//1  3//1 4//1\n"
+            "f 1 2 3 4"
+        )
+    for block_size in [7, 1 << 20]:
+        vertices, faces = read_obj(obj_file, block_size)
+        assert np.array_equal(vertices, [[0, 0, 0], [1.5, 0, 0], [1, 1, 0], [0, 1, 0]])
+        assert np.array_equal(faces, [[0, 1, 2], [0, 2, 3], [0, 1, 2], [0, 2, 3]])
+    os.remove(obj_file)
+
+
+def test_connect_mesh():
+    meshes = [trimesh.creation.icosphere(subdivisions=s) for s in [2, 1, 0]]
+    centers = [[0, 0, 0], [5, 0, 0], [0, 10, 0]]
+    offsets = np.cumsum([0] + [len(m.vertices) for m in meshes])
+    vertices = np.vstack([m.vertices + c for m, c in zip(meshes, centers)])
+    faces = np.vstack([m.faces + o for m, o in zip(meshes, offsets)])
+
+    components = disconnect_mesh(vertices, faces)
+    assert len(components) == 3
+    for (vs, fs), m, c in zip(components, meshes, centers):
+        assert np.allclose(vs, m.vertices + c)
+        assert np.array_equal(fs, m.faces)
+
+    new_faces = connect_mesh(vertices, faces)
+    assert new_faces.shape == (faces.shape[0] + 2, 3)
+    assert np.array_equal(new_faces[: faces.shape[0]], faces)
+    assert _face_components(vertices.shape[0], new_faces)[1] == 1
+    # The new faces join the closest pairs of spheres at their nearest points.
+    lengths = sorted(
+        np.linalg.norm(vertices[a] - vertices[b]) for a, b, _ in new_faces[-2:]
+    )
+    sphere_dist = [
+        [np.min(cdist(v, w)) for w, _ in components[i + 1 :]]
+        for i, (v, _) in enumerate(components)
+    ]
+    assert np.allclose(
+        lengths, [sphere_dist[0][0], min(sphere_dist[0][1], sphere_dist[1][0])]
+    )
+    assert connect_mesh(vertices, new_faces) is new_faces
+
+    # Many fragments of different sizes, one of them larger than all others together.
+    rng = np.random.default_rng(0)
+    meshes = [trimesh.creation.icosphere(subdivisions=4)] + [
+        trimesh.creation.icosphere(subdivisions=s) for s in rng.integers(0, 2, 60)
+    ]
+    centers = rng.random((len(meshes), 3)) * 30
+    offsets = np.cumsum([0] + [len(m.vertices) for m in meshes])
+    vertices = np.vstack([m.vertices + c for m, c in zip(meshes, centers)])
+    faces = np.vstack([m.faces + o for m, o in zip(meshes, offsets)])
+    new_faces = connect_mesh(vertices, faces)
+    assert new_faces.shape == (faces.shape[0] + len(meshes) - 1, 3)
+    assert _face_components(vertices.shape[0], new_faces)[1] == 1
+    # The bridges form a minimum spanning tree of the distances between fragments.
+    fragments = [v for v, _ in disconnect_mesh(vertices, faces)]
+    fragment_dist = np.array(
+        [[np.min(cdist(v, w)) for w in fragments] for v in fragments]
+    )
+    length = sum(
+        np.linalg.norm(vertices[a] - vertices[b])
+        for a, b, _ in new_faces[faces.shape[0] :]
+    )
+    assert np.isclose(length, minimum_spanning_tree(fragment_dist).sum())
+
+
+def test_sample_vertex_indices():
+    mesh = trimesh.creation.icosphere(subdivisions=3)
+    vertices = np.asarray(mesh.vertices) * [3, 1, 1]
+    faces = np.asarray(mesh.faces)
+    assert np.isclose(
+        vertex_areas(vertices, faces).sum(), trimesh.Trimesh(vertices, faces).area
+    )
+    assert np.array_equal(
+        sample_vertices(vertices, 20),
+        vertices[np.linspace(0, vertices.shape[0] - 1, 20).astype("uint32")],
+    )
+    for sampling in ["area", "farthest"]:
+        sample = sample_vertex_indices(vertices, faces, 20, sampling, seed=1)
+        assert np.unique(sample).shape == (20,)
+        assert np.array_equal(
+            sample, sample_vertex_indices(vertices, faces, 20, sampling, seed=1)
+        )
+        assert get_geodesic(vertices, faces, 20, "heat", sampling).shape == (190,)
+    assert sample_vertex_indices(vertices[:10], faces[:0], 5, "area") is None
+    # Every vertex is at least as close to the farthest point sample as the
+    # sample points are to each other.
+    sample = sample_vertex_indices(vertices, faces, 30, "farthest")
+    assert cdist(vertices, vertices[sample]).min(axis=1).max() <= pdist(
+        vertices[sample]
+    ).min() * (1 + 1e-12)
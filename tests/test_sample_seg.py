@@ -1,6 +1,24 @@
-from src.cajal.sample_seg import cell_boundaries, compute_icdm_all
+from src.cajal.sample_seg import (
+    cell_boundaries,
+    compute_icdm_all,
+    open_tiff,
+    resample_curves,
+)
+from src.cajal.parallel import Executor
+from scipy.spatial.distance import pdist
+from skimage import measure
+import numpy as np
 import tifffile
+import csv
 import os
+import shutil
+import threading
+import time
+
+
+def _random_segmentation(rng: np.random.Generator) -> np.ndarray:
+    # A 60x60 image of rectangular cells with random labels.
+    return np.repeat(np.repeat(rng.integers(0, 200, (12, 15)), 5, 0), 4, 1)
 
 
 def test():
@@ -15,3 +33,115 @@ def test():
         "CAJAL/data/tiff_images_cleaned", "CAJAL/data/tiff_sampling.csv", 50
     )
     os.remove("CAJAL/data/tiff_sampling.csv")
+
+
+def test_cell_boundaries():
+    imarray = np.zeros((40, 50), dtype=np.int64)
+    imarray[5:15, 5:20] = 7
+    imarray[20:35, 10:40] = 1000000
+    imarray[25:30, 20:30] = 0  # a hole
+    imarray[0:10, 40:50] = 3  # touches the border
+    boundaries = cell_boundaries(imarray, 10)
+    assert [i for i, _ in boundaries] == [0, 1]
+    for (_, boundary), cell in zip(boundaries, [7, 1000000]):
+        contours = np.concatenate(
+            measure.find_contours((imarray == cell) * 1, 0.5, fully_connected="high")
+        )
+        indices = np.linspace(0, contours.shape[0] - 1, 10).astype("uint32")
+        assert np.allclose(boundary, contours[indices])
+    assert len(cell_boundaries(imarray, 10, discard_cells_with_holes=True)) == 1
+    # The longest boundary of the annulus is its exterior.
+    exterior = cell_boundaries(imarray, 200, only_longest=True)[1][1]
+    assert exterior[:, 0].min() < 20 and exterior[:, 0].max() > 34
+    resampled = cell_boundaries(imarray, 40, spacing="arc_length")
+    assert [boundary.shape for _, boundary in resampled] == [(40, 2), (40, 2)]
+
+
+def test_resample_curves():
+    square = np.array([[0, 0], [0, 4], [4, 4], [4, 0]], dtype=float)
+    assert np.allclose(
+        resample_curves([square], 8),
+        [[0, 0], [0, 2], [0, 4], [2, 4], [4, 4], [4, 2], [4, 0], [2, 0]],
+    )
+    # The points are shared among the curves in proportion to their lengths.
+    assert np.allclose(
+        resample_curves([square, square / 2 + 10], 6),
+        [[0, 0], [0, 4], [4, 4], [4, 0], [10, 10], [12, 12]],
+    )
+    assert np.allclose(
+        resample_curves([np.array([[0, 0], [0, 3.0]])], 4, closed=False),
+        [[0, 0], [0, 1], [0, 2], [0, 3]],
+    )
+
+
+def test_strip_rows():
+    imarray = _random_segmentation(np.random.default_rng(0))
+    expected = cell_boundaries(imarray, 10)
+    tiff_file = "tests/test_strip_rows.tif"
+    tifffile.imwrite(tiff_file, imarray, tile=(16, 16), compression="zlib")
+    for strip_rows in [1, 7, 100]:
+        boundaries = cell_boundaries(open_tiff(tiff_file), 10, strip_rows=strip_rows)
+        assert len(boundaries) == len(expected) > 0
+        for (_, boundary), (_, expected_boundary) in zip(boundaries, expected):
+            assert np.array_equal(boundary, expected_boundary)
+    os.remove(tiff_file)
+
+
+def test_compute_icdm_all():
+    rng = np.random.default_rng(1)
+    infolder = "tests/test_seg_tiffs"
+    os.makedirs(infolder, exist_ok=True)
+    images = {}
+    for name in ["a", "b"]:
+        images[name] = _random_segmentation(rng)
+        tifffile.imwrite(os.path.join(infolder, name + ".tif"), images[name])
+    out_csv = "tests/test_seg_icdm.csv"
+    for executor in [Executor("serial"), Executor("threads", num_workers=2)]:
+        assert compute_icdm_all(infolder, out_csv, 10, executor=executor) == []
+        with open(out_csv, newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            rows = {row[0]: np.array(row[1:], dtype=float) for row in reader}
+        assert len(rows) == sum(
+            len(cell_boundaries(imarray, 10)) for imarray in images.values()
+        )
+        for name, imarray in images.items():
+            for i, boundary in cell_boundaries(imarray, 10):
+                assert np.allclose(rows[name + "_" + str(i)], pdist(boundary))
+    # The temporary shard files are removed.
+    assert not [name for name in os.listdir("tests") if name.startswith("tmp")]
+    os.remove(out_csv)
+    shutil.rmtree(infolder)
+
+
+def test_compute_icdm_all_parallel():
+    infolder = "tests/test_seg_tiffs_parallel"
+    os.makedirs(infolder, exist_ok=True)
+    num_workers = 2
+    for i in range(8 * num_workers + 4):
+        tifffile.imwrite(os.path.join(infolder, str(i) + ".tif"), np.zeros((4, 4)))
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+    imread = tifffile.imread
+
+    def slow_imread(*args, **kwargs):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return imread(*args, **kwargs)
+
+    out_csv = "tests/test_seg_icdm_parallel.csv"
+    tifffile.imread = slow_imread
+    try:
+        compute_icdm_all(
+            infolder, out_csv, 10, executor=Executor("threads", num_workers)
+        )
+    finally:
+        tifffile.imread = imread
+    assert peak[0] == num_workers
+    os.remove(out_csv)
+    shutil.rmtree(infolder)
@@ -5,8 +5,23 @@ from src.cajal.sample_swc import (
     read_preprocess_compute_euclidean,
     compute_icdm_all_euclidean,
     compute_icdm_all_geodesic,
+    get_sample_pts_euclidean,
+    euclidean_point_cloud,
+    euclidean_point_cloud_features,
+    geodesic_features,
+    get_sample_pts_geodesic,
+    geodesic_distance,
+    geodesic_distances,
+    get_sample_coords_geodesic,
+    swc_landmarks,
 )
+from src.cajal.swc import read_swc, read_swc_array, NeuronNode, NeuronTree
 from src.cajal.utilities import Err
+from src.cajal.qgw import voronoi_clusters
+from src.cajal.parallel import Executor
+from scipy.spatial.distance import pdist, squareform
+import numpy as np
+import csv
 import os
 
 
@@ -51,3 +66,113 @@ def test_compute_icdm_both():
     )
     os.remove("tests/icdm_euclidean.csv")
     os.remove("tests/icdm_geodesic.csv")
+
+
+def test_sample_pts_euclidean():
+    # A path of length 15, from (0,0,0) to (10,0,0) to (10,5,0).
+    coords = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0), (10.0, 5.0, 0.0)]
+    nodes = [
+        NeuronNode(i + 1, 3, c, 1.0, i if i > 0 else -1) for i, c in enumerate(coords)
+    ]
+    tree = NeuronTree(root=nodes[2], child_subgraphs=[])
+    tree = NeuronTree(root=nodes[1], child_subgraphs=[tree])
+    tree = NeuronTree(root=nodes[0], child_subgraphs=[tree])
+    pts = get_sample_pts_euclidean([tree], 2.0)
+    expected = [(x, 0.0, 0.0) for x in range(0, 11, 2)]
+    expected += [(10.0, 2.0, 0.0), (10.0, 4.0, 0.0)]
+    assert np.allclose(np.stack(pts), expected)
+
+
+def test_features():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    forest, _ = read_swc(file_paths[0])
+    pts = euclidean_point_cloud(forest, 30)
+    features = euclidean_point_cloud_features(forest, 30)
+    assert features.shape == (pts.shape[0], 2)
+    assert geodesic_features(forest[0], 30).shape == (30, 2)
+
+
+def test_euclidean_swc_array():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    forest, _ = read_swc(file_paths[0])
+    arr = read_swc_array(file_paths[0])
+    pts = euclidean_point_cloud(arr, 50)
+    assert pts.shape == (50, 3)
+    assert np.array_equal(pts, euclidean_point_cloud(forest, 50))
+    assert np.array_equal(
+        euclidean_point_cloud_features(arr, 50),
+        euclidean_point_cloud_features(forest, 50),
+    )
+    # Every sample point lies on a line segment between a node and its parent.
+    children = np.flatnonzero(arr.parent >= 0)
+    for pt in pts:
+        a = arr.coords[arr.parent[children]] - pt
+        b = arr.coords[children] - pt
+        on_line = np.linalg.norm(np.cross(a, b), axis=1) < 1e-6 * (
+            1 + np.linalg.norm(a - b, axis=1)
+        )
+        between = np.sum(a * b, axis=1) <= 1e-9
+        assert np.any(on_line & between) or np.any(np.all(a == 0, axis=1))
+
+
+def test_geodesic_distances():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    forest, _ = read_swc(file_paths[0])
+    pts = get_sample_pts_geodesic(forest[0], 50)
+    expected = [
+        geodesic_distance(*pts[i], *pts[j])
+        for i in range(len(pts))
+        for j in range(i + 1, len(pts))
+    ]
+    assert np.allclose(geodesic_distances(pts), expected)
+
+
+def test_landmarks():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    forest, _ = read_swc(file_paths[0])
+    pts = euclidean_point_cloud(forest, 100)
+    landmarks = swc_landmarks(forest, pts, 20)
+    assert len(landmarks) <= 20
+    clusters = voronoi_clusters(squareform(pdist(pts)), landmarks)
+    assert np.array_equal(clusters[landmarks], np.arange(len(landmarks)))
+    coords = get_sample_coords_geodesic(
+        forest[0], get_sample_pts_geodesic(forest[0], 30)
+    )
+    assert coords.shape == (30, 3)
+    assert len(swc_landmarks(forest[:1], coords)) > 0
+
+
+def test_compute_icdm_parallel():
+    def rows(path):
+        with open(path, newline="") as f:
+            return {row[0]: row[1:] for row in csv.reader(f)}
+
+    swc_dir = "tests/swc"
+    compute_icdm_all_euclidean(
+        swc_dir, "tests/icdm_serial.csv", 20, executor=Executor("serial")
+    )
+    # A lambda is not picklable, so this runs with dill.
+    failed = compute_icdm_all_euclidean(
+        swc_dir,
+        "tests/icdm_parallel.csv",
+        20,
+        preprocess=lambda forest: forest,
+        num_processes=2,
+        ordered=False,
+    )
+    assert failed == []
+    assert rows("tests/icdm_serial.csv") == rows("tests/icdm_parallel.csv")
+    failed = compute_icdm_all_geodesic(
+        swc_dir,
+        "tests/icdm_parallel.csv",
+        20,
+        num_processes=2,
+        preprocess=lambda forest: forest[5],
+    )
+    # Cells with fewer than six components fail with an IndexError.
+    assert all(isinstance(err, Err) for _, err in failed)
+    assert len(failed) + len(rows("tests/icdm_parallel.csv")) - 1 == len(
+        get_filenames(swc_dir, default_name_validate)[0]
+    )
+    os.remove("tests/icdm_serial.csv")
+    os.remove("tests/icdm_parallel.csv")
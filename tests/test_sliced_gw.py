@@ -0,0 +1,38 @@
+from cajal.sliced_gw import sliced_gw_pairwise, random_projections, _sliced_gw_block
+import numpy as np
+import os
+
+
+def test_closed_form():
+    rng = np.random.default_rng(0)
+    K = 15
+    u = np.sort(rng.random(K))
+    v = np.sort(rng.random(K) * 2)
+    u -= u.mean()
+    v -= v.mean()
+
+    def brute_force(u, v):
+        du = (u[:, None] - u[None, :]) ** 2
+        dv = (v[:, None] - v[None, :]) ** 2
+        return ((du - dv) ** 2).sum() / K**2
+
+    expected = min(brute_force(u, v), brute_force(u, v[::-1]))
+    assert np.isclose(
+        _sliced_gw_block(u[None, None, :], v[None, None, :])[0, 0], expected
+    )
+
+
+def test():
+    rng = np.random.default_rng(0)
+    ptclouds = [rng.random((n, 3)) for n in (100, 150, 80, 120)]
+    projections = random_projections(3, 20, seed=0)
+    dmat = sliced_gw_pairwise(
+        ptclouds,
+        projections=projections,
+        names=["a", "b", "c", "d"],
+        gw_dist_csv="tests/sliced_gw.csv",
+        block_size=3,
+    )
+    assert dmat.shape == (4, 4)
+    assert np.allclose(dmat, dmat.T)
+    os.remove("tests/sliced_gw.csv")
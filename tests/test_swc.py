@@ -3,11 +3,14 @@ import math
 from shutil import rmtree
 from typing import Union
 
+import numpy as np
+
 from src.cajal.utilities import Err
 from src.cajal.swc import (
     batch_filter_and_preprocess,
     cell_iterator,
     default_name_validate,
+    get_filenames,
     linearize,
     forest_from_linear,
     read_swc_node_dict,
@@ -25,6 +28,9 @@ from src.cajal.swc import (
     diagnostics,
     _depth_table,
     _branching_degree,
+    SWCArray_of,
+    forest_from_array,
+    read_swc_array,
 )
 
 
@@ -190,3 +196,47 @@ def test_2():
 
 def test_diagnostics():
     diagnostics("tests/swc", lambda forest: None, 1)
+
+
+def test_swc_array():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    forest, _ = read_swc(file_paths[0])
+    arr = SWCArray_of(forest)
+    assert forest_from_array(arr) == forest
+    assert arr.node_type_counts() == node_type_counts_forest(forest)
+    assert sorted(arr.branching_degree()) == sorted(_branching_degree(forest))
+    assert arr.discrete_depth() == max(discrete_depth(tree) for tree in forest)
+    expected_length = 0.0
+    treelist = list(forest)
+    while bool(treelist):
+        tree = treelist.pop()
+        for child_tree in tree.child_subgraphs:
+            expected_length += math.dist(
+                tree.root.coord_triple, child_tree.root.coord_triple
+            )
+            treelist.append(child_tree)
+    assert np.isclose(arr.total_length(), expected_length)
+    assert np.isclose(sum(total_length(tree) for tree in forest), expected_length)
+    components = arr.components()
+    assert [forest_from_array(c) for c in components] == [[tree] for tree in forest]
+    filtered = arr.filter(np.isin(arr.structure_id, [1, 3]))
+    filtered_forest = filter_forest(forest, lambda node: node.structure_id in [1, 3])
+    assert sorted(len(c) for c in filtered.components()) == sorted(
+        map(num_nodes, filtered_forest)
+    )
+
+
+def test_read_swc_array():
+    _, file_paths = get_filenames("tests/swc", default_name_validate)
+    for file_path in file_paths:
+        forest, _ = read_swc(file_path)
+        assert read_swc_array(file_path) == SWCArray_of(forest)
+    # Branches whose nodes are interleaved in the file.
+    with open("tests/interleaved.swc", "w") as outfile:
+        for sample_number, parent in [(1, -1), (2, 1), (3, 1), (4, 3), (5, 2)]:
+            outfile.write(f"{sample_number} 1 0.0 0.0 0.0 1.0 {parent}\n")
+    forest, _ = read_swc("tests/interleaved.swc")
+    arr = read_swc_array("tests/interleaved.swc")
+    assert arr.sample_number.tolist() == [1, 2, 3, 5, 4]
+    assert arr == SWCArray_of(forest)
+    os.remove("tests/interleaved.swc")
@@ -6,7 +6,15 @@ from src.cajal.utilities import (
     avg_shape_spt,
     leiden_clustering,
     louvain_clustering,
+    write_csv_block,
+    BinaryFormat,
+    Err,
+    icdm_binary_iterator,
+    is_icdm_binary,
 )
+from src.cajal.run_gw import cell_iterator_csv
+from scipy.spatial.distance import pdist
+import os
 import numpy as np
 
 
@@ -34,3 +42,30 @@ def test():
     avg_shape_spt(cell_names, gw_dist_dictionary, icdm_dict, coupling_mats, 3)
     leiden_clustering(gmat)
     louvain_clustering(gmat, 3)
+
+
+def test_binary_icdm():
+    rng = np.random.default_rng(0)
+    cells = [("cell_" + str(i), pdist(rng.random((6, 3)))) for i in range(5)]
+    failed = ("failed", Err("error"))
+    out_file = "tests/test_binary_icdm.icdm"
+    for binary in [BinaryFormat(), BinaryFormat("float32", compress=True)]:
+        assert write_csv_block(out_file, 6, iter(cells[:2] + [failed]), 2, binary) == [
+            failed
+        ]
+        assert is_icdm_binary(out_file)
+        append = BinaryFormat(binary.dtype, binary.compress, append=True)
+        write_csv_block(out_file, 6, iter(cells[2:]), 2, append)
+        names, icdms = zip(*icdm_binary_iterator(out_file))
+        assert list(names) == [name for name, _ in cells]
+        assert np.allclose(icdms, [icdm for _, icdm in cells], rtol=1e-6)
+        for (name, dmat), (_, icdm) in zip(cell_iterator_csv(out_file), cells):
+            assert dmat.shape == (6, 6)
+            assert np.allclose(dmat[np.triu_indices(6, 1)], icdm, rtol=1e-6)
+    try:
+        write_csv_block(out_file, 5, iter([]), 2, BinaryFormat(append=True))
+        assert False
+    except ValueError:
+        pass
+    os.remove(out_file)
+    assert not is_icdm_binary("tests/icdm.csv")